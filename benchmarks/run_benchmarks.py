@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 15:21:08 2026
+
+Benchmarks for decoding, pattern generation and scan inner loops
+
+Usage:
+    python benchmarks/run_benchmarks.py                       # run all, write benchmarks/results/<commit>.json
+    python benchmarks/run_benchmarks.py -k decode --quick     # only matching benchmarks, small inputs
+    python benchmarks/run_benchmarks.py --compare old.json    # print speedup against a previous run
+"""
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from modules.asic import Asic                       # noqa: E402
+from modules.decode import Decode                   # noqa: E402
+from modules.emulator import HitGenerator           # noqa: E402
+from modules.nexysio import Nexysio                 # noqa: E402
+from modules.paralleldecode import ParallelDecode   # noqa: E402
+from modules.voltageboard import Voltageboard       # noqa: E402
+
+
+STREAM_SIZES = [1 << 10, 100 << 10, 10 << 20, 100 << 20]
+STREAM_SIZES_QUICK = [1 << 10, 100 << 10]
+HIT_DENSITIES = [0.01, 0.1, 0.5]
+CLKDIVS = [1, 8, 16, 64]
+TELESCOPE_CHIPS = [1, 4, 8]
+
+
+def synthetic_stream(size: int, density: float, chipversion: int = 2, seed: int = 0) -> bytearray:
+    """
+    Readout stream with frames separated by idle bytes
+
+    :param size: Stream length in bytes
+    :param density: Fraction of bytes belonging to frames
+    :param chipversion: Frame format
+    :param seed: Random seed
+
+    :returns: Stream
+    """
+    hitgen = HitGenerator(chipversion=chipversion, seed=seed)
+    rng = np.random.default_rng(seed)
+
+    framelen = hitgen.bytesperhit * (2 if chipversion == 2 else 1)
+    nhits = max(int(size * density / framelen), 1)
+
+    frames = np.frombuffer(hitgen.frames(nhits), dtype=np.uint8).reshape(nhits, framelen)
+
+    # Distribute idle bytes randomly between the frames
+    idle = size - nhits * framelen
+    gaps = np.diff(np.sort(rng.integers(0, max(idle, 0) + 1, nhits + 1)))
+
+    stream = np.full(size, 0xFF, dtype=np.uint8)
+    starts = np.cumsum(gaps) + np.arange(nhits) * framelen
+    stream[starts[:, np.newaxis] + np.arange(framelen)] = frames
+
+    return bytearray(stream.tobytes())
+
+
+def measure(func, min_time: float = 0.2, repeat: int = 5) -> dict:
+    """
+    Time func, calls per repeat are chosen so a repeat takes about min_time
+
+    :returns: Dict with min/median/mean time per call in s
+    """
+    func()
+
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2 if elapsed == 0 else max(2, int(min_time / elapsed))
+
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+
+    return {'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+            'number': number, 'repeat': repeat}
+
+
+def bench_decode(quick: bool):
+    sizes = STREAM_SIZES_QUICK if quick else STREAM_SIZES
+
+    for chipversion, bytesperhit in ((2, 5), (4, 8)):
+        decode = Decode(bytesperhit=bytesperhit)
+        decoder = decode.decode_astropix4_hits if chipversion == 4 else decode.decode_astropix2_hits
+
+        for size in sizes:
+            for density in HIT_DENSITIES:
+                stream = synthetic_stream(size, density, chipversion)
+                hits = decode.hits_from_readoutstream(stream)
+                params = {'chipversion': chipversion, 'bytes': size, 'density': density, 'hits': len(hits)}
+
+                yield 'hits_from_readoutstream', params, size, lambda: decode.hits_from_readoutstream(stream)
+                yield f'decode_astropix{chipversion}_hits', params, size, lambda: decoder(hits)
+
+
+def bench_decode_windowed(quick: bool):
+    sizes = STREAM_SIZES_QUICK if quick else STREAM_SIZES
+    decode = Decode()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for size in sizes:
+            filename = os.path.join(tmpdir, f'stream_{size}.bin')
+            with open(filename, 'wb') as stream:
+                stream.write(synthetic_stream(size, 0.1))
+
+            params = {'bytes': size, 'density': 0.1}
+            yield 'decode_windowed', params, size, lambda: decode.decode_windowed(filename)
+
+
+def bench_decode_parallel(quick: bool):
+    sizes = STREAM_SIZES_QUICK if quick else STREAM_SIZES
+    workers = os.cpu_count()
+
+    for size in sizes:
+        stream = synthetic_stream(size, 0.1)
+
+        # Enough chunks to keep all workers busy
+        with ParallelDecode(workers=workers, chunk_size=size // (4 * workers)) as parallel:
+            params = {'bytes': size, 'density': 0.1, 'workers': workers}
+            yield 'decode_parallel', params, size, lambda: parallel.decode(stream)
+
+
+def bench_patterns(quick: bool):
+    nexys = Nexysio()
+
+    asic = Asic(None)
+    asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+    vector = asic.gen_asic_vector()
+
+    vboard = Voltageboard(None, 4, (8, [0, 0, 1.1, 1, 0, 0, 0.8, 1.2]))
+    vbvector = vboard._Voltageboard__vb_vector(vboard.pos, list(vboard.dacvalues))
+
+    for clkdiv in CLKDIVS:
+        params = {'clkdiv': clkdiv, 'bits': len(vector)}
+        yield 'gen_asic_pattern', params, len(vector), lambda: nexys.gen_asic_pattern(vector, True, clkdiv)
+
+        params = {'clkdiv': clkdiv, 'bits': len(vbvector)}
+        yield 'gen_gecco_pattern', params, len(vbvector), lambda: nexys.gen_gecco_pattern(12, vbvector, clkdiv)
+
+
+def bench_asic_vector(quick: bool):
+    for nchips in TELESCOPE_CHIPS:
+        asic = Asic(None)
+        asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+        if nchips > 1:
+            config = asic.asic_config
+            asic.num_chips = nchips
+            asic.asic_config = {f'config_{chip}': copy.deepcopy(config) for chip in range(nchips)}
+
+        params = {'nchips': nchips}
+        yield 'gen_asic_vector', params, None, lambda: asic.gen_asic_vector()
+
+        # Typical scan step: move to another pixel and regenerate
+        def pixel_step(asic=asic):
+            config = asic.asic_config if nchips == 1 else asic.asic_config['config_0']
+            config['recconfig']['col1'][1] ^= 1 << 5
+            asic.gen_asic_vector()
+
+        yield 'gen_asic_vector_after_change', params, None, pixel_step
+
+        if nchips == 1:
+            pixels = itertools.cycle([(col, row) for col in range(asic.num_cols) for row in range(asic.num_rows)])
+
+            # Scan pixel setup through the array backed recconfig
+            def select_step(asic=asic):
+                asic.select_pixel(*next(pixels))
+                asic.gen_asic_vector()
+
+            yield 'select_pixel', params, None, select_step
+
+
+def bench_config_load(quick: bool):
+    for cache in (False, True):
+        def load(cache=cache):
+            asic = Asic(None)
+            asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix', cache=cache)
+            asic.gen_asic_vector()
+
+        yield 'load_conf_from_yaml', {'cache': cache}, None, load
+
+
+def bench_voltageboard(quick: bool):
+    nexys = Nexysio()
+    handle = nexys.open_emulator()
+
+    vboard = Voltageboard(handle, 4, (8, [0, 0, 1.1, 1, 0, 0, 0.8, 1.2]))
+
+    yield 'update_vb', {}, None, vboard.update_vb
+
+    thresholds = iter(np.tile(np.round(np.arange(1.0, 1.6, 0.01), 2), 1 << 20))
+
+    def threshold_step():
+        vboard.dacvalues = (8, [0, 0, 1.1, 1, 0, 0, 0.8, next(thresholds)])
+        vboard.update_vb()
+
+    yield 'update_vb_threshold_step', {}, None, threshold_step
+
+    # The 60 thresholds above fit in the pattern LRU, measure generation without it
+    def threshold_step_uncached():
+        vboard.pattern_cache.clear()
+        threshold_step()
+
+    yield 'update_vb_threshold_step', {'cache': False}, None, threshold_step_uncached
+
+
+BENCHMARKS = [bench_decode, bench_decode_windowed, bench_decode_parallel, bench_patterns, bench_asic_vector, bench_config_load, bench_voltageboard]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def result_key(result: dict) -> str:
+    return result['name'] + json.dumps(result['params'], sort_keys=True)
+
+
+def run(keyword: str, quick: bool, min_time: float, repeat: int) -> list:
+    results = []
+
+    for group in BENCHMARKS:
+        for name, params, nbytes, func in group(quick):
+            if keyword and keyword not in name:
+                continue
+
+            timing = measure(func, min_time, repeat)
+
+            result = {'name': name, 'params': params, **timing}
+            if nbytes:
+                result['throughput_MBps'] = nbytes / timing['min'] / 1e6
+
+            print(f"{name:32s} {json.dumps(params):70s} {timing['min'] * 1e3:12.4f} ms")
+            results.append(result)
+
+    return results
+
+
+def compare(results: list, filename: str) -> None:
+    with open(filename, 'r', encoding='utf-8') as stream:
+        previous = {result_key(result): result for result in json.load(stream)['results']}
+
+    print(f"\nComparison against {filename} (speedup > 1 is faster)")
+    for result in results:
+        old = previous.get(result_key(result))
+        if old:
+            print(f"{result['name']:32s} {json.dumps(result['params']):70s} {old['min'] / result['min']:8.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', '--keyword', default='', help='Only run benchmarks containing keyword')
+    parser.add_argument('--quick', action='store_true', help='Skip large streams')
+    parser.add_argument('--min-time', type=float, default=0.2, help='Min. time per repeat in s')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeats per benchmark')
+    parser.add_argument('-o', '--output', help='Result file, default benchmarks/results/<commit>.json')
+    parser.add_argument('--compare', help='Previous result file to compare with')
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+
+    # Config files are loaded relative to the repository root
+    os.chdir(ROOT)
+
+    commit = git_commit()
+    results = run(args.keyword, args.quick, args.min_time, args.repeat)
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+    with open(output, 'w', encoding='utf-8') as stream:
+        json.dump({
+            'commit': commit,
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'results': results,
+        }, stream, indent=2)
+
+    print(f"\nResults written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
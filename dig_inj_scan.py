@@ -9,6 +9,7 @@ Created on Sat Jun 26 00:10:56 2021
 import time
 
 from modules.asic import Asic
+from modules.hitstore import PARQUET_AVAILABLE
 from modules.injectionboard import Injectionboard
 from modules.nexysio import Nexysio
 from modules.voltageboard import Voltageboard
@@ -56,29 +57,45 @@ def main():
     col = None
     inj_pulses = 100
 
+    # 'parquet' stores typed columns and the run settings as file metadata, 'csv' a text log
+    output_format = 'parquet' if PARQUET_AVAILABLE else 'csv'
+
+    scan_kwargs = dict(vinj=vinj,
+                       vth=vth,
+                       v_start=v_start,
+                       v_stop=v_stop,
+                       scan_method=scan_method,
+                       noise_run=noise_run,
+                       row=row,
+                       col=col,
+                       counts=counts,
+                       inj_pulses=inj_pulses,
+                       v_vdd33=vboard1.vsupply)
+
     timestr = time.strftime("dig_inj_scan_%Y%m%d-%H%M%S")
-    with open("log/%s.log" % timestr, "w", buffering=1, newline='\n') as file:
-        file.write(f"Voltageboard settings: {vboard1.dacvalues}\n")
-        file.write(f"Digital: {asic.asic_config['digitalconfig']}\n")
-        file.write(f"Biasblock: {asic.asic_config['biasconfig']}\n")
-        file.write(f"IDAC: {asic.asic_config['idacs']}\n")
-        file.write(f"VDAC: {asic.asic_config.get('vdacs')}\n")
-        file.write(f"Receiver: {asic.asic_config['recconfig']}\n")
-        file.write(f"Noise run: {noise_run}\n")
-        file.write(f"Scan_method: {scan_method}\n")
-        file.write(f"Inj pulses: {inj_pulses}\n")
-
-        Scan.scan_binsearch(asic, vboard1, inj, nexys, file,
-                            vinj=vinj,
-                            vth=vth,
-                            v_start=v_start,
-                            v_stop=v_stop,
-                            scan_method=scan_method,
-                            row=row,
-                            col=col,
-                            counts=counts,
-                            inj_pulses=inj_pulses,
-                            v_vdd33=vboard1.vsupply)
+
+    if output_format == 'parquet':
+        metadata = {
+            'voltageboard': vboard1.dacvalues,
+            'asic_config': {group: asic.asic_config.get(group)
+                            for group in ('digitalconfig', 'biasconfig', 'idacs', 'vdacs', 'recconfig')},
+        }
+
+        Scan.scan_binsearch(asic, vboard1, inj, nexys, "log/%s.parquet" % timestr, metadata=metadata,
+                            **scan_kwargs)
+    else:
+        with open("log/%s.log" % timestr, "w", buffering=1, newline='\n') as file:
+            file.write(f"Voltageboard settings: {vboard1.dacvalues}\n")
+            file.write(f"Digital: {asic.asic_config['digitalconfig']}\n")
+            file.write(f"Biasblock: {asic.asic_config['biasconfig']}\n")
+            file.write(f"IDAC: {asic.asic_config['idacs']}\n")
+            file.write(f"VDAC: {asic.asic_config.get('vdacs')}\n")
+            file.write(f"Receiver: {asic.asic_config['recconfig']}\n")
+            file.write(f"Noise run: {noise_run}\n")
+            file.write(f"Scan_method: {scan_method}\n")
+            file.write(f"Inj pulses: {inj_pulses}\n")
+
+            Scan.scan_binsearch(asic, vboard1, inj, nexys, file, **scan_kwargs)
 
     # Close connection
     nexys.close()
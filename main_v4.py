@@ -5,11 +5,15 @@ Created on Sat Jun 26 00:10:56 2021
 
 @author: Nicolas Striebig
 """
+import time
+
 from modules.asic import Asic
 from modules.injectionboard import Injectionboard
 from modules.nexysio import Nexysio
 from modules.voltageboard import Voltageboard
 from modules.decode import Decode
+from modules.hitstore import HitStore, PARQUET_AVAILABLE
+from modules.readout import ReadoutStream
 from utils.utils import wait_progress
 
 
@@ -98,14 +102,21 @@ def main():
     inj.start()
 
     wait_progress(3)
-    while True:
-        # Read max. 100 times or until read FIFO is empty
-        readout = nexys.read_spi(100)
 
-        decode = Decode(bytesperhit=8)
-        list_hits = decode.hits_from_readoutstream(readout)
+    decode = Decode(bytesperhit=8)
+
+    # Decoded hits are also written to a file, Parquet with pyarrow and CSV without
+    extension = 'parquet' if PARQUET_AVAILABLE else 'csv'
+    store = HitStore.create(list(decode.decode_astropix4_columns([])),
+                            time.strftime(f"log/readout_%Y%m%d-%H%M%S.{extension}"))
+
+    # Read SPI in a background thread, decode and print in this one
+    with store, ReadoutStream(nexys, decode, decoder='astropix4') as stream:
+        stream.add_sink(store, decoded=True)
 
-        print(decode.decode_astropix4_hits(list_hits).to_string())
+        for hits in stream.batches():
+            if len(hits):
+                print(hits.to_string())
 
 
 if __name__ == "__main__":
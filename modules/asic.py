@@ -7,11 +7,16 @@ Created on Fri Jun 25 16:28:27 2021
 
 Functions for ASIC configuration
 """
+import hashlib
 import logging
+import os
+import pickle
+
+import numpy as np
 import yaml
 from bitstring import BitArray
 
-from modules.nexysio import Nexysio
+from modules.nexysio import Nexysio, PatternCache
 from modules.setup_logger import logger
 
 
@@ -22,10 +27,385 @@ COLCONFIG_MASK_ROW = 0b111_11111_11111_11111_11111_11111_11111_11110
 COLCONFIG_MASK_COL = 0b101_11111_11111_11111_11111_11111_11111_11111
 COLCONFIG_MASK_AMP = 0b011_11111_11111_11111_11111_11111_11111_11111
 
+COLCONFIG_INJ_ROW  = 1 << 0
+COLCONFIG_INJ_COL  = 1 << 36
+COLCONFIG_AMPOUT   = 1 << 37
+
+ASIC_CLKDIV        = 8
+
+CONFIG_CACHE_VERSION = 1
+
+
+class ConfigVector:
+    """
+    Compiled config layout with a persistent bit buffer
+
+    Offset and width of every config field are recorded once,
+    changed fields are patched in place instead of rebuilding the whole vector.
+    The buffer holds the fields MSB first in dict order.
+    """
+
+    def __init__(self, reverse_blocks: tuple = ()) -> None:
+        """Init
+
+        :param reverse_blocks: Config blocks whose fields are stored bitreversed
+        """
+        self._reverse_blocks = reverse_blocks
+
+        self._bits = BitArray()
+        self._layout = []       # [block, name, offset, nbits, length, value] per field
+        self._fields = {}       # (block, name) -> layout entry
+
+    @property
+    def bits(self) -> BitArray:
+        """Compiled bit buffer, do not modify"""
+        return self._bits
+
+    @property
+    def fields(self) -> list:
+        """Field table
+
+        :returns: List of (group, name, offset, width, reverse) tuples
+        """
+        return [(block, name, offset, length, block in self._reverse_blocks)
+                for block, name, offset, _, length, _ in self._layout]
+
+    def digest(self) -> bytes:
+        """Hash of the compiled bit buffer
+
+        :returns: Digest
+        """
+        data = len(self._bits).to_bytes(4, 'big') + self._bits.tobytes()
+
+        return hashlib.blake2b(data, digest_size=16).digest()
+
+    @staticmethod
+    def field_bits(value: int, nbits: int) -> BitArray:
+        """Convert int to nbit bitarray
+
+        :param value: Integer value
+        :param nbits: Number of bits
+
+        :returns: Bitarray of specified length, None if value does not fit
+        """
+
+        try:
+            return BitArray(uint=value, length=nbits)
+        except ValueError:
+            logger.error('Allowed Values 0 - %d', 2**nbits - 1)
+            return None
+
+    def _encode(self, block: str, value: int, nbits: int) -> BitArray:
+        bits = self.field_bits(value, nbits)
+
+        if bits is not None and block in self._reverse_blocks:
+            bits.reverse()
+
+        return bits
+
+    def compile(self, config: dict) -> BitArray:
+        """Rebuild layout and bit buffer from config
+
+        :param config: Config dict {block: {name: [nbits, value]}}
+
+        :returns: Bit buffer
+        """
+
+        self._bits = BitArray()
+        self._layout = []
+        self._fields = {}
+
+        for block, fields in config.items():
+            for name, values in fields.items():
+                bits = self._encode(block, values[1], values[0])
+
+                # Values out of range are left out, as appending None to a BitArray does nothing
+                length = len(bits) if bits is not None else 0
+
+                entry = [block, name, len(self._bits), values[0], length, values[1]]
+                self._layout.append(entry)
+                self._fields[(block, name)] = entry
+
+                if length:
+                    self._bits.append(bits)
+
+        return self._bits
+
+    def patch(self, config: dict, block: str, name: str) -> bool:
+        """Update a single field in the bit buffer
+
+        :param config: Config dict
+        :param block: Config block
+        :param name: Field name
+
+        :returns: False if the field changed its length and the layout has to be recompiled
+        """
+
+        entry = self._fields.get((block, name))
+
+        if entry is None:
+            return False
+
+        try:
+            nbits, value = config[block][name][:2]
+
+            if value == entry[5] and nbits == entry[3]:
+                return True
+
+            bits = self._encode(block, value, nbits) if nbits == entry[3] else None
+        except (TypeError, ValueError):
+            # Invalid field, raised again by compile() when the vector is generated
+            bits = None
+
+        if bits is None or len(bits) != entry[4]:
+            # Force recompile on next sync
+            self._layout = []
+            self._fields = {}
+            return False
+
+        self._bits.overwrite(bits, entry[2])
+        entry[5] = value
+
+        return True
+
+    def sync(self, config: dict) -> BitArray:
+        """Patch all fields changed since the last sync, recompile if the layout changed
+
+        :param config: Config dict
+
+        :returns: Bit buffer
+        """
+
+        layout = self._layout
+        index = 0
+
+        for block, fields in config.items():
+            for name, values in fields.items():
+                if index >= len(layout):
+                    return self.compile(config)
+
+                entry = layout[index]
+                index += 1
+
+                if entry[1] != name or entry[0] != block:
+                    return self.compile(config)
+
+                if values[1] != entry[5] or values[0] != entry[3]:
+                    if not self.patch(config, block, name):
+                        return self.compile(config)
+
+        if index != len(layout) or not layout:
+            return self.compile(config)
+
+        return self._bits
+
+
+class ConfigCache:
+    """
+    Pickle sidecar next to a YAML config file
+
+    Holds the parsed YAML and the compiled config vectors, keyed by the hash of the YAML file.
+    A changed YAML file invalidates the sidecar, it is rebuilt on the next load.
+    """
+
+    def __init__(self, filename: str) -> None:
+        """Init
+
+        :param filename: Path of the YAML file
+        """
+        self.filename = filename
+        self.cachefile = f"{filename}.cache"
+
+        self.config = None
+        self._vectors = {}
+        self._digest = None
+        self._changed = False
+
+    def load(self, use_cache: bool = True) -> dict:
+        """Load YAML config, from the sidecar if it is up to date
+
+        :param use_cache: Read the sidecar, otherwise always parse the YAML
+
+        :returns: Dict from YAML, None if the YAML could not be parsed
+        """
+        with open(self.filename, "rb") as stream:
+            data = stream.read()
+
+        self._digest = hashlib.sha256(data).hexdigest()
+
+        cached = self._read_cache() if use_cache else None
+
+        if cached is not None:
+            logger.debug("Config loaded from cache %s", self.cachefile)
+            self.config, self._vectors = cached['config'], cached['vectors']
+            return self.config
+
+        try:
+            self.config = yaml.safe_load(data)
+        except yaml.YAMLError as exc:
+            logger.error(exc)
+            self.config = None
+            return None
+
+        self._vectors = {}
+        self._changed = True
+
+        return self.config
+
+    def _read_cache(self) -> dict:
+        try:
+            with open(self.cachefile, "rb") as stream:
+                cached = pickle.load(stream)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError) as exc:
+            logger.debug("Ignoring unreadable config cache %s: %s", self.cachefile, exc)
+            return None
+
+        if not isinstance(cached, dict) or cached.get('version') != CONFIG_CACHE_VERSION \
+                or cached.get('hash') != self._digest:
+            return None
+
+        return cached
+
+    def vector(self, key: tuple, config: dict, reverse_blocks: tuple = ()) -> ConfigVector:
+        """Compiled config vector, compiled and added to the cache on a miss
+
+        :param key: Cache key, e.g. (chip, config name)
+        :param config: Config dict loaded with load()
+        :param reverse_blocks: Config blocks stored bitreversed
+
+        :returns: ConfigVector
+        """
+        vector = self._vectors.get(key)
+
+        if vector is None:
+            vector = ConfigVector(reverse_blocks)
+            vector.compile(config)
+
+            self._vectors[key] = vector
+            self._changed = True
+
+        return vector
+
+    def save(self) -> None:
+        """Write sidecar if something was parsed or compiled"""
+
+        if not self._changed or self.config is None:
+            return
+
+        # Write next to the sidecar and swap it in, readers never see a partial file
+        tmpfile = f"{self.cachefile}.{os.getpid()}.tmp"
+
+        try:
+            with open(tmpfile, "wb") as stream:
+                pickle.dump({'version': CONFIG_CACHE_VERSION, 'hash': self._digest,
+                             'config': self.config, 'vectors': self._vectors}, stream)
+            os.replace(tmpfile, self.cachefile)
+        except OSError as exc:
+            logger.debug("Could not write config cache %s: %s", self.cachefile, exc)
+            try:
+                os.remove(tmpfile)
+            except OSError:
+                pass
+            return
+
+        self._changed = False
+
+
+class RecConfig:
+    """
+    Array backed receiver config, one uint64 per column
+
+    Bit 0 switches the injection of the row with the same number as the column,
+    bits 1 to 35 disable the pixel comparators of the column,
+    bit 36 switches the column injection and bit 37 selects the column for the analog mux.
+    Changed columns are tracked and written back to the config dict on flush().
+    """
+
+    def __init__(self, recconfig: dict) -> None:
+        """Init
+
+        :param recconfig: recconfig block of the config dict {colN: [nbits, value]}
+        """
+        self._keys = [f'col{col}' for col in range(len(recconfig))]
+
+        self.values = np.array([recconfig[key][1] for key in self._keys], dtype=np.uint64)
+        self._dirty = np.zeros(len(self._keys), dtype=bool)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def update(self, values: np.ndarray) -> None:
+        """Replace column values, only columns with a different value are marked changed
+
+        :param values: uint64 array with one value per column
+        """
+        self._dirty |= values != self.values
+        self.values = values
+
+    def set_columns(self, cols, set_mask: int = 0, clear_mask: int = 0) -> None:
+        """Set and clear bits in some columns
+
+        :param cols: Column index, slice or index array
+        :param set_mask: Bits to set
+        :param clear_mask: Bits to clear
+        """
+        values = self.values.copy()
+        values[cols] = (values[cols] & np.uint64(~clear_mask & 0xFFFF_FFFF_FFFF_FFFF)) | np.uint64(set_mask)
+        self.update(values)
+
+    @staticmethod
+    def pixel_bits(mask: np.ndarray) -> np.ndarray:
+        """Comparator disable bits per column from a mask of enabled pixels
+
+        :param mask: Bool array (cols, rows), True enables the pixel
+
+        :returns: uint64 array with one value per column
+        """
+        disabled = ~np.asarray(mask, dtype=bool)
+        shifts = np.arange(1, disabled.shape[1] + 1, dtype=np.uint64)
+
+        return np.bitwise_or.reduce(disabled.astype(np.uint64) << shifts, axis=1)
+
+    def pixel_mask(self, num_rows: int) -> np.ndarray:
+        """Enabled pixels
+
+        :param num_rows: Number of rows
+
+        :returns: Bool array (cols, rows), True if the pixel is enabled
+        """
+        shifts = np.arange(1, num_rows + 1, dtype=np.uint64)
+
+        return (self.values[:, np.newaxis] >> shifts & np.uint64(1)) == 0
+
+    def flush(self, recconfig: dict) -> list:
+        """Write changed columns to the config dict
+
+        :param recconfig: recconfig block of the config dict
+
+        :returns: Keys of the written columns
+        """
+        keys = []
+
+        for col in np.flatnonzero(self._dirty).tolist():
+            key = self._keys[col]
+            recconfig[key][1] = int(self.values[col])
+            keys.append(key)
+
+        self._dirty[:] = False
+
+        return keys
+
 
 class Asic(Nexysio):
     """Configure ASIC"""
 
+    _config_vectors = None
+    _written_config = None
+    _recconfig = None
+    _spi_config = False
+
     def __init__(self, handle) -> None:
 
         self._handle = handle
@@ -35,7 +415,7 @@ class Asic(Nexysio):
         self._num_rows = 35
         self._num_cols = 35
 
-        self.asic_config = {}
+        self._asic_config = {}
         self.asic_tdac_config = {}
 
         self._num_chips = 1             # is this correct?
@@ -44,6 +424,42 @@ class Asic(Nexysio):
 
         self._is_lf_tst_vers = True          # Temporary Cod Mod to avoid immediate deletion of code
 
+        self._spi_config = False
+
+    @property
+    def asic_config(self) -> dict:
+        """Get/set config dict
+
+        Pending recconfig changes are written to the dict first,
+        afterwards the dict can be edited directly.
+
+        :returns: Config dict
+        """
+        self._flush_recconfig()
+        self._recconfig = None
+
+        return self._asic_config
+
+    @asic_config.setter
+    def asic_config(self, config: dict):
+        self._asic_config = config
+        self._recconfig = None
+
+    @property
+    def spi_config(self) -> bool:
+        """Get/set per chip configuration over SPI
+
+        If enabled, update_asic() writes only changed telescope chips,
+        addressed by chip id over SPI. SPI has to be enabled on the Nexys.
+
+        :returns: Per chip configuration over SPI enabled
+        """
+        return self._spi_config
+
+    @spi_config.setter
+    def spi_config(self, enable: bool):
+        self._spi_config = enable
+
     @property
     def chipname(self):
         """Get/set chipname
@@ -149,10 +565,11 @@ class Asic(Nexysio):
 
         :param col: Col number
         """
-        for i in range(self.num_cols):
-            self.asic_config['recconfig'][f'col{i}'][1] &= COLCONFIG_MASK_AMP
+        recconfig = self._recconfig_array()
 
-        self.asic_config['recconfig'][f'col{col}'][1] |= 1 << 37
+        values = recconfig.values & np.uint64(COLCONFIG_MASK_AMP)
+        values[col] |= np.uint64(COLCONFIG_AMPOUT)
+        recconfig.update(values)
 
     def enable_pixel(self, col: int, row: int):
         """Enable pixel comparator for specified pixel
@@ -181,9 +598,9 @@ class Asic(Nexysio):
         """
         if row < self.num_rows and col < self.num_cols:
             if enable:
-                self.asic_config['recconfig'][f'col{col}'][1] &= ~(2 << row)
+                self._recconfig_array().set_columns(col, clear_mask=2 << row)
             else:
-                self.asic_config['recconfig'][f'col{col}'][1] |= (2 << row)
+                self._recconfig_array().set_columns(col, set_mask=2 << row)
 
     def set_inj_row(self, row: int, enable: bool):
         """Enable or disable row injection switch
@@ -193,9 +610,9 @@ class Asic(Nexysio):
         """
         if row < self.num_rows:
             if enable:
-                self.asic_config['recconfig'][f'col{row}'][1] |= 1 << 0
+                self._recconfig_array().set_columns(row, set_mask=COLCONFIG_INJ_ROW)
             else:
-                self.asic_config['recconfig'][f'col{row}'][1] &= COLCONFIG_MASK_ROW
+                self._recconfig_array().set_columns(row, clear_mask=COLCONFIG_INJ_ROW)
 
     def set_inj_col(self, col: int, enable: bool):
         """Enable or disable col injection switch
@@ -205,9 +622,9 @@ class Asic(Nexysio):
         """
         if col < self.num_cols:
             if enable:
-                self.asic_config['recconfig'][f'col{col}'][1] |= 1 << 36
+                self._recconfig_array().set_columns(col, set_mask=COLCONFIG_INJ_COL)
             else:
-                self.asic_config['recconfig'][f'col{col}'][1] &= COLCONFIG_MASK_COL
+                self._recconfig_array().set_columns(col, clear_mask=COLCONFIG_INJ_COL)
 
     def get_pixel(self, col: int, row: int) -> bool:
         """Check if Pixel is enabled
@@ -216,15 +633,108 @@ class Asic(Nexysio):
         :param row: Row number
         """
         if row < self.num_rows:
-            return not bool(self.asic_config['recconfig'].get(f'col{col}')[1] & (1 << (row + 1)))
+            return not bool(int(self._recconfig_array().values[col]) & (1 << (row + 1)))
 
         logger.error("Invalid row %d larger than %d", row, self.num_rows)
         return None
 
     def reset_recconfig(self):
         """Reset recconfig to default mask"""
-        for key in self.asic_config['recconfig']:
-            self.asic_config['recconfig'][key][1] = COLCONFIG_MASK_ALL
+        recconfig = self._recconfig_array()
+        recconfig.update(np.full(len(recconfig), COLCONFIG_MASK_ALL, dtype=np.uint64))
+
+    def select_pixel(self, col: int, row: int, inj: bool = True, ampout: bool = True) -> None:
+        """Enable only the comparator of one pixel, optionally with injection and analog output
+
+        Same as reset_recconfig(), enable_ampout_col(col), set_inj_col(col, True),
+        set_inj_row(row, True) and set_pixel_comparator(col, row, True)
+
+        :param col: Col number
+        :param row: Row number
+        :param inj: Enable injection switches of the pixel
+        :param ampout: Select col for the analog mux
+        """
+        recconfig = self._recconfig_array()
+
+        values = np.full(len(recconfig), COLCONFIG_MASK_ALL, dtype=np.uint64)
+
+        if ampout:
+            values[col] |= np.uint64(COLCONFIG_AMPOUT)
+
+        if inj:
+            values[col] |= np.uint64(COLCONFIG_INJ_COL)
+            values[row] |= np.uint64(COLCONFIG_INJ_ROW)
+
+        values[col] &= np.uint64(~(2 << row) & 0xFFFF_FFFF_FFFF_FFFF)
+
+        recconfig.update(values)
+
+    def apply_pixel_mask(self, mask: np.ndarray) -> None:
+        """Enable pixel comparators from a mask, injection and ampout bits are kept
+
+        :param mask: Bool array (cols, rows), True enables the pixel
+        """
+        recconfig = self._recconfig_array()
+
+        mask = np.asarray(mask, dtype=bool)
+        pixel_bits = np.uint64(((1 << mask.shape[1]) - 1) << 1)
+
+        values = recconfig.values.copy()
+        values[:len(mask)] = (values[:len(mask)] & ~pixel_bits) | RecConfig.pixel_bits(mask)
+
+        recconfig.update(values)
+
+    def set_pixels(self, pixels, enable: bool = True) -> None:
+        """Enable or disable the comparators of a set of pixels
+
+        :param pixels: Iterable of (col, row) tuples or array (N, 2)
+        :param enable: True to enable, False to disable
+        """
+        pixels = np.asarray(list(pixels) if not isinstance(pixels, np.ndarray) else pixels, dtype=np.int64)
+
+        if not len(pixels):
+            return
+
+        cols, rows = pixels.reshape(-1, 2).T
+
+        valid = (rows < self.num_rows) & (cols < self.num_cols)
+        cols, rows = cols[valid], rows[valid]
+
+        recconfig = self._recconfig_array()
+
+        bits = np.zeros(len(recconfig), dtype=np.uint64)
+        np.bitwise_or.at(bits, cols, np.uint64(2) << rows.astype(np.uint64))
+
+        if enable:
+            recconfig.update(recconfig.values & ~bits)
+        else:
+            recconfig.update(recconfig.values | bits)
+
+    def pixel_mask(self) -> np.ndarray:
+        """Enabled pixel comparators
+
+        :returns: Bool array (cols, rows), True if the pixel is enabled
+        """
+        return self._recconfig_array().pixel_mask(self.num_rows)
+
+    def _recconfig_array(self) -> RecConfig:
+        """Array backed recconfig of the single chip config, loaded from the dict on first use
+
+        :returns: RecConfig
+        """
+        if self._recconfig is None:
+            self._recconfig = RecConfig(self._asic_config['recconfig'])
+
+        return self._recconfig
+
+    def _flush_recconfig(self) -> None:
+        """Write changed recconfig columns to the config dict and the compiled vector"""
+
+        if self._recconfig is None:
+            return
+
+        for key in self._recconfig.flush(self._asic_config['recconfig']):
+            self._patch_config('recconfig', key)
 
     def set_internal_vdac(self, dac: str, voltage: float, vdda: float = 1.8, nbits: int = 10) -> None:
         """Set integrated VDAC voltage
@@ -234,9 +744,10 @@ class Asic(Nexysio):
         :param vdd: Supply voltage VDDA
         :param nbits: VDAC resolution
         """
-        if dac in self.asic_config['vdacs'] and 0 <= voltage <= 1.8:
+        if dac in self._asic_config['vdacs'] and 0 <= voltage <= 1.8:
             dacval = voltage * vdda / 2**nbits
-            self.asic_config['vdacs'][dac] = dacval
+            self._asic_config['vdacs'][dac] = dacval
+            self._patch_config('vdacs', dac)
             logger.debug('Set internal vdac: %s to %d V (dacval: %d)', dac, voltage, dacval)
         else:
             logger.warning('Can not set internal vdac: %s to %d V!', dac, voltage)
@@ -251,11 +762,43 @@ class Asic(Nexysio):
         :returns: Bitarray of specified length
         """
 
-        try:
-            return BitArray(uint=value, length=nbits)
-        except ValueError:
-            logger.error('Allowed Values 0 - %d', 2**nbits - 1)
-            return None
+        return ConfigVector.field_bits(value, nbits)
+
+    def _config_vector(self, chip: int = None) -> ConfigVector:
+        """Compiled config of a chip
+
+        :param chip: Chip number in telescope setup, None for a single chip
+
+        :returns: ConfigVector
+        """
+        if self._config_vectors is None:
+            self._config_vectors = {}
+
+        vector = self._config_vectors.get(chip)
+
+        if vector is None:
+            vector = ConfigVector(self._reverse_blocks(chip))
+            self._config_vectors[chip] = vector
+
+        return vector
+
+    @staticmethod
+    def _reverse_blocks(chip: int = None) -> tuple:
+        """Config blocks stored bitreversed
+
+        :param chip: Chip number in telescope setup, None for a single chip
+        """
+        # Only single chip configs store the vdac block bitreversed
+        return ('vdac_block',) if chip is None else ()
+
+    def _patch_config(self, block: str, name: str) -> None:
+        """Patch changed field of the single chip config into the compiled vector
+
+        :param block: Config block
+        :param name: Field name
+        """
+        if self._config_vectors and None in self._config_vectors:
+            self._config_vectors[None].patch(self._asic_config, block, name)
 
     def load_conf_from_yaml(self, chipversion: int, filename: str, **kwargs) -> None:
         """Load ASIC config from yaml
@@ -263,18 +806,17 @@ class Asic(Nexysio):
         :param chipversion: Name of yml file in config folder     
         :param filename: Name of yml file in config folder
         :param chipname; Name of the chip i.e. astropix
+        :param cache: Use the compiled config cache next to the yml file, default True
         """
         #DO I introduce a Bug, because my chipversion (1) is not part of yml file name?
         chipname = kwargs.get('chipname', 'astropix_lf_test')
+        use_cache = kwargs.get('cache', True)
 
         self.chipversion = chipversion
         self.chipname = chipname
 
-        with open(f"config/{filename}.yml", "r", encoding="utf-8") as stream:
-            try:
-                dict_from_yml = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                logger.error(exc)
+        cache = ConfigCache(f"config/{filename}.yml")
+        dict_from_yml = cache.load(use_cache)
 
         # Get Telescope settings
         try:
@@ -311,6 +853,22 @@ class Asic(Nexysio):
                 logger.error("%s%d config not found!", chipname, chipversion)
                 raise
 
+        # Compiled config vectors, cached with the parsed yml
+        self._config_vectors = {}
+        self._written_config = None
+
+        if use_cache:
+            if self.num_chips > 1:
+                for chip_number in range(self.num_chips):
+                    self._config_vectors[chip_number] = cache.vector(
+                        (self.chip, f'config_{chip_number}'), self._asic_config[f'config_{chip_number}'],
+                        self._reverse_blocks(chip_number))
+            else:
+                self._config_vectors[None] = cache.vector((self.chip, 'config'), self._asic_config,
+                                                          self._reverse_blocks(None))
+
+            cache.save()
+
         # Get chip tdac configs only IF chip is NOT LF Test Chip, dont know what TDAC is!
         if not self._is_lf_tst_vers:
             if self.num_chips > 1:
@@ -363,28 +921,24 @@ class Asic(Nexysio):
 
         bitvector = BitArray()
 
+        # Compiled vectors are patched with fields changed since the last call
         if self.num_chips > 1:
-            for chip in range(self.num_chips - 1, -1, -1):
-
-                for key in self.asic_config[f'config_{chip}']:
-                    for values in self.asic_config[f'config_{chip}'][key].values():
-                        bitvector.append(self.__int2nbit(values[1], values[0]))
+            # The daisy chain is one shift register, chip n-1 first MSB first.
+            # LSB first is the reverse of the whole chain: every chip segment is reversed on its own
+            # and chip 0 comes first, each segment equals the SPI vector of gen_asic_chip_vector()
+            chips = range(self.num_chips - 1, -1, -1) if msbfirst else range(self.num_chips)
 
-                if not msbfirst:
-                    bitvector.reverse()
+            for chip in chips:
+                bitvector.append(self.gen_asic_chip_vector(chip, msbfirst))
 
                 logger.info("Generated chip_%d config successfully!", chip)
 
         else:
             logger.info("Start chip config generation!")
-            for key in self.asic_config:
-                for values in self.asic_config[key].values():
-                    if key == 'vdac_block':          # What is different here?!
-                        bitvector2 = BitArray(self.__int2nbit(values[1], values[0]))
-                        bitvector2.reverse()
-                        bitvector.append(bitvector2)
-                    else:
-                        bitvector.append(self.__int2nbit(values[1], values[0]))
+
+            # vdac_block fields are stored bitreversed (What is different here?!)
+            self._flush_recconfig()
+            bitvector.append(self._config_vector().sync(self._asic_config))
 
             if not msbfirst:
                 bitvector.reverse()
@@ -419,22 +973,149 @@ class Asic(Nexysio):
 
         return bitvector
 
-    def update_asic(self) -> None:
-        """Update ASIC"""
+    def gen_asic_chip_vector(self, chip: int, msbfirst: bool = False) -> BitArray:
+        """Generate bitvector of a single telescope chip
+
+        :param chip: Chip number in telescope setup
+        :param msbfirst: Send vector MSB first
+        """
+        bitvector = BitArray(self._config_vector(chip).sync(self._asic_config[f'config_{chip}']))
+
+        if not msbfirst:
+            bitvector.reverse()
+
+        return bitvector
+
+    def _config_digests(self) -> dict:
+        """Hashes of the compiled config vectors per chip
+
+        :returns: Dict chip -> digest, chip is None for a single chip
+        """
+        if self.num_chips > 1:
+            digests = {}
+
+            for chip in range(self.num_chips):
+                vector = self._config_vector(chip)
+                vector.sync(self._asic_config[f'config_{chip}'])
+                digests[chip] = vector.digest()
+
+            return digests
+
+        self._flush_recconfig()
+
+        vector = self._config_vector()
+        vector.sync(self._asic_config)
+
+        return {None: vector.digest()}
+
+    def dirty_chips(self) -> list:
+        """Chips with config changes not written yet
+
+        :returns: List of chip numbers, None for a single chip
+        """
+        digests = self._config_digests()
+        written = self._written_digests()
+
+        if written is None:
+            return list(digests)
+
+        return [chip for chip, digest in digests.items() if written.get(chip) != digest]
+
+    def _written_digests(self) -> dict:
+        """Digests written to the chip selected by the demux since the last chip reset
+
+        :returns: Dict chip -> digest, None if nothing was written to the selected chip
+        """
+        if self._written_config is None:
+            return None
+
+        return self._written_config.get(self.chip_state.key)
+
+    def _store_written_digests(self, digests: dict) -> None:
+        """Remember digests for the selected chip, configs written before a chip reset are dropped"""
+        resets, demux = self.chip_state.key
+
+        written = self._written_config or {}
+
+        self._written_config = {key: value for key, value in written.items() if key[0] == resets}
+        self._written_config[(resets, demux)] = digests
+
+    def invalidate_asic_config(self) -> None:
+        """Forget the written config, next update_asic() writes unconditionally"""
+        self._written_config = None
+
+    def chip_reset(self) -> None:
+        """Reset chip, config has to be written again"""
+        super().chip_reset()
+        self.invalidate_asic_config()
+
+    def update_asic(self, force: bool = False) -> bool:
+        """Update ASIC
+
+        Skipped if the config did not change since the last update of the chip selected
+        by the demux (register 0x34). Demux flips and chip resets are tracked on the handle,
+        also when written through another Nexysio object.
+        With spi_config enabled, only changed telescope chips are written over SPI,
+        otherwise and on the first or a forced update the full daisy chain is written.
+
+        :param force: Write even if the config is unchanged
+
+        :returns: True if the config was written
+        """
 
         # THIS HAS NOTHING TO DO WITH JUSTINS ASTROPIX LF TST CHIP
         #if self.chipversion == 1:
         #    dummybits = self.gen_asic_pattern(BitArray(uint=0, length=245), True)  # Not needed for v2
         #    self.write(dummybits)
 
-        # Write config
-        asicbits = self.gen_asic_pattern(self.gen_asic_vector(), True)
+        digests = self._config_digests()
+        written = self._written_digests()
+        dirty = [chip for chip, digest in digests.items() if written is None or written.get(chip) != digest]
+
+        if not force and not dirty:
+            logger.info("ASIC config unchanged, update skipped")
+            return False
+
+        if self.spi_config and self.num_chips > 1 and not force and written is not None \
+                and len(dirty) < self.num_chips:
+            for chip in dirty:
+                self.update_asic_chip(chip)
+
+            logger.warning("ASIC update of chips %s complete!", dirty)
+
+            return True
+
+        vector = self.gen_asic_vector()
+
+        # Write config, patterns of earlier configs are replayed from the cache
+        asicbits = self.pattern_cache.get(PatternCache.key(vector, True, ASIC_CLKDIV),
+                                          lambda: self.gen_asic_pattern(vector, True, ASIC_CLKDIV))
 
         for value in asicbits:
             self.write(value)
 
+        self._store_written_digests(digests)
+
         logger.warning("ASIC update complete!")
 
+        return True
+
+    def update_asic_chip(self, chip: int) -> None:
+        """Write config of a single telescope chip over SPI, addressed by chip id
+
+        :param chip: Chip number in telescope setup, used as chip id
+        """
+        data = self.asic_spi_vector(self.gen_asic_chip_vector(chip), True, broadcast=False, chipid=chip)
+
+        self.write_spi(data, False)
+
+        written = self._written_digests()
+
+        if written is not None:
+            written[chip] = self._config_vector(chip).digest()
+
+        logger.info("ASIC chip_%d config written over SPI", chip)
+
     def update_asic_tdacrow(self, row: int) -> None:
         """Write ASIC TDAC ROW
         :param row: Specify row to write tdac config
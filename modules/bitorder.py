@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 10:12:31 2026
+
+Bit order and bit vector helpers shared by readout decoding, pattern generation and SPI writes
+"""
+import numpy as np
+
+
+# Byte value -> byte value with reversed bit order
+BITREVERSE_TABLE = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+BITREVERSE_LUT = np.frombuffer(BITREVERSE_TABLE, dtype=np.uint8)
+
+
+def reverse_bits(data):
+    """
+    Reverse bit order of every byte
+
+    :param data: bytes, bytearray, memoryview or uint8 array
+
+    :returns: Reversed copy, bytes for memoryviews, otherwise same type as data
+    """
+    if isinstance(data, np.ndarray):
+        return BITREVERSE_LUT[data]
+
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+
+    return data.translate(BITREVERSE_TABLE)
+
+
+def reverse_bits_inplace(data) -> None:
+    """
+    Reverse bit order of every byte in place
+
+    :param data: Writable buffer, e.g. bytearray, memoryview or uint8 array
+    """
+    view = np.frombuffer(data, dtype=np.uint8) if not isinstance(data, np.ndarray) else data
+    view[:] = BITREVERSE_LUT[view]
+
+
+def bit_array(value) -> np.ndarray:
+    """
+    Convert bitvector to bool array
+
+    :param value: BitArray, bool/int array, bytes with one bit per byte or iterable of bits
+
+    :returns: Bool array with one element per bit
+    """
+    if hasattr(value, 'tobytes') and hasattr(value, 'len'):
+        # BitArray, unpack the bytes instead of iterating bit by bit
+        return np.unpackbits(np.frombuffer(value.tobytes(), dtype=np.uint8))[:len(value)].astype(bool)
+
+    if isinstance(value, (bytes, bytearray)):
+        return np.frombuffer(value, dtype=np.uint8) == 1
+
+    return np.asarray(value if isinstance(value, np.ndarray) else list(value)) == 1
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 21:40:26 2026
+
+Raw readout capture files with block index and replay
+
+File layout:
+    File header     8 bytes     CAPTURE_MAGIC
+    Block           32 bytes    BLOCK_HEADER: sync, reserved, time, scan_col, scan_row, step, count, nbytes
+                    nbytes      raw SPI readout
+    ...
+
+The index <file>.idx holds one INDEX_DTYPE record per block and is rebuilt from
+the block headers if it is missing or does not match the capture.
+"""
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+import pandas as pd
+
+from modules.decode import Decode
+from modules.hitstore import HitStore
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_MAGIC   = b'APXRAW\x00\x01'
+BLOCK_SYNC      = b'AB'
+BLOCK_HEADER    = struct.Struct('<2sHdiiiiI')
+CONTEXT_FIELDS  = ('scan_col', 'scan_row', 'step', 'count')
+CONTEXT_NONE    = -1
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('time', '<f8'), ('scan_col', '<i4'), ('scan_row', '<i4'),
+                        ('step', '<i4'), ('count', '<i4'), ('nbytes', '<u4')])
+
+
+def index_filename(filename: str) -> str:
+    """Index sidecar of a capture file"""
+    return filename + '.idx'
+
+
+def _context_values(context: dict) -> dict:
+    """Check context fields, None is stored as CONTEXT_NONE"""
+
+    for field in context:
+        if field not in CONTEXT_FIELDS:
+            raise KeyError(f"Unknown capture context field {field}, use one of {CONTEXT_FIELDS}")
+
+    return {field: CONTEXT_NONE if value is None else int(value) for field, value in context.items()}
+
+
+class CaptureWriter:
+    """
+    Write raw readout blocks to a capture file
+
+    Every block is tagged with the current context, e.g. scan pixel and step.
+    The writer is callable, so it can be used as raw sink of a ReadoutStream.
+    """
+
+    def __init__(self, filename: str) -> None:
+        """Init
+
+        :param filename: Capture file, an existing file is overwritten
+        """
+        self._filename = filename
+        self._file = open(filename, 'wb')
+        self._index = open(index_filename(filename), 'wb')
+
+        self._file.write(CAPTURE_MAGIC)
+        self._offset = len(CAPTURE_MAGIC)
+
+        self._context = dict.fromkeys(CONTEXT_FIELDS, CONTEXT_NONE)
+        self._blocks = 0
+        self._bytes = 0
+
+        logger.info("Raw capture to %s", filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __call__(self, data: bytes) -> None:
+        self.write(data)
+
+    @property
+    def filename(self) -> str:
+        """Capture file"""
+        return self._filename
+
+    @property
+    def blocks(self) -> int:
+        """Number of written blocks"""
+        return self._blocks
+
+    @property
+    def bytes_written(self) -> int:
+        """Number of captured readout bytes"""
+        return self._bytes
+
+    @property
+    def context(self) -> dict:
+        """Context of the next blocks"""
+        return dict(self._context)
+
+    def set_context(self, **context) -> None:
+        """
+        Set context of the next blocks, fields not given are kept
+
+        :param context: scan_col, scan_row, step and/or count, None clears a field
+        """
+        self._context.update(_context_values(context))
+
+    def write(self, data: bytes, timestamp: float = None, **context) -> int:
+        """
+        Write one block
+
+        :param data: Raw readout
+        :param timestamp: Block time, default now
+        :param context: Context overriding the current one for this block
+
+        :returns: Block number, None for empty data
+        """
+        if not data:
+            return None
+
+        fields = {**self._context, **_context_values(context)}
+
+        timestamp = time.time() if timestamp is None else timestamp
+        context = [fields[field] for field in CONTEXT_FIELDS]
+
+        self._file.write(BLOCK_HEADER.pack(BLOCK_SYNC, 0, timestamp, *context, len(data)))
+        self._file.write(data)
+
+        self._offset += BLOCK_HEADER.size
+        self._index.write(np.array((self._offset, timestamp, *context, len(data)), dtype=INDEX_DTYPE).tobytes())
+        self._offset += len(data)
+
+        self._blocks += 1
+        self._bytes += len(data)
+
+        return self._blocks - 1
+
+    def flush(self) -> None:
+        """Flush capture and index to disk"""
+        self._file.flush()
+        self._index.flush()
+
+    def close(self) -> None:
+        """Close capture and index"""
+        if self._file.closed:
+            return
+
+        self._file.close()
+        self._index.close()
+
+        logger.info("Raw capture %s closed: %d bytes in %d blocks", self._filename, self._bytes, self._blocks)
+
+
+class CaptureReader:
+    """Seek and replay blocks of a capture file"""
+
+    def __init__(self, filename: str) -> None:
+        """Init
+
+        :param filename: Capture file
+        """
+        self._filename = filename
+        self._file = open(filename, 'rb')
+
+        if self._file.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            self._file.close()
+            raise ValueError(f"{filename} is not a raw capture file")
+
+        self._size = os.path.getsize(filename)
+        self._index = self._load_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self):
+        for block in range(len(self._index)):
+            yield self._index[block], self.read_block(block)
+
+    @property
+    def filename(self) -> str:
+        """Capture file"""
+        return self._filename
+
+    @property
+    def index(self) -> np.ndarray:
+        """Block index, structured array with INDEX_DTYPE"""
+        return self._index
+
+    def _load_index(self) -> np.ndarray:
+        """Load index sidecar, rebuild it if missing or inconsistent"""
+
+        try:
+            index = np.fromfile(index_filename(self._filename), dtype=INDEX_DTYPE)
+        except (OSError, ValueError):
+            index = None
+
+        if index is not None and self._index_valid(index):
+            return index
+
+        logger.warning("Index of %s missing or outdated, rebuilding from block headers", self._filename)
+        return self.rebuild_index()
+
+    def _index_valid(self, index: np.ndarray) -> bool:
+        if not len(index):
+            return self._size == len(CAPTURE_MAGIC)
+
+        end = int(index['offset'][-1]) + int(index['nbytes'][-1])
+
+        return end == self._size and int(index['offset'][0]) == len(CAPTURE_MAGIC) + BLOCK_HEADER.size
+
+    def rebuild_index(self) -> np.ndarray:
+        """
+        Rebuild index by walking the block headers and write it to the sidecar
+
+        A truncated last block, e.g. after a crash, is not indexed.
+
+        :returns: Block index
+        """
+        records = []
+        offset = len(CAPTURE_MAGIC)
+
+        while offset + BLOCK_HEADER.size <= self._size:
+            self._file.seek(offset)
+            sync, _, timestamp, *context, nbytes = BLOCK_HEADER.unpack(self._file.read(BLOCK_HEADER.size))
+
+            if sync != BLOCK_SYNC:
+                logger.error("Corrupt block header at offset %d in %s", offset, self._filename)
+                break
+
+            offset += BLOCK_HEADER.size
+            if offset + nbytes > self._size:
+                logger.warning("Truncated block at offset %d in %s", offset, self._filename)
+                break
+
+            records.append((offset, timestamp, *context, nbytes))
+            offset += nbytes
+
+        index = np.array(records, dtype=INDEX_DTYPE)
+        index.tofile(index_filename(self._filename))
+
+        return index
+
+    def select(self, **context) -> np.ndarray:
+        """
+        Block numbers matching context
+
+        :param context: scan_col, scan_row, step and/or count
+
+        :returns: Array of block numbers in file order
+        """
+        mask = np.ones(len(self._index), dtype=bool)
+
+        for field, value in _context_values(context).items():
+            mask &= self._index[field] == value
+
+        return np.flatnonzero(mask)
+
+    def read_block(self, block: int) -> bytes:
+        """
+        Read raw readout of one block
+
+        :param block: Block number
+
+        :returns: Raw readout
+        """
+        record = self._index[block]
+
+        self._file.seek(int(record['offset']))
+        return self._file.read(int(record['nbytes']))
+
+    def index_frame(self) -> pd.DataFrame:
+        """Block index as DataFrame"""
+        return pd.DataFrame(self._index)
+
+    def replay(self, decode: Decode = None, decoder: str = 'astropix2', blocks=None, **context) -> pd.DataFrame:
+        """
+        Decode captured blocks
+
+        Consecutive blocks with the same context are decoded as one stream,
+        hits straddling two of them are completed.
+
+        :param decode: Decode instance, default 5 bytes per hit
+        :param decoder: 'astropix2' or 'astropix4'
+        :param blocks: Block numbers to replay, default all blocks matching context
+        :param context: scan_col, scan_row, step and/or count
+
+        :returns: DataFrame with decoded hits and block, time and context columns
+        """
+        decode = decode if decode is not None else Decode()
+
+        if decoder == 'astropix4':
+            decode_columns = decode.decode_astropix4_columns
+        else:
+            decode_columns = decode.decode_astropix2_columns
+
+        if blocks is None:
+            blocks = self.select(**context)
+
+        store = HitStore(['block', 'time', *CONTEXT_FIELDS, *decode_columns([])])
+
+        carry = b''
+        previous = None
+
+        for block in blocks:
+            record = self._index[block]
+            key = tuple(int(record[field]) for field in CONTEXT_FIELDS)
+
+            # Incomplete hit at the end of a context is dropped, as in the online decoding
+            if key != previous:
+                carry = b''
+                previous = key
+
+            stream = carry + self.read_block(block)
+
+            hits, consumed = decode.split_readoutstream(stream)
+            carry = stream[consumed:]
+
+            store.append(decode_columns(hits), block=block, time=record['time'],
+                         **dict(zip(CONTEXT_FIELDS, key)))
+
+        return store.to_dataframe()
+
+    def close(self) -> None:
+        """Close capture file"""
+        self._file.close()
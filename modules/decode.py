@@ -5,16 +5,31 @@ Created on Tue Dec 28 19:03:40 2021
 
 @author: Nicolas Striebig
 """
+import mmap
+import os
+from contextlib import contextmanager
+
+import numpy as np
 import pandas as pd
 
 import logging
+from modules.bitorder import BITREVERSE_LUT, BITREVERSE_TABLE, reverse_bits
+from modules.hitstore import HitStore
 from modules.setup_logger import logger
 
 
 logger = logging.getLogger(__name__)
 
+# Gray codes up to this width are decoded by table lookup (covers AstroPix4 ts << 3 | tsfine)
+GRAY_LUT_BITS = 17
+
+# Bytes of a mapped readout stream searched for hits at once
+DECODE_WINDOW_SIZE = 1 << 24
+
 
 class Decode:
+    _gray_lut = None
+
     def __init__(self, sampleclock_period_ns: int = 5, nchips: int = 1, bytesperhit: int = 5):
         self._sampleclock_period_ns = sampleclock_period_ns
         self._bytesperhit = bytesperhit
@@ -23,6 +38,8 @@ class Decode:
 
         self._header = set()
         self._header_rev = set()
+        self._header_lut = np.zeros(256, dtype=bool)
+        self._header_rev_lut = np.zeros(256, dtype=bool)
         self._gen_header()
 
     def _gen_header(self):
@@ -37,9 +54,16 @@ class Decode:
             id = (i << self._idbits) + self._bytesperhit - 1
             self._header.add(id)
 
-            id_rev = int(f'{id:08b}'[::-1], 2)
+            id_rev = BITREVERSE_TABLE[id]
             self._header_rev.add(id_rev)
 
+        # Lookup tables for vectorized header search
+        self._header_lut = np.zeros(256, dtype=bool)
+        self._header_lut[list(self._header)] = True
+
+        self._header_rev_lut = np.zeros(256, dtype=bool)
+        self._header_rev_lut[list(self._header_rev)] = True
+
     def gray_to_dec(self, gray: int) -> int:
         """
         Decode Gray code to decimal
@@ -54,49 +78,344 @@ class Decode:
             bits >>= 1
         return gray
 
+    @staticmethod
+    def _gray_prefix_xor(gray: np.ndarray, nbits: int) -> np.ndarray:
+        """
+        Decode Gray codes with a log-step prefix XOR
+
+        :param gray: Array with Gray codes
+        :param nbits: Width of the Gray codes
+
+        :returns: Array with decoded decimals
+        """
+        decoded = gray.copy()
+        shift = 1
+        while shift < nbits:
+            decoded ^= decoded >> shift
+            shift <<= 1
+
+        return decoded
+
+    @classmethod
+    def _gen_gray_lut(cls) -> np.ndarray:
+        """
+        Pregenerate Gray decoding table for GRAY_LUT_BITS wide codes, shared by all instances
+        """
+        if cls._gray_lut is None:
+            cls._gray_lut = cls._gray_prefix_xor(np.arange(1 << GRAY_LUT_BITS, dtype=np.int64), GRAY_LUT_BITS)
+
+        return cls._gray_lut
+
+    @classmethod
+    def gray_to_dec_array(cls, gray: np.ndarray, nbits: int = None) -> np.ndarray:
+        """
+        Decode array of Gray codes to decimal
+
+        Codes up to GRAY_LUT_BITS are looked up in a precomputed table,
+        wider codes are decoded with a log-step prefix XOR.
+
+        :param gray: Array with Gray codes
+        :param nbits: Width of the Gray codes, defaults to the full width of the dtype
+
+        :returns: Array with decoded decimals
+        """
+        gray = np.asarray(gray)
+
+        if nbits is None:
+            if gray.dtype == object:
+                nbits = max((int(value).bit_length() for value in gray.flat), default=0)
+            else:
+                nbits = gray.dtype.itemsize * 8
+
+        if nbits <= GRAY_LUT_BITS and gray.dtype.kind in 'iu':
+            return cls._gen_gray_lut()[gray].astype(gray.dtype, copy=False)
+
+        return cls._gray_prefix_xor(gray, nbits)
+
     def reverse_bitorder(self, data: bytearray) -> bytearray:
-        reversed_data = bytearray()
+        """
+        Reverse bitorder of every byte
+
+        :param data: Bytes to reverse
+
+        :returns: Reversed copy
+        """
+        return reverse_bits(data if isinstance(data, bytearray) else bytearray(data))
+
+    def _find_hit_offsets(self, stream: np.ndarray, reverse_bitorder: bool = True) -> tuple:
+        """
+        Find start offsets of hits in a uint8 readout stream
+
+        Header candidates are resolved in the same greedy order as a byte-by-byte scan:
+        a header is taken if it lies behind the end of the previously taken hit.
+        Only runs of overlapping candidates need to be walked in Python.
 
-        for item in data:
-            item_rev = int(bin(item)[2:].zfill(8)[::-1], 2)
-            reversed_data.append(item_rev)
+        :param stream: Readout stream as uint8 array
+        :param reverse_bitorder: Search for bitreversed header
 
-        return reversed_data
+        :returns: Tuple with array of hit offsets and offset where the scan stopped
+        """
+
+        header_lut = self._header_rev_lut if reverse_bitorder else self._header_lut
+        bytesperhit = self._bytesperhit
+        length = len(stream)
+
+        candidates = np.flatnonzero(header_lut[stream])
+
+        # Headers without enough bytes left cannot start a complete hit
+        n_complete = int(np.searchsorted(candidates, length - bytesperhit, side='right'))
+        tail = candidates[n_complete:]
+        candidates = candidates[:n_complete]
 
-    def hits_from_readoutstream(self, readout: bytearray, reverse_bitorder: bool = True) -> list:
+        # Consecutive candidates closer than one hit overlap, drop the ones inside a taken hit
+        overlapping = np.flatnonzero(np.diff(candidates) < bytesperhit) + 1
+
+        if len(overlapping):
+            keep = np.ones(len(candidates), dtype=bool)
+            positions = candidates.tolist()
+            last_end = 0
+            prev = -1
+
+            for k in overlapping.tolist():
+                # Predecessor does not overlap with its own predecessor, so it was taken
+                if k - 1 != prev:
+                    last_end = positions[k - 1] + bytesperhit
+
+                if positions[k] >= last_end:
+                    last_end = positions[k] + bytesperhit
+                else:
+                    keep[k] = False
+
+                prev = k
+
+            candidates = candidates[keep]
+
+        # Scan stops at the first incomplete header behind the last hit
+        last_end = int(candidates[-1]) + bytesperhit if len(candidates) else 0
+        tail = tail[tail >= last_end]
+        stop = int(tail[0]) if len(tail) else length
+
+        return candidates, stop
+
+    def split_readoutstream(self, readout: bytearray, reverse_bitorder: bool = True) -> tuple:
+        """
+        Find hits in readoutstream and report how far the stream was consumed
+
+        Bytes behind the consumed offset start with a header of an incomplete hit
+        and have to be prepended to the next readout.
+
+        :param readout: Readout stream
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: Tuple with hit array (N, bytesperhit) and number of consumed bytes
+        """
+
+        stream = np.frombuffer(readout, dtype=np.uint8)
+
+        offsets, consumed = self._find_hit_offsets(stream, reverse_bitorder)
+
+        hits = stream[offsets[:, np.newaxis] + np.arange(self._bytesperhit)]
+
+        if reverse_bitorder:
+            hits = BITREVERSE_LUT[hits]
+
+        return hits, consumed
+
+    def hits_from_readoutstream(self, readout: bytearray, reverse_bitorder: bool = True) -> np.ndarray:
         """
         Find hits in readoutstream
 
         :param readout: Readout stream
         :param reverse_bitorder: Reverse Bitorder per byte
 
-        :returns: Position of hits in the datastream
+        :returns: Array with shape (N, bytesperhit), one hit per row
         """
 
-        length = len(readout)
-        hitlist = []
-        i = 0
+        hits, _ = self.split_readoutstream(readout, reverse_bitorder)
 
-        header = self._header_rev if reverse_bitorder else self._header
-        bytesperhit = self._bytesperhit
+        return hits
 
-        while i < length:
-            if readout[i] not in header:
-                i += 1
-            else:
-                if i + bytesperhit <= length:
-                    if reverse_bitorder:
-                        hitlist.append(self.reverse_bitorder(readout[i:i + bytesperhit]))
-                    else:
-                        hitlist.append(readout[i:i + bytesperhit])
+    @staticmethod
+    @contextmanager
+    def _open_buffer(source):
+        """
+        Map a readout file read-only, other sources are used as they are
 
-                    i += bytesperhit
-                else:
+        :param source: Path, mmap, memoryview or bytes-like
+
+        :returns: Tuple with buffer and the mmap owned by this call or None
+        """
+        if not isinstance(source, (str, os.PathLike)):
+            yield source, None
+            return
+
+        with open(source, 'rb') as file:
+            # Empty files cannot be mapped
+            if not os.fstat(file.fileno()).st_size:
+                yield b'', None
+                return
+
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            try:
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+                yield mapped, mapped
+            except BaseException:
+                Decode._close_buffer(mapped, quiet=True)
+                raise
+
+            Decode._close_buffer(mapped)
+
+    @staticmethod
+    def _close_buffer(handle, quiet: bool = False) -> None:
+        """
+        Close an mmap or SharedMemory
+
+        :param handle: mmap or SharedMemory
+        :param quiet: Leave the buffer to the garbage collector if views of it still exist,
+                      e.g. in the traceback of an error that is being raised
+        """
+        try:
+            handle.close()
+        except BufferError:
+            if not quiet:
+                raise
+
+            logger.debug("Buffer still has views, not closed")
+
+    @staticmethod
+    def _release_pages(mapped: mmap.mmap, start: int, end: int) -> None:
+        """Drop mapped pages in [start, end) so the resident size stays bounded"""
+
+        if not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+
+        start -= start % mmap.PAGESIZE
+        end -= end % mmap.PAGESIZE
+
+        if end > start:
+            mapped.madvise(mmap.MADV_DONTNEED, start, end - start)
+
+    def iter_hits_windowed(self, source, window_size: int = DECODE_WINDOW_SIZE,
+                           reverse_bitorder: bool = True):
+        """
+        Find hits in a readout stream window by window without copying the stream
+
+        Each window starts where the previous one stopped, so hits straddling
+        a window boundary are found in the next window. Hits are the same as
+        hits_from_readoutstream() finds in the whole stream.
+
+        :param source: Path of a raw readout file, mmap, memoryview or bytes-like
+        :param window_size: Bytes searched at once
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: Generator of hit arrays with shape (N, bytesperhit)
+        """
+        if window_size < self._bytesperhit:
+            raise ValueError(f"Window size must be at least {self._bytesperhit} bytes")
+
+        with self._open_buffer(source) as (buffer, mapped):
+            with memoryview(buffer) as view:
+                length = view.nbytes
+
+            start = 0
+            while start < length:
+                count = min(window_size, length - start)
+
+                stream = np.frombuffer(buffer, dtype=np.uint8, count=count, offset=start)
+                offsets, consumed = self._find_hit_offsets(stream, reverse_bitorder)
+
+                # Fancy indexing copies, the window view can be dropped before the map is closed
+                hits = stream[offsets[:, np.newaxis] + np.arange(self._bytesperhit)]
+                del stream
+
+                if reverse_bitorder:
+                    hits = BITREVERSE_LUT[hits]
+
+                if mapped is not None:
+                    self._release_pages(mapped, start, start + consumed)
+
+                yield hits
+
+                if start + count == length:
                     break
 
-        return hitlist
+                start += consumed
 
-    def decode_astropix2_hits(self, list_hits: list) -> pd.DataFrame:
+    def decode_windowed(self, source, decoder: str = 'astropix2', window_size: int = DECODE_WINDOW_SIZE,
+                        sink=None, reverse_bitorder: bool = True) -> pd.DataFrame:
+        """
+        Decode a raw readout file or buffer window by window
+
+        Memory use is bounded by the window size when the decoded hits go to a sink.
+
+        :param source: Path of a raw readout file, mmap, memoryview or bytes-like
+        :param decoder: 'astropix2' or 'astropix4'
+        :param window_size: Bytes decoded at once
+        :param sink: Callable getting a dict of column arrays per window, e.g. a HitStore
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: Dataframe with decoded hits, None if a sink was given
+        """
+        if decoder == 'astropix4':
+            decode_columns = self.decode_astropix4_columns
+        else:
+            decode_columns = self.decode_astropix2_columns
+
+        store = HitStore(list(decode_columns([]))) if sink is None else sink
+
+        for hits in self.iter_hits_windowed(source, window_size, reverse_bitorder):
+            store(decode_columns(hits))
+
+        return store.to_dataframe() if sink is None else None
+
+    def hit_array(self, list_hits) -> np.ndarray:
+        """
+        Convert hits to a uint8 array with one hit per row
+
+        Hits with a length other than bytesperhit are dropped.
+
+        :param list_hits: Array (N, bytesperhit) or list of bytearrays
+
+        :returns: Array with shape (N, bytesperhit)
+        """
+
+        if isinstance(list_hits, np.ndarray):
+            if list_hits.ndim != 2 or list_hits.shape[1] != self._bytesperhit:
+                return np.empty((0, self._bytesperhit), dtype=np.uint8)
+
+            return list_hits.astype(np.uint8, copy=False)
+
+        data = b''.join(bytes(hit) for hit in list_hits if len(hit) == self._bytesperhit)
+
+        return np.frombuffer(data, dtype=np.uint8).reshape(-1, self._bytesperhit)
+
+    def decode_astropix2_columns(self, list_hits) -> dict:
+        """
+        Decode 5byte Frames from AstroPix 2 column-wise
+
+        :param list_hits: Array (N, bytesperhit) or list with all hits
+
+        :returns: Dict with one int64 array per field
+        """
+
+        hits = self.hit_array(list_hits)
+
+        header   = hits[:, 0]
+        location = hits[:, 1]
+
+        return {
+            'id': (header >> 3).astype(np.int64),
+            'payload': (header & 0b111).astype(np.int64),
+            'location': (location & 0b111111).astype(np.int64),
+            'col': (location >> 7 & 1).astype(np.int64),
+            'timestamp': hits[:, 2].astype(np.int64),
+            'tot_total': ((hits[:, 3] & 0b1111).astype(np.int64) << 8) + hits[:, 4],
+        }
+
+    def decode_astropix2_hits(self, list_hits, log_hits: bool = False) -> pd.DataFrame:
         """
         Decode 5byte Frames from AstroPix 2
 
@@ -110,68 +429,76 @@ class Decode:
                                     3-0: ToT MSB
         Byte 4: ToT LSB
 
-        :param list_hists: List with all hits
+        :param list_hists: Array (N, bytesperhit) or list with all hits
+        :param log_hits: Log every decoded hit
 
         :returns: Dataframe with decoded hits
         """
 
-        hit_pd = []
+        columns = self.decode_astropix2_columns(list_hits)
 
-        for hit in list_hits:
-            if len(hit) == self._bytesperhit:
-                header, location, timestamp, tot_msb, tot_lsb = hit
-
-                id          = header >> 3
-                payload     = header & 0b111
-                col         = location >> 7 & 1
-                location   &= 0b111111
-                timestamp   = timestamp
-                tot_msb    &= 0b1111
-                tot_total   = (tot_msb << 8) + tot_lsb
-
-                hit_pd.append([id, payload, location, col, timestamp, tot_total])
+        if log_hits:
+            for id, payload, location, col, timestamp, tot_total in zip(*(c.tolist() for c in columns.values())):
                 logger.info(
                     "Header: ChipId: %d\tPayload: %d\n"
                     "Location: %d\tRow/Col: %d\n"
                     "Timestamp: %d\n"
                     "ToT: MSB: %d\tLSB: %d Total: %d (%d us)",
-                    id, payload, location, col, timestamp, tot_msb, tot_lsb, tot_total,
+                    id, payload, location, col, timestamp, tot_total >> 8, tot_total & 0xFF, tot_total,
                     (tot_total * self._sampleclock_period_ns) / 1000.0
                 )
 
-        return pd.DataFrame(hit_pd, columns=['id', 'payload', 'location', 'col', 'timestamp', 'tot_total'])
+        return pd.DataFrame(columns)
 
-    def decode_astropix4_hits(self, list_hits: list) -> pd.DataFrame:
+    def decode_astropix4_columns(self, list_hits) -> dict:
         """
-        Decode 8byte Frames from AstroPix 4
+        Decode 8byte Frames from AstroPix 4 column-wise
 
-        :param list_hists: List with all hits
+        :param list_hits: Array (N, bytesperhit) or list with all hits
 
-        :returns: Dataframe with decoded hits
+        :returns: Dict with one int64 array per field
         """
 
-        hit_pd = []
+        hits = self.hit_array(list_hits).astype(np.int64)
+
+        header, byte1, byte2, byte3, byte4, byte5, byte6, byte7 = hits.T
+
+        ts1     = ((byte2 & 0b11111) << 9) + (byte3 << 1) + (byte4 >> 7)
+        tsfine1 = (byte4 >> 4) & 0b111
+        ts2     = ((byte5 & 0b111111) << 8) + byte6
+        tsfine2 = (byte7 >> 5) & 0b111
+
+        return {
+            'id': header >> 3,
+            'payload': header & 0b111,
+            'row': byte1 >> 3,
+            'col': ((byte1 & 0b111) << 2) + (byte2 >> 6),
+            'ts1': ts1,
+            'tsfine1': tsfine1,
+            'ts2': ts2,
+            'tsfine2': tsfine2,
+            'tsneg1': (byte2 >> 5) & 0b1,
+            'tsneg2': (byte5 >> 6) & 0b1,
+            'tstdc1': ((byte4 & 0b1111) << 1) + (byte5 >> 7),
+            'tstdc2': byte7 & 0b11111,
+            'ts_dec1': self.gray_to_dec_array((ts1 << 3) + tsfine1, GRAY_LUT_BITS),
+            'ts_dec2': self.gray_to_dec_array((ts2 << 3) + tsfine2, GRAY_LUT_BITS),
+        }
+
+    def decode_astropix4_hits(self, list_hits, log_hits: bool = False) -> pd.DataFrame:
+        """
+        Decode 8byte Frames from AstroPix 4
 
-        for hit in list_hits:
-            if len(hit) == self._bytesperhit:
-                header, byte1, byte2, byte3, byte4, byte5, byte6, byte7 = hit
+        :param list_hists: Array (N, bytesperhit) or list with all hits
+        :param log_hits: Log every decoded hit
 
-                id          = header >> 3
-                payload     = header & 0b111
-                row         = byte1 >> 3
-                col         = ((byte1 & 0b111) << 2) + (byte2 >> 6)
+        :returns: Dataframe with decoded hits
+        """
 
-                tsneg1      = (byte2 >> 5) & 0b1
-                ts1         = ((byte2 & 0b11111) << 9) + (byte3 << 1) + (byte4 >> 7)
-                tsfine1     = (byte4 >> 4) & 0b111
-                tstdc1      = ((byte4 & 0b1111) << 1) + (byte5 >> 7)
+        hit_pd = pd.DataFrame(self.decode_astropix4_columns(list_hits))
 
-                tsneg2      = (byte5 >> 6) & 0b1
-                ts2         = ((byte5 & 0b111111) << 8) + byte6
-                tsfine2     = (byte7 >> 5) & 0b111
-                tstdc2      = byte7 & 0b11111
+        if log_hits:
+            for hit in hit_pd.itertuples(index=False):
+                logger.info("Hit: %s", hit)
 
-                hit_pd.append([id, payload, row, col, ts1, tsfine1, ts2, tsfine2, tsneg1, tsneg2, tstdc1, tstdc2,
-                               self.gray_to_dec((ts1 << 3) + tsfine1), self.gray_to_dec((ts2 << 3) + tsfine2)])
-        return pd.DataFrame(hit_pd, columns=['id', 'payload', 'row', 'col', 'ts1', 'tsfine1', 'ts2',
-                                             'tsfine2', 'tsneg1', 'tsneg2', 'tstdc1', 'tstdc2', 'ts_dec1', 'ts_dec2'])
+        return hit_pd
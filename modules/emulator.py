@@ -0,0 +1,568 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 13:40:52 2026
+
+Software model of the Nexys FPGA behind the FTDI handle
+
+Drop-in replacement for the ftd2xx device handle, so Nexysio, Asic, Voltageboard,
+Injectionboard and Scan run without hardware, e.g. for benchmarks and regression checks.
+"""
+import logging
+import threading
+import time
+
+import numpy as np
+
+from modules.bitorder import BITREVERSE_LUT
+from modules.injectionboard import PG_RESET, PG_SUSPEND, PG_WRITE, PG_ADDRESS, PG_DATA, PATGEN_CLOCK_HZ
+from modules.nexysio import (READ_ADRESS, WRITE_ADRESS, SR_ASIC_ADRESS, SIN_ASIC, LD_ASIC, LD_TDAC_ASIC,
+                             SIN_GECCO, LD_GECCO, DEMUX_ADRESS, NEXYS_USB_DESC, NEXYS_USB_SER)
+from modules.spi import (SPI_CONFIG_REG, SPI_CLKDIV_REG, SPI_WRITE_REG, SPI_READ_REG, SPI_READBACK_REG,
+                         SPI_WRITE_FIFO_RESET, SPI_WRITE_FIFO_EMPTY, SPI_WRITE_FIFO_FULL,
+                         SPI_READ_FIFO_RESET, SPI_READ_FIFO_EMPTY, SPI_READ_FIFO_FULL, SPI_MODULE_RESET,
+                         SPI_WRITE_FIFO_SIZE)
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+GECCO_ADRESS    = 12
+
+SYSCLK_HZ       = 100e6     # SPI clock = SYSCLK_HZ / spi_clkdiv
+
+
+class HitGenerator:
+    """Generate valid AstroPix2/AstroPix4 frames"""
+
+    def __init__(self, chipversion: int = 2, nchips: int = 1, rate: float = 0.0,
+                 pixel: tuple = None, num_cols: int = 35, num_rows: int = 35,
+                 reverse_bitorder: bool = True, seed: int = None) -> None:
+        """Init
+
+        :param chipversion: 2 for 5 byte frames, 4 for 8 byte frames
+        :param nchips: Number of chips in the daisy chain, hits get random chip ids
+        :param rate: Rate of random noise hits in Hz
+        :param pixel: (col, row) of injected hits, random pixel if None
+        :param num_cols: Number of columns for random pixels
+        :param num_rows: Number of rows for random pixels
+        :param reverse_bitorder: Send frames LSB first like the chip
+        :param seed: Random seed
+        """
+        self.chipversion = chipversion
+        self.nchips = nchips
+        self.rate = rate
+        self.pixel = pixel
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+        self.reverse_bitorder = reverse_bitorder
+
+        self.generated = 0
+
+        self._rng = np.random.default_rng(seed)
+
+    @property
+    def bytesperhit(self) -> int:
+        """Frame length"""
+        return 8 if self.chipversion == 4 else 5
+
+    def frames(self, num: int, pixel: tuple = None) -> bytes:
+        """
+        Generate frames for num hits
+
+        AstroPix2 sends one row and one col frame per hit, AstroPix4 one frame.
+
+        :param num: Number of hits
+        :param pixel: (col, row), overrides the generator pixel
+
+        :returns: Concatenated frames
+        """
+        if num <= 0:
+            return b''
+
+        pixel = pixel if pixel is not None else self.pixel
+        rng = self._rng
+
+        if pixel is None:
+            col = rng.integers(0, self.num_cols, num)
+            row = rng.integers(0, self.num_rows, num)
+        else:
+            col = np.full(num, pixel[0])
+            row = np.full(num, pixel[1])
+
+        chip = rng.integers(0, self.nchips, num)
+        header = (chip << 3) | (self.bytesperhit - 1)
+
+        if self.chipversion == 4:
+            frames = self._astropix4_frames(header, col, row)
+        else:
+            frames = self._astropix2_frames(header, col, row)
+
+        if self.reverse_bitorder:
+            frames = BITREVERSE_LUT[frames]
+
+        self.generated += num
+
+        return frames.tobytes()
+
+    def _astropix2_frames(self, header, col, row) -> np.ndarray:
+        num = len(header)
+        rng = self._rng
+
+        timestamp = rng.integers(0, 256, num)
+        tot = rng.integers(0, 1 << 12, num)
+
+        frames = np.empty((num, 2, 5), dtype=np.uint8)
+
+        for index, (flag, location) in enumerate(((0, row), (1, col))):
+            frames[:, index, 0] = header
+            frames[:, index, 1] = (flag << 7) | (location & 0b111111)
+            frames[:, index, 2] = timestamp
+            frames[:, index, 3] = tot >> 8
+            frames[:, index, 4] = tot & 0xFF
+
+        return frames.reshape(-1, 5)
+
+    def _astropix4_frames(self, header, col, row) -> np.ndarray:
+        num = len(header)
+        rng = self._rng
+
+        # Gray coded 17 bit timestamps: ts << 3 | tsfine
+        t1 = rng.integers(0, 1 << 17, num)
+        t2 = (t1 + rng.integers(0, 1 << 10, num)) & ((1 << 17) - 1)
+        g1 = t1 ^ (t1 >> 1)
+        g2 = t2 ^ (t2 >> 1)
+
+        ts1, tsfine1 = g1 >> 3, g1 & 0b111
+        ts2, tsfine2 = g2 >> 3, g2 & 0b111
+
+        tstdc1 = rng.integers(0, 32, num)
+        tstdc2 = rng.integers(0, 32, num)
+        tsneg1 = rng.integers(0, 2, num)
+        tsneg2 = rng.integers(0, 2, num)
+
+        frames = np.empty((num, 8), dtype=np.uint8)
+        frames[:, 0] = header
+        frames[:, 1] = ((row & 0b11111) << 3) | ((col >> 2) & 0b111)
+        frames[:, 2] = ((col & 0b11) << 6) | (tsneg1 << 5) | ((ts1 >> 9) & 0b11111)
+        frames[:, 3] = (ts1 >> 1) & 0xFF
+        frames[:, 4] = ((ts1 & 1) << 7) | (tsfine1 << 4) | (tstdc1 >> 1)
+        frames[:, 5] = ((tstdc1 & 1) << 7) | (tsneg2 << 6) | ((ts2 >> 8) & 0b111111)
+        frames[:, 6] = ts2 & 0xFF
+        frames[:, 7] = (tsfine2 << 5) | tstdc2
+
+        return frames
+
+
+class ShiftRegisterModel:
+    """
+    Bit-banged shift register
+
+    SIN is sampled on rising clock edges, a rising load edge latches the bits
+    shifted in since the previous load. Loads after fewer than min_bits clocks
+    (e.g. the trailing clocks of the GECCO pattern) keep the previous vector.
+    """
+
+    def __init__(self, sin: int, clk: int, load: int, min_bits: int = 1) -> None:
+        self._sin = sin
+        self._clk = clk
+        self._load = load
+        self._min_bits = min_bits
+
+        self._prev = 0
+        self._bits = []
+
+        self.vector = np.empty(0, dtype=np.uint8)
+        self.loads = 0
+
+    def feed(self, data) -> None:
+        """
+        Apply pattern bytes
+
+        :param data: Pattern bytes
+        """
+        pattern = np.frombuffer(data, dtype=np.uint8)
+
+        if not len(pattern):
+            return
+
+        prev = np.empty_like(pattern)
+        prev[0] = self._prev
+        prev[1:] = pattern[:-1]
+        self._prev = int(pattern[-1])
+
+        clk_edges = np.flatnonzero((pattern & self._clk != 0) & (prev & self._clk == 0))
+        load_edges = np.flatnonzero((pattern & self._load != 0) & (prev & self._load == 0))
+
+        bits = (pattern[clk_edges] & self._sin != 0).astype(np.uint8)
+
+        start = 0
+        for edge in load_edges:
+            stop = int(np.searchsorted(clk_edges, edge))
+            self._bits.append(bits[start:stop])
+            self._latch()
+            start = stop
+
+        self._bits.append(bits[start:])
+
+    def _latch(self) -> None:
+        bits = np.concatenate(self._bits) if self._bits else np.empty(0, dtype=np.uint8)
+        self._bits = []
+
+        if len(bits) >= self._min_bits:
+            self.vector = bits
+            self.loads += 1
+
+
+class NexysEmulator:
+    """
+    Software model of the Nexys FTDI handle
+
+    Implements the ftd2xx handle methods used by Nexysio and models the FPGA register map:
+    SPI config/clkdiv/write/read (0x15-0x18), SR readback (0x3C/0x3D), chip demux (0x34),
+    pattern generator (2-7), ASIC SR (0) and GECCO SR (12).
+    USB latency and bandwidth can be emulated to measure round-trip costs.
+    """
+
+    def __init__(self, hitgen: HitGenerator = None, latency: float = 0.0, bandwidth: float = None,
+                 read_fifo_size: int = 1 << 17, write_fifo_size: int = SPI_WRITE_FIFO_SIZE + 1,
+                 hits_per_pulse: int = 1, autoread: bool = True, idle_byte: int = 0xFF,
+                 patgen_clock_hz: float = PATGEN_CLOCK_HZ) -> None:
+        """Init
+
+        :param hitgen: Hit generator feeding the chip output, default AstroPix2 without noise
+        :param latency: Delay per FTDI read/write call in s
+        :param bandwidth: USB bandwidth in bytes/s, None for unlimited
+        :param read_fifo_size: Depth of the SPI read FIFO
+        :param write_fifo_size: Depth of the SPI write FIFO
+        :param hits_per_pulse: Hits generated per injection pulse
+        :param autoread: FPGA reads pending chip data without SPI writes from the host
+        :param idle_byte: MISO idle byte and read padding
+        :param patgen_clock_hz: Pattern generator clock before clkdiv in Hz
+        """
+        self.hitgen = hitgen if hitgen is not None else HitGenerator()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.read_fifo_size = read_fifo_size
+        self.write_fifo_size = write_fifo_size
+        self.hits_per_pulse = hits_per_pulse
+        self.autoread = autoread
+        self.idle_byte = idle_byte
+        self.patgen_clock_hz = patgen_clock_hz
+
+        self.registers = bytearray(256)
+        self.registers[SPI_CONFIG_REG] = SPI_MODULE_RESET
+        self.registers[SPI_CLKDIV_REG] = 16
+
+        self.patgen = bytearray(16)
+
+        # ASIC SR per demux position
+        self.asic_sr = {}
+        self.tdac_sr = {}
+        self.gecco_sr = ShiftRegisterModel(SIN_GECCO, 0x01, LD_GECCO, min_bits=16)
+
+        self.stats = {'writes': 0, 'reads': 0, 'bytes_written': 0, 'bytes_read': 0,
+                      'commands': 0, 'read_fifo_overflows': 0, 'write_fifo_overflows': 0}
+
+        self._commands = bytearray()
+        self._answer = bytearray()
+
+        self._write_fifo = 0            # bytes waiting to be shifted out
+        self._read_fifo = bytearray()
+        self._chip_output = bytearray()
+
+        self._last_update = time.monotonic()
+        self._spi_budget = 0.0
+        self._noise_budget = 0.0
+
+        self._pg_running = False
+        self._pg_start = 0.0
+        self._pg_pulses_done = 0
+
+        self._lock = threading.RLock()
+
+    # ftd2xx handle interface
+
+    def getDeviceInfo(self) -> dict:
+        return {'type': 6, 'id': 0, 'description': NEXYS_USB_DESC, 'serial': NEXYS_USB_SER + b'EMU'}
+
+    def setTimeouts(self, read: int, write: int) -> None:
+        pass
+
+    def setBitMode(self, mask: int, enable: int) -> None:
+        pass
+
+    def setLatencyTimer(self, latency: int) -> None:
+        pass
+
+    def setUSBParameters(self, in_size: int, out_size: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def write(self, data: bytes) -> int:
+        """Host to FPGA"""
+
+        self._usb_delay(len(data))
+
+        with self._lock:
+            self.stats['writes'] += 1
+            self.stats['bytes_written'] += len(data)
+
+            self._update()
+
+            self._commands.extend(data)
+            self._process_commands()
+
+        return len(data)
+
+    def read(self, num: int) -> bytes:
+        """FPGA to host"""
+
+        self._usb_delay(num)
+
+        with self._lock:
+            self.stats['reads'] += 1
+
+            if len(self._answer) < num:
+                logger.warning("Emulator: read of %d bytes, only %d available", num, len(self._answer))
+
+            data = bytes(self._answer[:num])
+            del self._answer[:num]
+
+            self.stats['bytes_read'] += len(data)
+
+        return data
+
+    # Emulated FPGA
+
+    @property
+    def spi_rate(self) -> float:
+        """SPI bytes per second"""
+        return SYSCLK_HZ / max(self.registers[SPI_CLKDIV_REG], 1) / 8
+
+    @property
+    def asic_vector(self) -> np.ndarray:
+        """Bits latched in the ASIC SR of the selected demux position"""
+        return self._asic_sr(self.registers[DEMUX_ADRESS]).vector
+
+    @property
+    def gecco_vector(self) -> np.ndarray:
+        """Bits latched in the GECCO SR"""
+        return self.gecco_sr.vector
+
+    def inject(self, num: int, pixel: tuple = None) -> None:
+        """
+        Queue hits at the chip output
+
+        :param num: Number of hits
+        :param pixel: (col, row)
+        """
+        with self._lock:
+            self._chip_output.extend(self.hitgen.frames(num, pixel))
+
+    def _usb_delay(self, num: int) -> None:
+        delay = self.latency
+
+        if self.bandwidth:
+            delay += num / self.bandwidth
+
+        if delay > 0:
+            time.sleep(delay)
+
+    def _asic_sr(self, demux: int) -> ShiftRegisterModel:
+        if demux not in self.asic_sr:
+            self.asic_sr[demux] = ShiftRegisterModel(SIN_ASIC, 0x01, LD_ASIC)
+            self.tdac_sr[demux] = ShiftRegisterModel(SIN_ASIC, 0x01, LD_TDAC_ASIC)
+
+        return self.asic_sr[demux]
+
+    def _process_commands(self) -> None:
+        """Execute all complete commands in the command buffer"""
+
+        commands = self._commands
+        view = memoryview(commands)
+        index = 0
+
+        while len(commands) - index >= 4:
+            mode, register, hbyte, lbyte = commands[index:index + 4]
+            length = (hbyte << 8) | lbyte
+
+            if mode == WRITE_ADRESS:
+                if len(commands) - index < 4 + length:
+                    break
+
+                self._write_register(register, view[index + 4:index + 4 + length])
+                index += 4 + length
+
+            elif mode == READ_ADRESS:
+                self._answer.extend(self._read_register(register, length))
+                index += 4
+
+            else:
+                logger.error("Emulator: invalid command byte 0x%02x", mode)
+                index += 1
+                continue
+
+            self.stats['commands'] += 1
+
+        view.release()
+        del commands[:index]
+
+    def _write_register(self, register: int, data: memoryview) -> None:
+        if not len(data):
+            return
+
+        value = data[-1]
+
+        if register == SR_ASIC_ADRESS and len(data) > 1:
+            demux = self.registers[DEMUX_ADRESS]
+            self._asic_sr(demux).feed(data)
+            self.tdac_sr[demux].feed(data)
+
+        elif register == GECCO_ADRESS:
+            self.gecco_sr.feed(data)
+
+        elif register == SPI_CONFIG_REG:
+            if value & SPI_WRITE_FIFO_RESET:
+                self._write_fifo = 0
+            if value & SPI_READ_FIFO_RESET:
+                self._read_fifo.clear()
+            self.registers[register] = value
+
+        elif register == SPI_WRITE_REG:
+            accepted = min(len(data), self.write_fifo_size - self._write_fifo)
+            if accepted < len(data):
+                self.stats['write_fifo_overflows'] += 1
+            self._write_fifo += accepted
+
+        elif PG_RESET <= register <= PG_DATA:
+            self._write_patgen(register, value)
+
+        else:
+            self.registers[register] = value
+
+    def _read_register(self, register: int, num: int) -> bytes:
+        self._update()
+
+        if register == SPI_READ_REG:
+            data = bytes(self._read_fifo[:num])
+            del self._read_fifo[:num]
+            return data + bytes([self.idle_byte]) * (num - len(data))
+
+        if register == SPI_CONFIG_REG:
+            return bytes([self._spi_status()]) * num
+
+        if register == SPI_READBACK_REG:
+            return bytes(num)
+
+        return bytes([self.registers[register]]) * num
+
+    def _spi_status(self) -> int:
+        flags = SPI_WRITE_FIFO_EMPTY | SPI_WRITE_FIFO_FULL | SPI_READ_FIFO_EMPTY | SPI_READ_FIFO_FULL
+        status = self.registers[SPI_CONFIG_REG] & ~flags
+
+        if self._write_fifo == 0:
+            status |= SPI_WRITE_FIFO_EMPTY
+        if self._write_fifo >= self.write_fifo_size:
+            status |= SPI_WRITE_FIFO_FULL
+        if not self._read_fifo:
+            status |= SPI_READ_FIFO_EMPTY
+        if len(self._read_fifo) >= self.read_fifo_size:
+            status |= SPI_READ_FIFO_FULL
+
+        return status
+
+    def _write_patgen(self, register: int, value: int) -> None:
+        previous = self.registers[register]
+        self.registers[register] = value
+
+        if register == PG_WRITE and value and not previous:
+            self.patgen[self.registers[PG_ADDRESS] & 0xF] = self.registers[PG_DATA]
+
+        elif register == PG_RESET and value:
+            self._pg_running = False
+
+        elif register == PG_SUSPEND and not value and previous and not self.registers[PG_RESET]:
+            self._pg_running = True
+            self._pg_start = time.monotonic()
+            self._pg_pulses_done = 0
+
+    def _patgen_pulses(self, now: float) -> int:
+        """Number of injection pulses since the last update"""
+
+        if not self._pg_running:
+            return 0
+
+        pulsesperset = self.patgen[7]
+        period = self.patgen[8]
+        cycle = (self.patgen[10] << 8) | self.patgen[11]
+        initdelay = (self.patgen[12] << 8) | self.patgen[13]
+        clkdiv = (self.patgen[14] << 8) | self.patgen[15]
+
+        tick = max(clkdiv, 1) / self.patgen_clock_hz
+        elapsed = now - self._pg_start - initdelay * tick
+
+        if elapsed < 0:
+            return 0
+
+        due = int(elapsed / (max(period, 1) * tick)) + 1
+
+        if cycle:
+            due = min(due, cycle * pulsesperset)
+            if due == cycle * pulsesperset:
+                self._pg_running = False
+
+        pulses = due - self._pg_pulses_done
+        self._pg_pulses_done = due
+
+        return pulses
+
+    def _update(self) -> None:
+        """Advance the model to the current time"""
+
+        now = time.monotonic()
+        elapsed, self._last_update = now - self._last_update, now
+
+        # Injection and noise hits
+        pulses = self._patgen_pulses(now)
+        if pulses:
+            self._chip_output.extend(self.hitgen.frames(pulses * self.hits_per_pulse))
+
+        if self.hitgen.rate:
+            self._noise_budget += self.hitgen.rate * elapsed
+            noise = int(self._noise_budget)
+            self._noise_budget -= noise
+            self._chip_output.extend(self.hitgen.frames(noise))
+
+        if self.registers[SPI_CONFIG_REG] & SPI_MODULE_RESET:
+            self._spi_budget = 0.0
+            return
+
+        # SPI transfers, every byte written by the host clocks one byte out of the chip
+        self._spi_budget = min(self._spi_budget + elapsed * self.spi_rate, self.read_fifo_size + self._write_fifo)
+        budget = int(self._spi_budget)
+
+        clocked = min(budget, self._write_fifo)
+        self._write_fifo -= clocked
+
+        miso = self._chip_output[:clocked]
+        del self._chip_output[:clocked]
+        miso.extend(bytes([self.idle_byte]) * (clocked - len(miso)))
+
+        # Interrupt driven readout of pending chip data
+        if self.autoread:
+            auto = min(budget - clocked, len(self._chip_output))
+            miso.extend(self._chip_output[:auto])
+            del self._chip_output[:auto]
+            clocked += auto
+
+        self._spi_budget -= clocked
+
+        free = self.read_fifo_size - len(self._read_fifo)
+        if len(miso) > free:
+            self.stats['read_fifo_overflows'] += 1
+            miso = miso[:free]
+
+        self._read_fifo.extend(miso)
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 19:12:44 2026
+
+Append-only columnar store for decoded hits
+"""
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from modules.setup_logger import logger
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow missing, only CSV output is available
+    pa = pq = None
+
+PARQUET_AVAILABLE = pq is not None
+
+
+logger = logging.getLogger(__name__)
+
+# Key of the run metadata in the Parquet schema metadata
+PARQUET_METADATA_KEY = b'astropix'
+
+
+class HitStore:
+    """
+    Append-only hit store with fixed columns
+
+    Appended hits are kept as numpy column chunks and written to CSV incrementally,
+    so appending costs the same regardless of how many hits were stored before.
+    """
+
+    def __init__(self, columns: list, file=None, flush_rows: int = 4096,
+                 keep: bool = None, index_label: str = 'index', dtypes: dict = None) -> None:
+        """Init
+
+        :param columns: Column names in output order
+        :param file: CSV path or open text file, None keeps everything in memory
+        :param flush_rows: Write to file when this many rows are buffered
+        :param keep: Keep flushed rows in memory, default only without file
+        :param index_label: Name of the index column in the CSV
+        :param dtypes: Column types appended values are cast to, e.g. {'vth': np.float64}
+        """
+        self._columns = list(columns)
+        self._dtypes = dict(dtypes or {})
+        self._flush_rows = flush_rows
+        self._keep = file is None if keep is None else keep
+        self._index_label = index_label
+
+        self._output = file is not None
+        self._path = None
+        self._file = None
+
+        if self._output:
+            self._open(file)
+
+        self._chunks = []       # buffered chunks, not written yet
+        self._kept = []         # written chunks kept in memory
+        self._buffered = 0
+        self._rows = 0
+        self._written = 0
+        self._header_written = False
+
+    @classmethod
+    def create(cls, columns: list, file=None, metadata: dict = None, **kwargs):
+        """
+        Store for file, Parquet for paths ending in .parquet and CSV otherwise
+
+        :param columns: Column names in output order
+        :param file: Output path or open text file, None keeps everything in memory
+        :param metadata: Run metadata, only stored in Parquet files
+        :param kwargs: Passed to the store
+
+        :returns: HitStore or ParquetHitStore
+        """
+        if isinstance(file, str) and file.endswith('.parquet'):
+            return ParquetHitStore(columns, file, metadata=metadata, **kwargs)
+
+        return cls(columns, file, **kwargs)
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def __call__(self, hits) -> None:
+        """Append hits, lets the store be used as decoded sink of a ReadoutStream"""
+        self.append(hits)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def columns(self) -> list:
+        """Column names"""
+        return self._columns
+
+    def append(self, hits, **constants) -> None:
+        """
+        Append hits
+
+        Columns missing in hits and constants are filled with NaN, other columns are ignored.
+
+        :param hits: DataFrame or dict of arrays with decoded hits
+        :param constants: Values shared by all appended hits, e.g. scan_col=3
+        """
+        if isinstance(hits, pd.DataFrame):
+            num = len(hits)
+        else:
+            num = len(next(iter(hits.values()))) if len(hits) else 0
+
+        if not num:
+            return
+
+        chunk = {}
+        for column in self._columns:
+            dtype = self._dtypes.get(column)
+
+            if column in constants:
+                chunk[column] = np.full(num, constants[column], dtype=dtype)
+            elif column in hits:
+                chunk[column] = np.asarray(hits[column], dtype=dtype)
+            else:
+                chunk[column] = np.full(num, np.nan)
+
+        self._chunks.append(chunk)
+        self._buffered += num
+        self._rows += num
+
+        if self._output and self._buffered >= self._flush_rows:
+            self.flush()
+
+    @staticmethod
+    def _concat(chunks: list, columns: list) -> dict:
+        return {column: np.concatenate([chunk[column] for chunk in chunks]) for column in columns}
+
+    def _open(self, file) -> None:
+        """Open output, file is a path or an open text file"""
+
+        if isinstance(file, str):
+            self._path = file
+            self._file = open(file, "w", encoding="utf-8", newline='')
+        else:
+            self._file = file
+
+    def _write(self, data: dict) -> None:
+        """
+        Write one block of hits
+
+        :param data: Dict with one array per column, None writes only the header
+        """
+        if data is not None:
+            frame = pd.DataFrame(data, columns=self._columns,
+                                 index=pd.RangeIndex(self._written, self._written + self._buffered))
+        elif not self._header_written:
+            frame = pd.DataFrame(columns=self._columns)
+        else:
+            return
+
+        frame.index.name = self._index_label
+        frame.to_csv(self._file, header=not self._header_written)
+        self._file.flush()
+
+        self._header_written = True
+
+    def flush(self) -> None:
+        """Write buffered hits to the file"""
+
+        if not self._output:
+            return
+
+        self._write(self._concat(self._chunks, self._columns) if self._chunks else None)
+
+        self._written += self._buffered
+
+        if self._keep:
+            self._kept.extend(self._chunks)
+
+        self._chunks = []
+        self._buffered = 0
+
+        logger.debug("HitStore: %d rows written", self._written)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """
+        All stored hits as DataFrame
+
+        Rows that were flushed and not kept are read back if the store owns its CSV file.
+
+        :returns: DataFrame with one row per hit
+        """
+        if self._written and not self._keep:
+            if self._path is None:
+                raise ValueError("Hits were flushed to a file object and not kept in memory")
+
+            self.flush()
+            return self._read_back()
+
+        chunks = self._kept + self._chunks
+
+        if not chunks:
+            return pd.DataFrame(columns=self._columns)
+
+        return pd.DataFrame(self._concat(chunks, self._columns), columns=self._columns)
+
+    def _read_back(self) -> pd.DataFrame:
+        return pd.read_csv(self._path, index_col=self._index_label)
+
+    def close(self) -> None:
+        """Write remaining hits, close the file if the store opened it"""
+
+        self.flush()
+
+        if self._path is not None and not self._file.closed:
+            self._file.close()
+
+
+class ParquetHitStore(HitStore):
+    """
+    Hit store writing a compressed Parquet file
+
+    Every flush is written as one row group. Types of columns not declared in dtypes
+    are taken from the first flushed block, so columns that may change from int to float
+    during a run have to be declared. Run metadata is stored as JSON in the file metadata.
+    """
+
+    def __init__(self, columns: list, file: str, flush_rows: int = 4096, keep: bool = None,
+                 index_label: str = 'index', dtypes: dict = None, metadata: dict = None,
+                 compression: str = 'zstd') -> None:
+        """Init
+
+        :param columns: Column names in output order
+        :param file: Parquet path
+        :param flush_rows: Write a row group when this many rows are buffered
+        :param keep: Keep flushed rows in memory, default False
+        :param index_label: Name of the index column
+        :param dtypes: Column types appended values are cast to, e.g. {'vth': np.float64}
+        :param metadata: JSON serializable run metadata, e.g. voltageboard DACs and scan parameters
+        :param compression: Parquet compression codec
+        """
+        if pq is None:
+            logger.error('pyarrow not available, cannot write %s', file)
+            raise ImportError('Parquet output requires pyarrow')
+
+        self._metadata = metadata or {}
+        self._compression = compression
+        self._schema = None
+        self._writer = None
+
+        super().__init__(columns, file, flush_rows, keep, index_label, dtypes)
+
+    @property
+    def metadata(self) -> dict:
+        """Run metadata, stored when the file is created"""
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, metadata: dict) -> None:
+        if self._writer is not None:
+            raise ValueError("Metadata can only be changed before the first flush")
+
+        self._metadata = metadata
+
+    def _open(self, file: str) -> None:
+        # Writer is created with the first block, when the column types are known
+        self._path = file
+
+    def _write(self, data: dict) -> None:
+        if data is None:
+            if self._writer is not None:
+                return
+
+            # Nothing appended yet, still create a valid file with all columns
+            data = {column: np.empty(0, dtype=self._dtypes.get(column, np.float64)) for column in self._columns}
+
+        arrays = {self._index_label: np.arange(self._written, self._written + self._buffered, dtype=np.int64)}
+        arrays.update(data)
+
+        if self._writer is None:
+            table = pa.table(arrays)
+            self._schema = table.schema.with_metadata(
+                {PARQUET_METADATA_KEY: json.dumps(self._metadata, default=str)})
+            self._writer = pq.ParquetWriter(self._path, self._schema, compression=self._compression)
+
+        self._writer.write_table(pa.Table.from_pydict(arrays, schema=self._schema))
+
+    def _read_back(self) -> pd.DataFrame:
+        if self._writer is not None:
+            raise ValueError("Parquet file can only be read back after close")
+
+        return load_hits(self._path)[0]
+
+    def close(self) -> None:
+        """Write remaining hits and the file footer"""
+
+        self.flush()
+
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._output = False
+
+
+def _csv_header_lines(filename: str, index_label: str) -> tuple:
+    """
+    Free-text lines in front of the CSV header of a scan log
+
+    :returns: Tuple with metadata dict of 'key: value' lines and number of lines to skip
+    """
+    metadata = {}
+
+    with open(filename, 'r', encoding='utf-8') as file:
+        for num, line in enumerate(file):
+            if line.startswith(index_label + ','):
+                return metadata, num
+
+            key, sep, value = line.partition(':')
+            if sep:
+                metadata[key.strip()] = value.strip()
+
+    return metadata, 0
+
+
+def load_hits(filename: str, columns: list = None, index_label: str = 'index') -> tuple:
+    """
+    Load hits written by a HitStore
+
+    Parquet files only read the requested columns. For CSV scan logs the free-text
+    lines in front of the header are skipped and returned as metadata strings.
+
+    :param filename: Parquet file or CSV log
+    :param columns: Columns to load, None loads all
+    :param index_label: Name of the index column
+
+    :returns: Tuple with DataFrame and metadata dict
+    """
+    if filename.endswith('.parquet'):
+        if pq is None:
+            raise ImportError('Reading Parquet files requires pyarrow')
+
+        table = pq.read_table(filename, columns=None if columns is None else [index_label] + list(columns))
+
+        raw = (table.schema.metadata or {}).get(PARQUET_METADATA_KEY)
+        metadata = json.loads(raw) if raw else {}
+
+        return table.to_pandas().set_index(index_label), metadata
+
+    metadata, skiprows = _csv_header_lines(filename, index_label)
+
+    usecols = None if columns is None else [index_label] + list(columns)
+    frame = pd.read_csv(filename, sep=',', skiprows=skiprows, usecols=usecols, index_col=index_label)
+
+    return frame, metadata
@@ -19,6 +19,8 @@ PG_OUTPUT   = 5
 PG_ADDRESS  = 6
 PG_DATA     = 7
 
+PATGEN_CLOCK_HZ = 330e6     # Pattern generator clock before clkdiv
+
 
 logger = logging.getLogger(__name__)
 
@@ -26,12 +28,13 @@ logger = logging.getLogger(__name__)
 class Injectionboard(Nexysio):
     """Sets injection setting for GECCO Injectionboard"""
 
-    def __init__(self, handle, pos: int = 0, onchip=False) -> None:
+    def __init__(self, handle, pos: int = 0, onchip=False, clock_hz: float = PATGEN_CLOCK_HZ) -> None:
         """Init
 
         :param handle: USB device handle
         :param pos: Set card position on gecco board from 1-8
         :param onchip: Set if onchip injection circuit is used
+        :param clock_hz: Pattern generator clock before clkdiv in Hz, depends on the firmware
         """
 
         self._handle = handle
@@ -43,6 +46,9 @@ class Injectionboard(Nexysio):
         self._pulsesperset = 0
         self._amplitude = 0
         self._onchip = onchip
+        self._clock_hz = clock_hz
+
+        self._written_amplitude = None
 
         if not self._onchip:
             self._injvoltage = Voltageboard(handle, pos, (2, [0.0, 0.0]))
@@ -119,6 +125,32 @@ class Injectionboard(Nexysio):
         if 0 <= amplitude <= 1.8:
             self._amplitude = amplitude
 
+    @property
+    def clock_hz(self) -> float:
+        """Pattern generator clock before clkdiv in Hz"""
+
+        return self._clock_hz
+
+    @clock_hz.setter
+    def clock_hz(self, clock_hz: float) -> None:
+        if clock_hz > 0:
+            self._clock_hz = clock_hz
+
+    @property
+    def burst_duration(self) -> float:
+        """Duration of an injection burst from start() until the last pulse in s
+
+        initdelay and cycle * pulsesperset pulses of period patgen ticks, one tick is clkdiv patgen clocks of clock_hz.
+
+        :returns: Duration, None if the pattern generator runs continuously (cycle 0)
+        """
+        if not self.cycle:
+            return None
+
+        ticks = self.initdelay + max(self.period, 1) * self.cycle * self.pulsesperset
+
+        return ticks * max(self.clkdiv, 1) / self.clock_hz
+
     @property
     def vcal(self) -> float:
         """Voltageboard calibration value
@@ -211,24 +243,58 @@ class Injectionboard(Nexysio):
         """
         Generate injection vector for set output, pattern and pulses/set
 
+        Compiled programs are cached by their settings.
+
         :returns: config vector
         """
 
         logger.info("\nWrite Injection Config\n===============================")
 
-        if self._onchip:
-            output = self.write_register(PG_OUTPUT, 2)
-        else:
-            output = self.write_register(PG_OUTPUT, 1)
+        output = 2 if self._onchip else 1
+
+        key = ('patgen', self.period, self.cycle, self.clkdiv, self.initdelay, self.pulsesperset, output)
+
+        return self.pattern_cache.get(key, lambda: self.__compile_injection(output))
+
+    def __compile_injection(self, output: int) -> bytes:
+        """
+        Compile patgen program
+
+        :param output: Patgen output, 1 for the injectionboard, 2 for onchip injection
+
+        :returns: config vector
+        """
 
         patgenconfig = self.__patgen(self.period, self.cycle, self.clkdiv, self.initdelay)
         pulses = self.__patgenwrite(7, self.pulsesperset)
 
-        data = output + patgenconfig + pulses
+        data = self.write_register(PG_OUTPUT, output) + patgenconfig + pulses
         logger.debug(f"Injection vector({len(data)} Bytes): 0x{data.hex()}\n")
 
         return bytes(data)
 
+    def __amplitude_setting(self) -> tuple:
+        return (self._amplitude, self.vcal, self.vsupply, self._injvoltage.pos)
+
+    def __amplitude_pattern(self, force: bool = False) -> bytes:
+        """
+        Generate voltageboard pattern for the injection amplitude
+
+        :param force: Generate even if the amplitude was already written
+
+        :returns: Pattern, empty if nothing has to be written
+        """
+        if self._onchip:
+            # TODO: update asic config if onchip vdacs are used
+            return b''
+
+        if not force and self.__amplitude_setting() == self._written_amplitude:
+            return b''
+
+        self._injvoltage.dacvalues = (2, [self._amplitude, 0])
+
+        return self._injvoltage.vb_pattern()
+
     def __start(self) -> bytes:
         """
         Start injection
@@ -264,37 +330,43 @@ class Injectionboard(Nexysio):
         return bytes(data)
 
     def update_inj(self) -> None:
-        """Update injectionboard"""
+        """Update injectionboard
 
-        # Update amplitude
-        self.update_inj_amplitude()
+        Amplitude, stop and configuration are sent in one write.
+        """
 
-        # Stop injection
-        self.write(self.__stop())
+        # Update amplitude, stop and configure injection
+        amplitude = self.__amplitude_pattern()
 
-        # Configure injection
-        self.write(self.__configureinjection())
+        self.write(amplitude + self.__stop() + self.__configureinjection())
 
-    def update_inj_amplitude(self) -> None:
-        """Write injection amplitude"""
-        if not self._onchip:
-            self._injvoltage.dacvalues = (2, [self._amplitude, 0])
-            self._injvoltage.update_vb()
-        else:
-            pass
-            # TODO: update asic config if onchip vdacs are used
+        if amplitude:
+            self._written_amplitude = self.__amplitude_setting()
+
+    def update_inj_amplitude(self, force: bool = False) -> None:
+        """Write injection amplitude, skipped if it did not change
+
+        :param force: Write even if the amplitude is unchanged
+        """
+        amplitude = self.__amplitude_pattern(force)
+
+        if amplitude:
+            self.write(amplitude)
+            self._written_amplitude = self.__amplitude_setting()
 
     def start(self) -> None:
-        """Start injection"""
+        """Start injection
 
-        # Stop injection
-        self.write(self.__stop())
+        Stop, amplitude update, configuration and start are sent in one write.
+        """
+
+        # Stop injection, update injboard amplitude, configure and start
+        amplitude = self.__amplitude_pattern()
 
-        # Update injboard amplitude
-        self.update_inj()
+        self.write(self.__stop() + amplitude + self.__configureinjection() + self.__start())
 
-        # Start Injection
-        self.write(self.__start())
+        if amplitude:
+            self._written_amplitude = self.__amplitude_setting()
 
         logger.info("Start injection")
 
@@ -6,13 +6,23 @@ Created on Fri Jun 25 16:10:45 2021
 @author: Nicolas Striebig
 
 """
-import ftd2xx as ftd
 import sys
 import time
+import weakref
+from collections import OrderedDict
 
 import logging
 import binascii
 
+import numpy as np
+
+try:
+    import ftd2xx as ftd
+except (ImportError, OSError):
+    # D2XX driver missing, only the emulator backend is available
+    ftd = None
+
+from modules.bitorder import bit_array
 from modules.spi import Spi
 from modules.setup_logger import logger
 
@@ -28,15 +38,264 @@ LD_TDAC_ASIC    = 0x40
 SIN_GECCO       = 0x02
 LD_GECCO        = 0x04
 
+RES_N           = 0x10      # Chip reset, Reg 0 Bit 4
+DEMUX_ADRESS    = 0x34      # Chip select of the config demux
+
+# Bytes clocked out per config bit, row 0 for bit 0 and row 1 for bit 1
+ASIC_BIT_PATTERN        = np.array([[0, 1, 0, 2, 0], [SIN_ASIC, SIN_ASIC | 1, SIN_ASIC, SIN_ASIC | 2, SIN_ASIC]],
+                                   dtype=np.uint8)
+ASIC_READBACK_PATTERN   = np.array([4, 4 | 1, 4, 4 | 2, 4], dtype=np.uint8)
+GECCO_BIT_PATTERN       = np.array([[0, 1, 0], [SIN_GECCO, SIN_GECCO | 1, SIN_GECCO]], dtype=np.uint8)
+
 NEXYS_USB_DESC  = b'Digilent USB Device A'
 NEXYS_USB_SER   = b'210276'
 
 logger = logging.getLogger(__name__)
 
 
+class RegisterTransaction:
+    """
+    Batch of register writes and reads sent as one FTDI write
+
+    Read answers arrive in order after all queued commands,
+    commit() returns them as a list. Used as context manager it commits on exit.
+    """
+
+    def __init__(self, nexys) -> None:
+        self._nexys = nexys
+        self._buffer = bytearray()
+        self._reads = []
+
+        self.results = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def write(self, data: bytes) -> None:
+        """
+        Queue prebuilt command bytes, e.g. from write_register() or gen_*_pattern()
+
+        :param data: Bytestring
+        """
+        self._buffer.extend(data)
+
+    def write_register(self, register: int, value: int) -> None:
+        """
+        Queue single byte register write
+
+        :param register: FTDI Register to write
+        :param value: Byte value
+        """
+        self._buffer.extend(self._nexys.write_register(register, value))
+
+    def write_registers(self, register: int, value: bytearray) -> None:
+        """
+        Queue multi byte register write
+
+        :param register: FTDI Register to write
+        :param value: Bytestring
+        """
+        self._buffer.extend(self._nexys.write_registers(register, value))
+
+    def read_register(self, register: int, num: int = 1) -> int:
+        """
+        Queue register read
+
+        :param register: FTDI Register to read from
+        :param num: Number of bytes to read
+
+        :returns: Index of the answer in the results
+        """
+        self._buffer.extend([READ_ADRESS, register, num >> 8, num % 256])
+        self._reads.append(num)
+
+        return len(self._reads) - 1
+
+    def commit(self) -> list:
+        """
+        Send all queued commands and collect read answers
+
+        :returns: List with one bytestring per queued read
+        """
+        if self._buffer:
+            self._nexys.write(bytes(self._buffer))
+
+        self.results = []
+
+        total = sum(self._reads)
+
+        if total:
+            answer = self._nexys.read(total)
+
+            offset = 0
+            for num in self._reads:
+                self.results.append(bytes(answer[offset:offset + num]))
+                offset += num
+
+        logger.debug("Transaction: %d bytes written, %d reads", len(self._buffer), len(self._reads))
+
+        self._buffer = bytearray()
+        self._reads = []
+
+        return self.results
+
+
+class PatternCache:
+    """
+    LRU cache for generated FTDI byte patterns
+
+    Keys are built from the bitvector and the pattern parameters,
+    returning to an earlier configuration replays the cached bytes.
+    """
+
+    def __init__(self, maxsize: int = 64) -> None:
+        """Init
+
+        :param maxsize: Max. number of cached patterns
+        """
+        self._maxsize = maxsize
+        self._patterns = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._patterns)
+
+    @staticmethod
+    def key(value, *params) -> tuple:
+        """
+        Cache key for a bitvector
+
+        :param value: BitArray or bytes-like vector
+        :param params: Pattern parameters, e.g. wload and clkdiv
+
+        :returns: Hashable key
+        """
+        data = value.tobytes() if hasattr(value, 'tobytes') else bytes(value)
+
+        return (len(value), data, *params)
+
+    def get(self, key: tuple, generate):
+        """
+        Get cached pattern, generate and store it on a miss
+
+        :param key: Key from PatternCache.key()
+        :param generate: Callable generating the pattern
+
+        :returns: Pattern
+        """
+        try:
+            pattern = self._patterns[key]
+        except KeyError:
+            self.misses += 1
+
+            pattern = generate()
+            self._patterns[key] = pattern
+
+            if len(self._patterns) > self._maxsize:
+                self._patterns.popitem(last=False)
+        else:
+            self.hits += 1
+            self._patterns.move_to_end(key)
+
+        return pattern
+
+    def clear(self) -> None:
+        """Drop all cached patterns"""
+        self._patterns.clear()
+
+
+class ChipState:
+    """
+    Demux selection and chip resets seen on one FTDI handle
+
+    Tracked from the command stream in Nexysio.write(), so writes from every
+    Nexysio object sharing the handle are seen, including batched transactions.
+    The key changes on every chip reset and demux flip.
+    """
+
+    def __init__(self) -> None:
+        self.demux = None
+        self.resets = 0
+
+        self._header = bytearray()
+        self._skip = 0
+        self._register = None
+
+    @property
+    def key(self) -> tuple:
+        """(resets, demux), demux is None until written"""
+        return (self.resets, self.demux)
+
+    def track(self, data: bytes) -> None:
+        """
+        Follow register writes in a command stream, commands may span several calls
+
+        :param data: Bytestring written to the FTDI chip
+        """
+        length = len(data)
+        index = 0
+
+        while index < length:
+            if self._register is not None:
+                self._single_write(self._register, data[index])
+                self._register = None
+                index += 1
+                continue
+
+            if self._skip:
+                step = min(self._skip, length - index)
+                self._skip -= step
+                index += step
+                continue
+
+            need = 4 - len(self._header)
+            self._header.extend(data[index:index + need])
+            index += need
+
+            if len(self._header) < 4:
+                break
+
+            mode, register, hbyte, lbyte = self._header
+            self._header.clear()
+
+            if mode == WRITE_ADRESS:
+                num = (hbyte << 8) | lbyte
+
+                if num == 1 and register in (SR_ASIC_ADRESS, DEMUX_ADRESS):
+                    self._register = register
+                else:
+                    self._skip = num
+
+            elif mode != READ_ADRESS:
+                # Not a command header, resync on the next byte
+                self._header.extend(bytes([register, hbyte, lbyte]))
+
+    def _single_write(self, register: int, value: int) -> None:
+        if register == DEMUX_ADRESS:
+            self.demux = value
+        elif value & RES_N:
+            self.resets += 1
+
+
+# Chip state per FTDI handle, shared by all Nexysio objects using it
+_chip_states = weakref.WeakKeyDictionary()
+
+
 class Nexysio(Spi):
     """Interface to Nexys FTDI Chip"""
 
+    _pattern_cache = None
+    _chip_state = None
+
     def __init__(self, handle=0) -> None:
         super().__init__()
         self._handle = handle
@@ -52,17 +311,51 @@ class Nexysio(Spi):
         :returns: Device handle
         """
 
-        data = bytearray()
-
         clkdiv = max(clkdiv, 1)
 
-        for byte in value:
-            data.extend([byte] * clkdiv)
+        return bytearray(np.repeat(np.frombuffer(bytes(value), dtype=np.uint8), clkdiv).tobytes())
 
-        return data
+    @classmethod
+    def _bit_pattern(cls, value, template: np.ndarray, clkdiv: int) -> bytearray:
+        """
+        Clock pattern for every bit, each byte repeated clkdiv times
+
+        :param value: Bitvector
+        :param template: Pattern for bit 0 and bit 1, shape (2, bytes per bit)
+        :param clkdiv: Clockdivider
+
+        :returns: Bytearray with pattern
+        """
+
+        pattern = template[bit_array(value).astype(np.uint8)].ravel()
+
+        return bytearray(np.repeat(pattern, max(clkdiv, 1)).tobytes())
+
+    @property
+    def pattern_cache(self) -> PatternCache:
+        """LRU cache for generated shift register patterns"""
+        if self._pattern_cache is None:
+            self._pattern_cache = PatternCache()
+
+        return self._pattern_cache
+
+    @property
+    def chip_state(self) -> ChipState:
+        """Demux selection and chip resets of the handle, shared by all users of the handle"""
+        try:
+            return _chip_states.setdefault(self._handle, ChipState())
+        except TypeError:
+            # Handle not opened yet or not weak referenceable
+            if self._chip_state is None:
+                self._chip_state = ChipState()
+
+            return self._chip_state
 
     def debug_print(self, name: str, length: int, hbyte: int, lbyte: int,
                     header: bytearray, value: bytearray):
+        if not logger.isEnabledFor(logging.DEBUG):
+            return
+
         logger.debug(
             "\nWrite %s\n===============================\
             Length: %d hByte: %d lByte: %d\n\
@@ -80,6 +373,10 @@ class Nexysio(Spi):
         :returns: Device handle
         """
 
+        if ftd is None:
+            logger.error('ftd2xx/D2XX driver not available')
+            sys.exit(1)
+
         self._handle = ftd.open(index)
 
         devinfo = self._handle.getDeviceInfo()
@@ -106,6 +403,10 @@ class Nexysio(Spi):
 
         :returns: Device handle
         """
+        if ftd is None:
+            logger.error('ftd2xx/D2XX driver not available')
+            return False
+
         # Get list with serialnumbers and descritions of all connected devices
         device_serial = ftd.listDevices(0)
         device_desc = ftd.listDevices(2)
@@ -131,6 +432,23 @@ class Nexysio(Spi):
         logger.error('Nexys not found')
         return False
 
+    def open_emulator(self, **kwargs):
+        """
+        Opens a software emulated Nexys instead of the FTDI device
+
+        :param kwargs: Arguments for modules.emulator.NexysEmulator
+
+        :returns: Device handle
+        """
+        from modules.emulator import NexysEmulator
+
+        self._handle = NexysEmulator(**kwargs)
+        self.__setup()
+
+        logger.info("Nexys emulator opened")
+
+        return self._handle
+
     def write(self, value: bytes) -> None:
         """
         Direct write to FTDI chip
@@ -140,13 +458,17 @@ class Nexysio(Spi):
         :param value: Bytestring to write
         """
         try:
+            self.chip_state.track(value)
+
             # split large vectors into multiple parts
-            while len(value) > 64000:
+            if len(value) > 64000:
                 logger.debug("Split writevector in parts")
-                self._handle.write(value[0:63999])
-                value = value[64000:]
 
-            self._handle.write(value)
+                view = memoryview(value)
+                for i in range(0, len(view), 64000):
+                    self._handle.write(bytes(view[i:i + 64000]))
+            else:
+                self._handle.write(bytes(value))
         except AttributeError:
             logger.error('Nexys Write Error')
 
@@ -233,6 +555,14 @@ class Nexysio(Spi):
 
         return data
 
+    def transaction(self) -> RegisterTransaction:
+        """
+        Start batch of register operations sent in one FTDI write
+
+        :returns: RegisterTransaction, commit() or leave the with block to send
+        """
+        return RegisterTransaction(self)
+
     def read_register(self, register: int, num: int = 1) -> bytes:
         """
         Read Single Byte from Register
@@ -274,23 +604,19 @@ class Nexysio(Spi):
 
         self.debug_print("GECCO Config", length, hbyte, lbyte, header, value)
 
-        data = bytearray()
-
-        # data
-        for bit in value:
-            pattern = SIN_GECCO if bit == 1 else 0
-
-            data.extend([pattern, pattern | 1, pattern])
+        tail = bytearray()
 
         # Load signal
-        data.extend([LD_GECCO, 0x00])
+        tail.extend([LD_GECCO, 0x00])
 
         # Add 8 clocks
-        data.extend([0x01, 0x00] * 8)
+        tail.extend([0x01, 0x00] * 8)
 
-        data.extend([LD_GECCO, 0x00])
+        tail.extend([LD_GECCO, 0x00])
 
-        data = self.__addbytes(data, clkdiv)
+        # data
+        data = self._bit_pattern(value, GECCO_BIT_PATTERN, clkdiv)
+        data.extend(self.__addbytes(tail, clkdiv))
 
         # concatenate header+dataasic
         return b''.join([header, data])
@@ -326,24 +652,19 @@ class Nexysio(Spi):
         data, load = bytearray(), bytearray()
 
         if not readback_mode:
-            # data
-            for bit in value:
-                pattern = SIN_ASIC if bit == 1 else 0
-
-                data.extend([pattern, pattern | 1, pattern, pattern | 2, pattern])  # Generate double clocked pattern
+            # data, double clocked pattern per bit
+            data = self._bit_pattern(value, ASIC_BIT_PATTERN, clkdiv)
 
             # Load signal
             if wload:
                 load.extend([0x00, LD_ASIC, 0x00])
 
-            data = self.__addbytes(data, clkdiv)
             data.extend(self.__addbytes(load, clkdiv * 10))
 
         else:
             data.extend([4 | 32, 4 | 33, 4 | 32, 4 | 34, 4 | 32])
-            for bit in value:
-                # data.extend([4 | 32, 4 | 33, 4, 4 | 2, 4])
-                data.extend([4, 4 | 1, 4, 4 | 2, 4])
+            # data.extend([4 | 32, 4 | 33, 4, 4 | 2, 4]) per bit
+            data.extend(np.tile(ASIC_READBACK_PATTERN, len(value)).tobytes())
             data = self.__addbytes(data, clkdiv)
 
         # concatenate header+data
@@ -380,17 +701,13 @@ class Nexysio(Spi):
         data, load = bytearray(), bytearray()
 
         if not readback_mode:
-            # data
-            for bit in value:
-                pattern = SIN_ASIC if bit == 1 else 0
-
-                data.extend([pattern, pattern | 1, pattern, pattern | 2, pattern])  # Generate double clocked pattern
+            # data, double clocked pattern per bit
+            data = self._bit_pattern(value, ASIC_BIT_PATTERN, clkdiv)
 
             # Load signal
             if wload:
                 load.extend([0x00, LD_TDAC_ASIC, 0x00])
 
-            data = self.__addbytes(data, clkdiv)
             data.extend(self.__addbytes(load, clkdiv * 10))
 
         """else:
@@ -449,10 +766,10 @@ class Nexysio(Spi):
         Set res_n to 0 and back to 1 after short sleep
         res_n is connected to FTDI Reg: 0 Bit: 4
         """
+        configregister = self.get_configregister()
+
         # Set Reset bits 1
-        configregister = self.set_bit(self.get_configregister(), 4)
-        self.write_register(0, configregister, True)
+        self.write_register(0, self.set_bit(configregister, 4), True)
         time.sleep(.1)
         # Set Reset bits and readback bit 0
-        configregister = self.clear_bit(self.get_configregister(), 4)
-        self.write_register(0, configregister, True)
+        self.write_register(0, self.clear_bit(configregister, 4), True)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 23:05:51 2026
+
+Parallel offline decoding of raw readout streams
+"""
+import logging
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+import pandas as pd
+
+from modules.bitorder import BITREVERSE_LUT
+from modules.decode import Decode
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+# Bytes of the stream decoded per task
+PARALLEL_CHUNK_SIZE = 1 << 24
+
+# Bytes searched behind a nominal chunk boundary for the next header
+REALIGN_SEARCH = 1 << 12
+
+
+def _decode_columns(decode: Decode, decoder: str):
+    if decoder == 'astropix4':
+        return decode.decode_astropix4_columns
+
+    return decode.decode_astropix2_columns
+
+
+def _attach(source: tuple):
+    """
+    Open the input buffer in a worker
+
+    :param source: ('shm', name) or ('file', path)
+
+    :returns: Tuple with uint8 array and handle to close
+    """
+    kind, name = source
+
+    if kind == 'shm':
+        shm = shared_memory.SharedMemory(name=name)
+        return np.ndarray(shm.size, dtype=np.uint8, buffer=shm.buf), shm
+
+    with open(name, 'rb') as file:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return np.frombuffer(mapped, dtype=np.uint8), mapped
+
+
+def _decode_chunk(source: tuple, length: int, start: int, end: int, decode: Decode,
+                  decoder: str, reverse_bitorder: bool) -> tuple:
+    """
+    Worker: find and decode hits starting in [start, end)
+
+    The hit search starts fresh at start, the merge corrects hits that depend on the previous chunk.
+
+    :returns: Tuple with absolute hit offsets and dict of column arrays
+    """
+    buffer, handle = _attach(source)
+
+    try:
+        # Bytes behind end complete hits starting before it
+        stream = buffer[start:min(end + decode._bytesperhit - 1, length)]
+
+        offsets, _ = decode._find_hit_offsets(stream, reverse_bitorder)
+        offsets = offsets[offsets < end - start]
+
+        hits = stream[offsets[:, np.newaxis] + np.arange(decode._bytesperhit)]
+        del stream
+    except BaseException:
+        # The traceback still holds views, closing must not replace the error by a BufferError
+        Decode._close_buffer(handle, quiet=True)
+        raise
+
+    del buffer
+    Decode._close_buffer(handle)
+
+    if reverse_bitorder:
+        hits = BITREVERSE_LUT[hits]
+
+    return offsets + start, _decode_columns(decode, decoder)(hits)
+
+
+class ParallelDecode:
+    """
+    Decode a raw readout stream in chunks on several processes
+
+    Chunk boundaries are moved to the next header byte and every chunk is
+    searched independently. A hit of the previous chunk can reach into the next one
+    and hide headers there, so at the merge the search is repeated from the end of
+    the previous hit until it meets a hit the worker found. The result is identical
+    to hits_from_readoutstream() on the whole stream.
+
+    In scripts, create and use it under if __name__ == "__main__" for platforms
+    starting workers with spawn.
+    """
+
+    def __init__(self, decode: Decode = None, decoder: str = 'astropix2', workers: int = None,
+                 chunk_size: int = PARALLEL_CHUNK_SIZE, reverse_bitorder: bool = True) -> None:
+        """Init
+
+        :param decode: Decode instance, default 5 bytes per hit
+        :param decoder: 'astropix2' or 'astropix4'
+        :param workers: Number of processes, default number of CPUs
+        :param chunk_size: Bytes decoded per task
+        :param reverse_bitorder: Reverse Bitorder per byte
+        """
+        self._decode = decode if decode is not None else Decode()
+        self._decoder = decoder
+        self._workers = workers
+        self._chunk_size = max(chunk_size, REALIGN_SEARCH)
+        self._reverse_bitorder = reverse_bitorder
+
+        self._decode_columns = _decode_columns(self._decode, decoder)
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """Worker pool, started on first use"""
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self._workers)
+
+        return self._pool
+
+    def close(self) -> None:
+        """Stop worker processes"""
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def _header_lut(self) -> np.ndarray:
+        return self._decode._header_rev_lut if self._reverse_bitorder else self._decode._header_lut
+
+    def chunk_bounds(self, stream: np.ndarray) -> list:
+        """
+        Chunk boundaries, moved forward to the next header byte
+
+        :param stream: Readout stream as uint8 array
+
+        :returns: List of (start, end) tuples covering the stream
+        """
+        header_lut = self._header_lut()
+        length = len(stream)
+
+        bounds = [0]
+        for nominal in range(self._chunk_size, length, self._chunk_size):
+            headers = np.flatnonzero(header_lut[stream[nominal:nominal + REALIGN_SEARCH]])
+            boundary = nominal + int(headers[0]) if len(headers) else nominal
+
+            if boundary > bounds[-1] and boundary < length:
+                bounds.append(boundary)
+
+        bounds.append(length)
+
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _resync(self, stream: np.ndarray, position: int, end: int, offsets: np.ndarray) -> tuple:
+        """
+        Redo the hit search from position until it meets a hit found by the worker
+
+        :param stream: Readout stream as uint8 array
+        :param position: End of the last hit of the previous chunk
+        :param end: End of the chunk
+        :param offsets: Hit offsets found by the worker
+
+        :returns: Tuple with offsets found in front of the meeting point and index of that worker hit
+        """
+        bytesperhit = self._decode._bytesperhit
+        window = 64 * bytesperhit
+
+        while True:
+            stop = min(position + window, end)
+
+            found, _ = self._decode._find_hit_offsets(stream[position:min(stop + bytesperhit - 1, len(stream))],
+                                                      self._reverse_bitorder)
+            found = found[found < stop - position] + position
+
+            # Same hit taken by both searches, everything behind it matches too
+            index = np.searchsorted(offsets, found)
+            matched = index < len(offsets)
+            matched[matched] = offsets[index[matched]] == found[matched]
+            common = np.flatnonzero(matched)
+
+            if len(common):
+                first = common[0]
+                return found[:first], int(index[first])
+
+            if stop == end:
+                return found, len(offsets)
+
+            window *= 2
+
+    def _extract(self, stream: np.ndarray, offsets: np.ndarray) -> dict:
+        """Decode hits at offsets in the main process"""
+
+        hits = stream[offsets[:, np.newaxis] + np.arange(self._decode._bytesperhit)]
+
+        if self._reverse_bitorder:
+            hits = BITREVERSE_LUT[hits]
+
+        return self._decode_columns(hits)
+
+    def _decode_buffer(self, stream: np.ndarray, source: tuple) -> dict:
+        """Run chunks on the pool and merge them in stream order"""
+
+        length = len(stream)
+        bytesperhit = self._decode._bytesperhit
+        bounds = self.chunk_bounds(stream)
+
+        futures = [self.pool.submit(_decode_chunk, source, length, start, end, self._decode,
+                                    self._decoder, self._reverse_bitorder) for start, end in bounds]
+
+        parts = []
+        position = 0
+        resynced = 0
+
+        for (start, end), future in zip(bounds, futures):
+            offsets, columns = future.result()
+
+            # Last hit of the previous chunk reaches into this one
+            if position > start:
+                extra, first = self._resync(stream, position, end, offsets)
+                resynced += 1
+
+                if len(extra):
+                    parts.append(self._extract(stream, extra))
+
+                offsets = offsets[first:]
+                columns = {key: value[first:] for key, value in columns.items()}
+
+                if len(extra) and not len(offsets):
+                    position = int(extra[-1]) + bytesperhit
+
+            parts.append(columns)
+
+            if len(offsets):
+                position = int(offsets[-1]) + bytesperhit
+
+        logger.debug("Parallel decode: %d bytes in %d chunks, %d resynced", length, len(bounds), resynced)
+
+        return {key: np.concatenate([part[key] for part in parts]) for key in parts[0]}
+
+    def decode_columns(self, source) -> dict:
+        """
+        Decode a raw readout stream column-wise
+
+        :param source: Path of a raw readout file, mmap, memoryview or bytes-like
+
+        :returns: Dict with one array per field
+        """
+        with Decode._open_buffer(source) as (buffer, mapped):
+            stream = np.frombuffer(buffer, dtype=np.uint8)
+
+            if len(stream) <= self._chunk_size:
+                hits, _ = self._decode.split_readoutstream(stream, self._reverse_bitorder)
+                del stream
+                return self._decode_columns(hits)
+
+            # Files are mapped by the workers, other buffers are shared through shared memory
+            if mapped is not None:
+                try:
+                    return self._decode_buffer(stream, ('file', os.fspath(source)))
+                finally:
+                    del stream
+
+            shm = shared_memory.SharedMemory(create=True, size=len(stream))
+            try:
+                shared = np.ndarray(len(stream), dtype=np.uint8, buffer=shm.buf)
+                shared[:] = stream
+                del stream
+
+                columns = self._decode_buffer(shared, ('shm', shm.name))
+            except BaseException:
+                # The traceback still holds views, closing must not replace the error by a BufferError
+                Decode._close_buffer(shm, quiet=True)
+                raise
+            finally:
+                shm.unlink()
+
+            del shared
+            Decode._close_buffer(shm)
+
+            return columns
+
+    def decode(self, source) -> pd.DataFrame:
+        """
+        Decode a raw readout stream
+
+        :param source: Path of a raw readout file, mmap, memoryview or bytes-like
+
+        :returns: Dataframe with decoded hits
+        """
+        return pd.DataFrame(self.decode_columns(source))
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Created on Sun Oct 18 11:02:17 2026
+
+Streaming SPI readout with a background reader thread
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from modules.decode import Decode
+from modules.spi import SPI_IDLE_BYTES
+from modules.setup_logger import logger
+
+
+logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """Preallocated byte ring buffer for one producer and one consumer"""
+
+    def __init__(self, size: int) -> None:
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._size = size
+
+        self._head = 0      # total bytes written
+        self._tail = 0      # total bytes read
+
+        self._cond = threading.Condition()
+
+    @property
+    def size(self) -> int:
+        """Capacity in bytes"""
+        return self._size
+
+    @property
+    def used(self) -> int:
+        """Bytes waiting to be read"""
+        return self._head - self._tail
+
+    @property
+    def free(self) -> int:
+        """Bytes that can be written without blocking"""
+        return self._size - self.used
+
+    def write(self, data: bytes, timeout: float = None) -> bool:
+        """
+        Write data, block until enough space is free
+
+        :param data: Bytes to write
+        :param timeout: Max. time to wait for free space, None waits forever
+
+        :returns: False if data did not fit in time and was not written
+        """
+        length = len(data)
+
+        if length > self._size:
+            return False
+
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.free >= length, timeout):
+                return False
+
+            start = self._head % self._size
+            first = min(length, self._size - start)
+
+            self._view[start:start + first] = data[:first]
+            self._view[:length - first] = data[first:]
+
+            self._head += length
+            self._cond.notify_all()
+
+        return True
+
+    def read(self, num: int = None, timeout: float = None) -> bytes:
+        """
+        Read up to num bytes, block until data is available
+
+        :param num: Max. number of bytes, None reads everything available
+        :param timeout: Max. time to wait for data, None waits forever
+
+        :returns: Read bytes, empty if nothing arrived in time
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.used > 0, timeout):
+                return b''
+
+            length = self.used if num is None else min(num, self.used)
+
+            start = self._tail % self._size
+            first = min(length, self._size - start)
+
+            data = bytes(self._view[start:start + first]) + bytes(self._view[:length - first])
+
+            self._tail += length
+            self._cond.notify_all()
+
+        return data
+
+    def clear(self) -> None:
+        """Drop all buffered data"""
+        with self._cond:
+            self._tail = self._head
+            self._cond.notify_all()
+
+
+class FileSink:
+    """Write raw readout to a binary file"""
+
+    def __init__(self, filename: str) -> None:
+        self._file = open(filename, "wb")
+
+    def __call__(self, data: bytes) -> None:
+        self._file.write(data)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class DecodeSink:
+    """Collect decoded hits in memory, optionally forwarding every batch"""
+
+    def __init__(self, callback=None) -> None:
+        self._callback = callback
+        self._batches = []
+
+    def __call__(self, hits: pd.DataFrame) -> None:
+        self._batches.append(hits)
+
+        if self._callback is not None:
+            self._callback(hits)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """All collected hits in one DataFrame"""
+        if not self._batches:
+            return pd.DataFrame()
+
+        return pd.concat(self._batches, ignore_index=True)
+
+    def close(self) -> None:
+        pass
+
+
+class ReadoutStream:
+    """
+    Continuous SPI readout
+
+    A reader thread drains the SPI read register into a ring buffer,
+    decoding and sinks run in the consumer thread.
+    While the stream is running the FTDI handle must not be used by other threads,
+    wrap register accesses in paused().
+    """
+
+    def __init__(self, nexys, decode: Decode = None, decoder: str = 'astropix2',
+                 buffersize: int = 1 << 24, readsize: int = 4096,
+                 block_timeout: float = 0.1, skip_idle: bool = True, poll_interval: float = 0.001) -> None:
+        """Init
+
+        :param nexys: Nexysio instance with opened handle
+        :param decode: Decode instance, default 5 bytes per hit
+        :param decoder: 'astropix2' or 'astropix4'
+        :param buffersize: Ring buffer size in bytes
+        :param readsize: Bytes per SPI read
+        :param block_timeout: Max. time the reader waits for free buffer space before dropping a read
+        :param skip_idle: Do not buffer reads containing only idle bytes
+        :param poll_interval: Wait after a read containing only idle bytes in s
+        """
+
+        self._nexys = nexys
+        self._decode = decode if decode is not None else Decode()
+
+        if decoder == 'astropix4':
+            self._decode_hits = self._decode.decode_astropix4_hits
+        else:
+            self._decode_hits = self._decode.decode_astropix2_hits
+
+        self._ring = RingBuffer(buffersize)
+        self._readsize = readsize
+        self._block_timeout = block_timeout
+        self._skip_idle = skip_idle
+        self._poll_interval = poll_interval
+
+        self._raw_sinks = []
+        self._hit_sinks = []
+
+        self._carry = b''
+
+        self._thread = None
+        self._error = None
+        self._running = threading.Event()
+        self._paused = threading.Event()
+        self._idle = threading.Event()
+
+        self._bytes_read = 0
+        self._reads = 0
+        self._overflows = 0
+        self._overflow_bytes = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+        self.close()
+
+    @property
+    def running(self) -> bool:
+        """Reader thread is running"""
+        return self._running.is_set()
+
+    @property
+    def overflows(self) -> int:
+        """Number of reads dropped because the ring buffer was full"""
+        return self._overflows
+
+    @property
+    def overflow_bytes(self) -> int:
+        """Number of bytes dropped because the ring buffer was full"""
+        return self._overflow_bytes
+
+    @property
+    def bytes_read(self) -> int:
+        """Number of bytes read from the SPI read register"""
+        return self._bytes_read
+
+    @property
+    def buffered(self) -> int:
+        """Bytes waiting in the ring buffer"""
+        return self._ring.used
+
+    def add_sink(self, sink, decoded: bool = False) -> None:
+        """
+        Add sink to the consumer
+
+        :param sink: Callable, gets raw bytes or a DataFrame with decoded hits
+        :param decoded: Sink gets decoded hits instead of raw bytes
+        """
+        if decoded:
+            self._hit_sinks.append(sink)
+        else:
+            self._raw_sinks.append(sink)
+
+    def start(self) -> None:
+        """Start reader thread"""
+
+        if self.running:
+            return
+
+        self._error = None
+        self._running.set()
+        self._paused.clear()
+
+        self._thread = threading.Thread(target=self._reader, name='ReadoutStream', daemon=True)
+        self._thread.start()
+
+        logger.info("Readout stream started")
+
+    def stop(self) -> None:
+        """Stop reader thread, buffered data can still be consumed"""
+
+        if not self.running:
+            return
+
+        self._running.clear()
+        self._thread.join()
+        self._thread = None
+
+        logger.info("Readout stream stopped: %d bytes in %d reads, %d overflows (%d bytes dropped)",
+                    self._bytes_read, self._reads, self._overflows, self._overflow_bytes)
+
+    def close(self) -> None:
+        """Close all sinks"""
+
+        for sink in self._raw_sinks + self._hit_sinks:
+            if hasattr(sink, 'close'):
+                sink.close()
+
+    @contextmanager
+    def paused(self):
+        """Suspend the reader thread to access the FTDI handle from another thread"""
+
+        self._idle.clear()
+        self._paused.set()
+
+        if self.running:
+            self._idle.wait()
+
+        try:
+            yield
+        finally:
+            self._paused.clear()
+
+    def _reader(self) -> None:
+        """Reader thread: drain SPI read register into the ring buffer"""
+
+        try:
+            self._read_loop()
+        except Exception as exc:
+            # Stop the stream, the consumer raises the error once the buffer is drained
+            logger.error("Readout stream reader failed: %s", exc)
+            self._error = exc
+            self._running.clear()
+            self._idle.set()
+
+    def _raise_reader_error(self) -> None:
+        """Raise the exception that stopped the reader thread, only once"""
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _read_loop(self) -> None:
+        """Read until stopped, backpressure and idle filtering"""
+
+        while self._running.is_set():
+            if self._paused.is_set():
+                self._idle.set()
+                time.sleep(0.001)
+                continue
+
+            data = self._nexys.read_spi(self._readsize)
+
+            if not data:
+                time.sleep(self._poll_interval)
+                continue
+
+            self._reads += 1
+            self._bytes_read += len(data)
+
+            if data.count(data[0]) == len(data) and data[0] in SPI_IDLE_BYTES:
+                # FIFO empty, do not spin on the handle and the GIL
+                time.sleep(self._poll_interval)
+
+                if self._skip_idle:
+                    continue
+
+            # Backpressure: wait for the consumer, drop the read if it does not catch up
+            if not self._ring.write(data, self._block_timeout):
+                self._overflows += 1
+                self._overflow_bytes += len(data)
+                logger.warning("Readout ring buffer full, dropped %d bytes", len(data))
+
+    def read(self, num: int = None, timeout: float = None) -> bytes:
+        """
+        Read raw bytes from the ring buffer
+
+        :param num: Max. number of bytes
+        :param timeout: Max. time to wait for data
+
+        :returns: Raw readout bytes
+        """
+        data = self._ring.read(num, timeout)
+
+        if not data:
+            self._raise_reader_error()
+
+        for sink in self._raw_sinks:
+            sink(data)
+
+        return data
+
+    def poll(self, timeout: float = None) -> pd.DataFrame:
+        """
+        Decode everything buffered so far
+
+        Incomplete hits at the end are kept and completed with the next poll.
+
+        :param timeout: Max. time to wait for data
+
+        :returns: DataFrame with decoded hits, None if no data arrived
+        """
+        data = self.read(timeout=timeout)
+
+        if not data:
+            return None
+
+        stream = self._carry + data
+
+        hits, consumed = self._decode.split_readoutstream(stream)
+        self._carry = stream[consumed:]
+
+        decoded = self._decode_hits(hits)
+
+        for sink in self._hit_sinks:
+            sink(decoded)
+
+        return decoded
+
+    def batches(self, timeout: float = 1.0, duration: float = None):
+        """
+        Generator yielding batches of decoded hits
+
+        An exception of the reader thread is raised after the buffered data was yielded.
+
+        :param timeout: Max. time to wait for each batch, yields an empty batch on timeout
+        :param duration: Stop after duration in seconds, None runs until the stream is stopped
+
+        :returns: Generator of DataFrames
+        """
+        end = None if duration is None else time.monotonic() + duration
+
+        while self.running or self._ring.used:
+            if end is not None and time.monotonic() >= end:
+                return
+
+            decoded = self.poll(timeout)
+
+            if decoded is None:
+                decoded = self._decode_hits([])
+
+            yield decoded
+
+        self._raise_reader_error()
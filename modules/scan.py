@@ -3,11 +3,12 @@ from tqdm.auto import tqdm
 import numpy as np
 import logging
 import binascii
-import pandas as pd
 
 from modules.asic import Asic
 from modules.nexysio import Nexysio
 from modules.decode import Decode
+from modules.hitstore import HitStore
+from modules.spi import SPI_IDLE_BYTES
 from modules.setup_logger import logger
 
 logger = logging.getLogger(__name__)
@@ -18,6 +19,91 @@ class Scan(Asic, Nexysio):
     def __init__(self, handle=0) -> None:
         self._handle = handle
 
+    @staticmethod
+    def acquire(nexys, inj=None, timeout: float = 6.0, margin: float = 0.05, margin_fraction: float = 0.5,
+                poll_interval: float = 0.005) -> bytearray:
+        """
+        Read SPI FIFO while an injection burst runs
+
+        Returns as soon as the burst is over and the FIFO stayed empty for margin seconds.
+        The margin grows with the burst, so a patgen clock slower than inj.clock_hz does not cut off the last hits.
+        Without injection or with continuously running injection, data is collected for timeout seconds.
+        The deadline also ends the acquisition while data keeps arriving, e.g. from a hot pixel.
+
+        :param nexys: Nexysio with enabled SPI
+        :param inj: Started Injectionboard, None for noise runs
+        :param timeout: Acquisition time without known burst duration, max. drain time after the burst in s
+        :param margin: Min. time the FIFO has to stay empty after the burst in s
+        :param margin_fraction: Min. time the FIFO has to stay empty after the burst relative to the burst duration
+        :param poll_interval: FIFO poll interval while empty in s
+
+        :returns: Readout stream
+        """
+
+        start = time.monotonic()
+
+        duration = inj.burst_duration if inj is not None else None
+
+        if duration is not None:
+            margin = max(margin, margin_fraction * duration)
+            window_end = start + duration
+            deadline = window_end + timeout
+        else:
+            window_end = deadline = start + timeout
+
+        last_data = start
+
+        readout = bytearray()
+        idle = bytes(SPI_IDLE_BYTES)
+
+        while True:
+            data = nexys.read_spi_fifo(0, adaptive=True, timeout=max(deadline - time.monotonic(), 0))
+            now = time.monotonic()
+
+            has_data = bool(data.translate(None, idle))
+
+            if has_data:
+                readout.extend(data)
+                last_data = now
+
+            if now >= deadline:
+                if has_data and duration is not None:
+                    logger.warning("FIFO not drained %.1f s after injection burst", timeout)
+                break
+
+            if has_data:
+                continue
+
+            if now >= window_end and now - max(last_data, window_end) >= margin:
+                break
+
+            time.sleep(poll_interval)
+
+        logger.debug("Acquired %d bytes in %.3f s (burst %s s)", len(readout), time.monotonic() - start, duration)
+
+        return readout
+
+    @staticmethod
+    def capture_context(nexys, **context) -> None:
+        """Tag the next raw capture blocks with scan context, does nothing without active capture"""
+
+        if nexys.capture is not None:
+            nexys.capture.set_context(**context)
+
+    @staticmethod
+    def scan_metadata(method: str, kwargs: dict) -> dict:
+        """
+        File metadata of a scan: scan parameters merged with the run metadata passed as kwarg metadata
+
+        :param method: Name of the scan
+        :param kwargs: Scan kwargs
+
+        :returns: Metadata dict
+        """
+        params = {key: value for key, value in kwargs.items() if key != 'metadata'}
+
+        return {**kwargs.get('metadata', {}), 'scan': {'method': method, **params}}
+
     @staticmethod
     def inj_scan_old(asic, vboard, injboard, nexys, file, **kwargs):
 
@@ -36,109 +122,123 @@ class Scan(Asic, Nexysio):
         vboard_Vminus = kwargs.get('vboard_Vminus', 1)
         set_col = kwargs.get('col')
         set_row = kwargs.get('row')
+        capture = kwargs.get('capture')
 
         decode = Decode()
 
-        vboard.dacvalues = (8, [0, 0, vboard_VCasc2, vboard_BL, 0, 0, vboard_Vminus, vboard_Vth])
-        vboard.update_vb()
+        if capture is not None:
+            nexys.start_capture(capture)
 
-        df = pd.DataFrame(columns=['scan_col', 'scan_row', 'run', 'step', 'vinj', 'id',
-                                   'payload', 'location', 'col', 'timestamp', 'tot_total'])
+        try:
+            vboard.dacvalues = (8, [0, 0, vboard_VCasc2, vboard_BL, 0, 0, vboard_Vminus, vboard_Vth])
+            vboard.update_vb()
 
-        for col in tqdm(range(asic.num_cols), position=0, leave=False, desc='Column'):
+            with HitStore.create(['scan_col', 'scan_row', 'run', 'step', 'vinj', 'id',
+                                  'payload', 'location', 'col', 'timestamp', 'tot_total'], file,
+                                 dtypes={'vinj': np.float64},
+                                 metadata=Scan.scan_metadata('inj_scan_old', kwargs)) as store:
 
-            if 'col' in kwargs and set_col != col:
-                continue
+                for col in tqdm(range(asic.num_cols), position=0, leave=False, desc='Column'):
 
-            asic.reset_recconfig()
-            asic.enable_ampout_col(col)  # enable ampout for current col
+                    if 'col' in kwargs and set_col != col:
+                        continue
 
-            if not noise_run:
-                asic.enable_inj_col(col)
+                    asic.reset_recconfig()
+                    asic.enable_ampout_col(col)  # enable ampout for current col
 
-            for row in tqdm(range(asic.num_rows), position=1, leave=False, desc='Row   '):
+                    if not noise_run:
+                        asic.enable_inj_col(col)
 
-                if 'row' in kwargs and set_row != row:
-                    continue
+                    for row in tqdm(range(asic.num_rows), position=1, leave=False, desc='Row   '):
 
-                if not noise_run:
-                    asic.enable_inj_row(row)
+                        if 'row' in kwargs and set_row != row:
+                            continue
 
-                asic.enable_pixel(col, row)
-                asic.update_asic()
+                        if not noise_run:
+                            asic.enable_inj_row(row)
 
-                average_per_step = np.zeros(steps)
+                        asic.enable_pixel(col, row)
+                        asic.update_asic()
 
-                for step in tqdm(range(steps), position=2, leave=False, desc='Step  '):
+                        average_per_step = np.zeros(steps)
 
-                    if up:
-                        injboard.amplitude = vinj_start + stepsize * step
-                    else:
-                        injboard.amplitude = vinj_stop - stepsize * step
+                        for step in tqdm(range(steps), position=2, leave=False, desc='Step  '):
 
-                    injboard.update_inj_amplitude()
+                            if up:
+                                injboard.amplitude = vinj_start + stepsize * step
+                            else:
+                                injboard.amplitude = vinj_stop - stepsize * step
 
-                    nexys.spi_reset()
-                    if asic.chipversion == 2:
-                        nexys.chip_reset()
-                    time.sleep(0.1)
+                            injboard.update_inj_amplitude()
 
-                    hit_per_iter = np.zeros(counts)
+                            nexys.spi_reset()
+                            if asic.chipversion == 2:
+                                nexys.chip_reset()
+                            time.sleep(0.1)
 
-                    for count in tqdm(range(counts), position=3, leave=False, desc='Count '):
-                        if up:
-                            tqdm.write(f"Pixel Col: {col} Row: {row} Vinj: {vinj_start+stepsize*step} Run: {count}")
-                            logger.info("Pixel Col: %d Row: %d Vth: %f Run: %d", col, row,
-                                        vinj_start + stepsize * step, count)
-                        else:
-                            tqdm.write(f"Pixel Col: {col} Row: {row} Vinj: {vinj_stop-stepsize*step} Run: {count}")
-                            logger.info("Pixel Col: %d Row: %d Vth: %f Run: %d", col, row,
-                                        vinj_stop - stepsize * step, count)
+                            hit_per_iter = np.zeros(counts)
 
-                        if not (noise_run):
-                            injboard.start()
-                            time.sleep(2)
-                            injboard.stop()
+                            for count in tqdm(range(counts), position=3, leave=False, desc='Count '):
+                                if up:
+                                    tqdm.write(f"Pixel Col: {col} Row: {row} Vinj: {vinj_start+stepsize*step} Run: {count}")
+                                    logger.info("Pixel Col: %d Row: %d Vth: %f Run: %d", col, row,
+                                                vinj_start + stepsize * step, count)
+                                else:
+                                    tqdm.write(f"Pixel Col: {col} Row: {row} Vinj: {vinj_stop-stepsize*step} Run: {count}")
+                                    logger.info("Pixel Col: %d Row: %d Vth: %f Run: %d", col, row,
+                                                vinj_stop - stepsize * step, count)
 
-                        readout = nexys.read_spi_fifo(20)
-                        nexys.spi_reset()
+                                Scan.capture_context(nexys, scan_col=col, scan_row=row, step=step, count=count)
 
-                        logger.debug('%s', binascii.hexlify(readout))
+                                if not (noise_run):
+                                    injboard.start()
+                                    readout = Scan.acquire(nexys, injboard, timeout=2)
+                                    injboard.stop()
+                                else:
+                                    readout = nexys.read_spi_fifo(20)
 
-                        # Decode
-                        list_hits = decode.hits_from_readoutstream(readout)
-                        decoded = decode.decode_astropix2_hits(list_hits)
-                        print(decoded.to_string())
-                        decoded = decoded.assign(scan_row=row, scan_col=col,
-                                                 run=count, step=step, vinj=injboard.amplitude)
-                        print(decoded.to_string())
+                                nexys.spi_reset()
 
-                        df = pd.concat([df, decoded], axis=0, ignore_index=True)[df.columns]
+                                logger.debug('%s', binascii.hexlify(readout))
 
-                        tqdm.write('\x1b[0;31;40m{} Hits found!\x1b[0m'.format((len(list_hits))))
-                        logger.info("%d Hits found!", len(list_hits))
+                                # Decode
+                                list_hits = decode.hits_from_readoutstream(readout)
+                                decoded = decode.decode_astropix2_hits(list_hits)
+                                print(decoded.to_string())
+                                decoded = decoded.assign(scan_row=row, scan_col=col,
+                                                         run=count, step=step, vinj=injboard.amplitude)
+                                print(decoded.to_string())
 
-                        hit_per_iter[count] = len(list_hits)
+                                store.append(decoded)
 
-                    mean_hits_per_iter = np.mean(hit_per_iter)
+                                tqdm.write('\x1b[0;31;40m{} Hits found!\x1b[0m'.format((len(list_hits))))
+                                logger.info("%d Hits found!", len(list_hits))
 
-                    logger.debug("average: %f", mean_hits_per_iter)
-                    average_per_step[step] = mean_hits_per_iter
+                                hit_per_iter[count] = len(list_hits)
 
-                    if mean_hits_per_iter <= th_up and up:
-                        logger.debug("Break: avg. hits 0")
-                        # break
-                    elif mean_hits_per_iter >= th_down and not up:
-                        logger.debug("Break: avg. hits > %f", th_down)
-                        # break
+                            mean_hits_per_iter = np.mean(hit_per_iter)
 
-                asic.disable_pixel(col, row)
-                logger.info("avg. Hits per step %f", average_per_step)
+                            logger.debug("average: %f", mean_hits_per_iter)
+                            average_per_step[step] = mean_hits_per_iter
 
-                asic.disable_pixel(col, row)
+                            if mean_hits_per_iter <= th_up and up:
+                                logger.debug("Break: avg. hits 0")
+                                # break
+                            elif mean_hits_per_iter >= th_down and not up:
+                                logger.debug("Break: avg. hits > %f", th_down)
+                                # break
 
-        df.index.name = 'index'
-        df.to_csv(file, mode='a')
+                        asic.disable_pixel(col, row)
+                        logger.info("avg. Hits per step %f", average_per_step)
+
+                        asic.disable_pixel(col, row)
+
+                        # Hits of finished pixels are on disk
+                        store.flush()
+
+        finally:
+            if capture is not None:
+                nexys.stop_capture()
 
     @staticmethod
     def scan_binsearch(asic, vboard, inj, nexys, file, **kwargs):
@@ -160,6 +260,8 @@ class Scan(Asic, Nexysio):
         inj_pulses = kwargs.get('inj_pulses', 100)
         v_vdda = kwargs.get('v_vdda', 1.8)
         v_vdd33 = kwargs.get('v_vdd33', 2.8)
+        acq_timeout = kwargs.get('acq_timeout', 6)
+        capture = kwargs.get('capture')
 
         inj.pulsesperset = inj_pulses
         inj.cycle = 1
@@ -167,130 +269,135 @@ class Scan(Asic, Nexysio):
 
         decode = Decode()
 
-        if inj.onchip:
-            asic.set_internal_vdac('thpix', vboard_Vth, v_vdda)
-            asic.set_internal_vdac('thpmos', vboard_Vthpmos, v_vdda)
-            asic.set_internal_vdac('vinj', vinj_thscan, v_vdda)
-        else:
-            vboard.dacvalues = (8, [vboard_Vthpmos, 0, vboard_VCasc2, vboard_BL, 0, 0, vboard_Vminus, vboard_Vth])
-            vboard.vsupply = v_vdd33
-            vboard.update_vb()
-
-        readout = bytearray()
-
-        df = pd.DataFrame(columns=['scan_col', 'scan_row', 'run', 'step', 'vinj', 'vth',
-                                   'id', 'payload', 'location', 'col', 'timestamp', 'tot_total'])
+        if capture is not None:
+            nexys.start_capture(capture)
 
-        for col in tqdm(range(asic.num_cols), position=0, leave=False, desc='Column'):
-            if 'col' in kwargs and set_col != col and set_col is not None:
-                continue
-
-            for row in tqdm(range(asic.num_rows), position=1, leave=False, desc='Row   '):
-                if 'row' in kwargs and set_row != row and set_row is not None:
-                    continue
-
-                asic.reset_recconfig()
-
-                if not noise_run:
-                    asic.set_inj_row(row, True)
-                    asic.set_inj_col(col, True)
-
-                asic.enable_ampout_col(col)  # enable ampout for current col
-                asic.set_pixel_comparator(col, row, True)
-                asic.update_asic()
-
-                step = 1
-
-                start_temp = v_start
-                stop_temp = v_stop
-
-                measure_at_zero = True
-
-                while (stop_temp - start_temp) >= precision:
-
-                    if measure_at_zero:
-                        if scan_method == 'injection':
-                            v_bin = 0.0  # Additional point at min
-                        elif scan_method == 'threshold':
-                            v_bin = v_stop  # Additional point at max
-                    else:
-                        v_bin = np.round((start_temp + stop_temp) / 2, 4)
-
-                    if scan_method == 'injection':
-                        if inj.onchip:
-                            asic.set_internal_vdac('vinj', v_bin, v_vdda)
-                        else:
-                            inj.amplitude = v_bin
-                    elif scan_method == 'threshold':
-                        if inj.onchip:
-                            asic.set_internal_vdac('thpix', v_bin + vboard_BL, v_vdda)
-                            asic.set_internal_vdac('thpmos', v_bin + vboard_BL, v_vdda)
-                            asic.update()
-                        else:
-                            vboard.dacvalues = (8, [v_bin + vboard_BL,
-                                                    0,
-                                                    vboard_VCasc2,
-                                                    vboard_BL,
-                                                    0,
-                                                    0,
-                                                    vboard_Vminus,
-                                                    v_bin + vboard_BL])
-                            vboard.update_vb()
-
-                    inj.stop()
-                    nexys.spi_reset_fpga_readout()
-
-                    hit_per_iter = np.zeros(counts)
-
-                    for count in tqdm(range(counts), position=2, leave=False, desc='Count '):
-                        tqdm.write(f"Pixel({col}, {row}) Vinj: {inj.amplitude} Vth: {vboard.dacvalues[7]} Run: {count}")
-                        logger.info("Pixel Col: %d Row: %d Vinj: %f Vth: %f Run: %d",
-                                    col, row, inj.amplitude, vboard.dacvalues[7], count)
+        try:
+            if inj.onchip:
+                asic.set_internal_vdac('thpix', vboard_Vth, v_vdda)
+                asic.set_internal_vdac('thpmos', vboard_Vthpmos, v_vdda)
+                asic.set_internal_vdac('vinj', vinj_thscan, v_vdda)
+            else:
+                vboard.dacvalues = (8, [vboard_Vthpmos, 0, vboard_VCasc2, vboard_BL, 0, 0, vboard_Vminus, vboard_Vth])
+                vboard.vsupply = v_vdd33
+                vboard.update_vb()
 
-                        if not noise_run:
-                            inj.start()
+            readout = bytearray()
 
-                        time.sleep(6)  # TODO: adapt to injection settings
+            with HitStore.create(['scan_col', 'scan_row', 'run', 'step', 'vinj', 'vth',
+                                  'id', 'payload', 'location', 'col', 'timestamp', 'tot_total'], file,
+                                 dtypes={'vinj': np.float64, 'vth': np.float64},
+                                 metadata=Scan.scan_metadata('scan_binsearch', kwargs)) as store:
 
-                        readout = nexys.read_spi_fifo(100)
+                for col in tqdm(range(asic.num_cols), position=0, leave=False, desc='Column'):
+                    if 'col' in kwargs and set_col != col and set_col is not None:
+                        continue
 
-                        logger.debug('%s', binascii.hexlify(readout))
+                    for row in tqdm(range(asic.num_rows), position=1, leave=False, desc='Row   '):
+                        if 'row' in kwargs and set_row != row and set_row is not None:
+                            continue
 
-                        # Decode
-                        list_hits = decode.hits_from_readoutstream(readout)
-                        decoded = decode.decode_astropix2_hits(list_hits)
-                        decoded = decoded.assign(scan_row=row, scan_col=col,
-                                                 run=count, step=step, vinj=inj.amplitude, vth=vboard.dacvalues[7])
-                        print(decoded.to_string())
+                        # Only current pixel enabled, ampout for current col
+                        asic.select_pixel(col, row, inj=not noise_run)
+                        asic.update_asic()
 
-                        df = pd.concat([df, decoded], axis=0, ignore_index=True)[df.columns]
+                        step = 1
 
-                        tqdm.write('\x1b[0;31;40m{} Hits found!\x1b[0m'.format((len(list_hits))))
-                        logger.info("%d Hits found!", len(list_hits))
+                        start_temp = v_start
+                        stop_temp = v_stop
 
-                        hit_per_iter[count] = len(list_hits)
+                        measure_at_zero = True
 
-                    mean_hits_per_iter = np.mean(hit_per_iter)
-                    tqdm.write('\x1b[0;31;40m{} Average Hits found!\x1b[0m'.format(mean_hits_per_iter))
+                        while (stop_temp - start_temp) >= precision:
 
-                    logger.debug("average: %f", mean_hits_per_iter)
-
-                    # bin search
-                    if not measure_at_zero:
-                        if scan_method == 'injection':
-                            if mean_hits_per_iter / 2 < inj_pulses / 2:
-                                start_temp = v_bin
-                            else:
-                                stop_temp = v_bin
-                        elif scan_method == 'threshold':
-                            if mean_hits_per_iter / 2 > inj_pulses / 2:
-                                start_temp = v_bin
+                            if measure_at_zero:
+                                if scan_method == 'injection':
+                                    v_bin = 0.0  # Additional point at min
+                                elif scan_method == 'threshold':
+                                    v_bin = v_stop  # Additional point at max
                             else:
-                                stop_temp = v_bin
-
-                    measure_at_zero = False
-
-                    step += 1
-
-        df.index.name = 'index'
-        df.to_csv(file, mode='a')
+                                v_bin = np.round((start_temp + stop_temp) / 2, 4)
+
+                            if scan_method == 'injection':
+                                if inj.onchip:
+                                    asic.set_internal_vdac('vinj', v_bin, v_vdda)
+                                else:
+                                    inj.amplitude = v_bin
+                            elif scan_method == 'threshold':
+                                if inj.onchip:
+                                    asic.set_internal_vdac('thpix', v_bin + vboard_BL, v_vdda)
+                                    asic.set_internal_vdac('thpmos', v_bin + vboard_BL, v_vdda)
+                                    asic.update()
+                                else:
+                                    vboard.dacvalues = (8, [v_bin + vboard_BL,
+                                                            0,
+                                                            vboard_VCasc2,
+                                                            vboard_BL,
+                                                            0,
+                                                            0,
+                                                            vboard_Vminus,
+                                                            v_bin + vboard_BL])
+                                    vboard.update_vb()
+
+                            inj.stop()
+                            nexys.spi_reset_fpga_readout()
+
+                            hit_per_iter = np.zeros(counts)
+
+                            for count in tqdm(range(counts), position=2, leave=False, desc='Count '):
+                                tqdm.write(f"Pixel({col}, {row}) Vinj: {inj.amplitude} Vth: {vboard.dacvalues[7]} Run: {count}")
+                                logger.info("Pixel Col: %d Row: %d Vinj: %f Vth: %f Run: %d",
+                                            col, row, inj.amplitude, vboard.dacvalues[7], count)
+
+                                Scan.capture_context(nexys, scan_col=col, scan_row=row, step=step, count=count)
+
+                                if not noise_run:
+                                    inj.start()
+
+                                # Wait for the injection burst and drain the FIFO
+                                readout = Scan.acquire(nexys, None if noise_run else inj, timeout=acq_timeout)
+
+                                logger.debug('%s', binascii.hexlify(readout))
+
+                                # Decode
+                                list_hits = decode.hits_from_readoutstream(readout)
+                                decoded = decode.decode_astropix2_hits(list_hits)
+                                decoded = decoded.assign(scan_row=row, scan_col=col,
+                                                         run=count, step=step, vinj=inj.amplitude, vth=vboard.dacvalues[7])
+                                print(decoded.to_string())
+
+                                store.append(decoded)
+
+                                tqdm.write('\x1b[0;31;40m{} Hits found!\x1b[0m'.format((len(list_hits))))
+                                logger.info("%d Hits found!", len(list_hits))
+
+                                hit_per_iter[count] = len(list_hits)
+
+                            mean_hits_per_iter = np.mean(hit_per_iter)
+                            tqdm.write('\x1b[0;31;40m{} Average Hits found!\x1b[0m'.format(mean_hits_per_iter))
+
+                            logger.debug("average: %f", mean_hits_per_iter)
+
+                            # bin search
+                            if not measure_at_zero:
+                                if scan_method == 'injection':
+                                    if mean_hits_per_iter / 2 < inj_pulses / 2:
+                                        start_temp = v_bin
+                                    else:
+                                        stop_temp = v_bin
+                                elif scan_method == 'threshold':
+                                    if mean_hits_per_iter / 2 > inj_pulses / 2:
+                                        start_temp = v_bin
+                                    else:
+                                        stop_temp = v_bin
+
+                            measure_at_zero = False
+
+                            step += 1
+
+                        # Hits of finished pixels are on disk
+                        store.flush()
+
+        finally:
+            if capture is not None:
+                nexys.stop_capture()
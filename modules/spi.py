@@ -6,7 +6,12 @@ Created on Tue Jul 12 20:07:13 2021
 @author: Nicolas Striebig
 """
 import logging
+import time
 
+import numpy as np
+
+from modules.bitorder import bit_array, reverse_bits_inplace
+from modules.capture import CaptureWriter
 from modules.setup_logger import logger
 
 
@@ -40,6 +45,17 @@ SPI_READ_FIFO_FULL   = 0b1 << 5
 SPI_READBACK_ENABLE  = 0b1 << 6
 SPI_MODULE_RESET     = 0b1 << 7
 
+# Readout
+SPI_IDLE_BYTES       = (0x00, 0xFF)     # Padding returned when the read FIFO runs empty
+SPI_READ_SIZE        = 4096
+SPI_READ_SIZE_MIN    = 512
+SPI_READ_SIZE_MAX    = 65535            # 16 bit read length
+SPI_DRAIN_MAX_BYTES  = 1 << 20          # Bound of one adaptive drain under steady hits
+SPI_DRAIN_TIMEOUT    = 0.5              # s
+
+# Bytes the FPGA write FIFO accepts when empty
+SPI_WRITE_FIFO_SIZE  = 8191
+
 logger = logging.getLogger(__name__)
 
 
@@ -61,6 +77,15 @@ class Spi:
     | SPI_Write Register 23
     | SPI_Read Register 24
     """
+    # Adaptive FIFO drain state, kept between read_spi_fifo() calls
+    _fifo_readsize = SPI_READ_SIZE
+    _fifo_fill_rate = 0.0
+    _fifo_last_empty = None
+    _fifo_read_stats = None
+
+    # Raw capture of FIFO reads
+    _capture = None
+
     def __init__(self):
         self._spi_clkdiv = 16
 
@@ -83,7 +108,7 @@ class Spi:
         """
         Write ASIC config via SPI
 
-        :param value: Bytearray vector
+        :param value: BitArray, bool array or bytes with one bit per byte
         :param load: Load signal
         :param n_load: Length of load signal
 
@@ -93,31 +118,25 @@ class Spi:
         :returns: SPI ASIC config pattern
         """
 
-        # Number of Bytes to write
-        length = len(value) * 5 + 4
+        bits = bit_array(value)
 
         logger.info("SPI Write Asic Config\n")
-        logger.debug("Length: %d\n Data (%db): %s\n", length, len(value), value)
 
-        # Write SPI SR Command to set MUX
-        if broadcast:
-            data = bytearray([SPI_SR_BROADCAST])
-        else:
-            data = bytearray([SPI_HEADER_SR | chipid])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Data (%db): %s\n", len(bits), value)
 
-        # data
-        for bit in value:
+        # SPI SR Command to set MUX, one command byte per bit, load signal and empty bytes
+        tail = 2 * n_load if load else 0
 
-            sin = SPI_SR_BIT1 if bit == 1 else SPI_SR_BIT0
+        data = bytearray(1 + len(bits) + tail)
+        view = np.frombuffer(data, dtype=np.uint8)
 
-            data.append(sin)
+        view[0] = SPI_SR_BROADCAST if broadcast else SPI_HEADER_SR | chipid
+        view[1:1 + len(bits)] = np.where(bits, SPI_SR_BIT1, SPI_SR_BIT0)
 
-        # Append Load signal and empty bytes
         if load:
-
-            data.extend([SPI_SR_LOAD] * n_load)
-
-            data.extend([SPI_EMPTY_BYTE] * n_load)
+            view[1 + len(bits):1 + len(bits) + n_load] = SPI_SR_LOAD
+            view[1 + len(bits) + n_load:] = SPI_EMPTY_BYTE
 
         return data
 
@@ -167,19 +186,15 @@ class Spi:
 
         reset_bits = [0, 3]
 
-        for bit in reset_bits:
-
-            configregister = self.get_spi_config()
-
-            # Set Reset bits 1
-            configregister = self.set_bit(configregister, bit)
-            self.write_register(SPI_CONFIG_REG, configregister, True)
+        configregister = self.get_spi_config()
 
-            configregister = self.get_spi_config()
+        with self.transaction() as transaction:
+            for bit in reset_bits:
+                # Set Reset bits 1
+                transaction.write_register(SPI_CONFIG_REG, self.set_bit(configregister, bit))
 
-            # Set Reset bits and readback bit 0
-            configregister = self.clear_bit(configregister, bit)
-            self.write_register(SPI_CONFIG_REG, configregister, True)
+                # Set Reset bits and readback bit 0
+                transaction.write_register(SPI_CONFIG_REG, self.clear_bit(configregister, bit))
 
     def sr_readback_reset(self) -> None:
         """
@@ -190,19 +205,15 @@ class Spi:
 
         reset_bits = [0]
 
-        for bit in reset_bits:
-
-            configregister = self.get_sr_readback_config()
-
-            # Set Reset bits 1
-            configregister = self.set_bit(configregister, bit)
-            self.write_register(SPI_READBACK_REG_CONF, configregister, True)
+        configregister = self.get_sr_readback_config()
 
-            configregister = self.get_sr_readback_config()
+        with self.transaction() as transaction:
+            for bit in reset_bits:
+                # Set Reset bits 1
+                transaction.write_register(SPI_READBACK_REG_CONF, self.set_bit(configregister, bit))
 
-            # Set Reset bits and readback bit 0
-            configregister = self.clear_bit(configregister, bit)
-            self.write_register(SPI_READBACK_REG_CONF, configregister, True)
+                # Set Reset bits and readback bit 0
+                transaction.write_register(SPI_READBACK_REG_CONF, self.clear_bit(configregister, bit))
 
     def direct_write_spi(self, data: bytes) -> None:
         """
@@ -238,25 +249,182 @@ class Spi:
         """ Continous readout """
         pass
 
-    def read_spi_fifo(self, max_reads: int = 1) -> bytearray:
+    def read_spi_fifo(self, max_reads: int = 1, adaptive: bool = False,
+                      max_bytes: int = SPI_DRAIN_MAX_BYTES, timeout: float = SPI_DRAIN_TIMEOUT) -> bytearray:
         """ Read Data from SPI FIFO until empty
 
-        :param max_reads: Max read cycles
+        In adaptive mode the read size follows the observed FIFO fill rate
+        and the status register is only polled after a short read.
+
+        :param max_reads: Max read cycles, 0 reads until empty in adaptive mode
+        :param adaptive: Adaptive read size and status polling
+        :param max_bytes: Adaptive mode returns after reading this many bytes
+        :param timeout: Adaptive mode returns after this time in s, even if the FIFO never ran empty
 
         :returns: SPI read stream
         """
 
+        if adaptive:
+            return self._read_spi_fifo_adaptive(max_reads, max_bytes, timeout)
+
         read_stream = bytearray()
         readcount = 0
+        polls = 0
 
-        while not (self.get_spi_config() & SPI_READ_FIFO_EMPTY) and readcount < max_reads:
-            readbuffer = self.read_spi(4096)
+        while readcount < max_reads:
+            polls += 1
+            if self.get_spi_config() & SPI_READ_FIFO_EMPTY:
+                break
+
+            readbuffer = self.read_spi(SPI_READ_SIZE)
             read_stream.extend(readbuffer)
 
             readcount += 1
 
+        self._update_fifo_read_stats(len(read_stream), readcount, polls, SPI_READ_SIZE)
+        self._capture_readout(read_stream)
+
+        return read_stream
+
+    @staticmethod
+    def _fifo_readsize_for(nbytes: float) -> int:
+        """Power of two read size for an expected number of bytes"""
+
+        return min(max(1 << int(nbytes).bit_length(), SPI_READ_SIZE_MIN), SPI_READ_SIZE_MAX)
+
+    def _read_spi_fifo_adaptive(self, max_reads: int = 0, max_bytes: int = SPI_DRAIN_MAX_BYTES,
+                                timeout: float = SPI_DRAIN_TIMEOUT) -> bytearray:
+        """
+        Drain SPI FIFO with reads sized from the fill rate
+
+        A read that comes back without idle padding means the FIFO held more data,
+        so the next read is doubled. A read ending in padding suggests an empty FIFO,
+        only then the status register is checked. The fill rate is estimated from
+        the data drained between two empty FIFOs and sizes the first read of the next call.
+
+        Under steady hits the FIFO may never run empty, the drain then stops
+        after max_bytes or timeout and returns what was read so far.
+
+        :param max_reads: Max read cycles, 0 for no limit
+        :param max_bytes: Max bytes to read, 0 for no limit
+        :param timeout: Max drain time in s, None for no limit
+
+        :returns: SPI read stream
+        """
+
+        read_stream = bytearray()
+        readcount = 0
+        polls = 0
+        valid_total = 0
+
+        start = time.monotonic()
+        readsize = self._fifo_readsize
+
+        if self._fifo_fill_rate and self._fifo_last_empty:
+            readsize = self._fifo_readsize_for(self._fifo_fill_rate * (start - self._fifo_last_empty))
+
+        while True:
+            readbuffer = self.read_spi(readsize)
+            read_stream.extend(readbuffer)
+            readcount += 1
+
+            # Strip idle padding at the end of the read
+            valid = len(readbuffer)
+            if valid and readbuffer[-1] in SPI_IDLE_BYTES:
+                valid = len(readbuffer.rstrip(bytes([readbuffer[-1]])))
+
+            valid_total += valid
+
+            if max_reads and readcount >= max_reads:
+                break
+
+            if max_bytes and len(read_stream) >= max_bytes:
+                logger.debug("SPI FIFO drain stopped after %d bytes", len(read_stream))
+                break
+
+            if timeout is not None and time.monotonic() - start >= timeout:
+                logger.debug("SPI FIFO drain stopped after %.3f s", timeout)
+                break
+
+            if valid == len(readbuffer):
+                # Full read, FIFO probably holds more
+                readsize = min(2 * readsize, SPI_READ_SIZE_MAX)
+                continue
+
+            polls += 1
+            if self.get_spi_config() & SPI_READ_FIFO_EMPTY:
+                now = time.monotonic()
+
+                if self._fifo_last_empty:
+                    rate = valid_total / (now - self._fifo_last_empty)
+                    self._fifo_fill_rate = 0.5 * (self._fifo_fill_rate + rate) if self._fifo_fill_rate else rate
+
+                self._fifo_last_empty = now
+                break
+
+            # Data arrived meanwhile, expect what the fill rate delivers during this call
+            readsize = self._fifo_readsize_for(self._fifo_fill_rate * (time.monotonic() - start))
+
+        self._fifo_readsize = readsize
+
+        self._update_fifo_read_stats(len(read_stream), readcount, polls, readsize)
+        self._capture_readout(read_stream)
+
         return read_stream
 
+    def _update_fifo_read_stats(self, nbytes: int, reads: int, polls: int, readsize: int) -> None:
+        self._fifo_read_stats = {
+            'bytes': nbytes,
+            'reads': reads,
+            'polls': polls,
+            'roundtrips': reads + polls,
+            'readsize': readsize,
+            'fill_rate': self._fifo_fill_rate,
+        }
+
+        logger.debug("SPI FIFO: read %d bytes in %d round-trips (%d reads, %d polls)",
+                     nbytes, reads + polls, reads, polls)
+
+    @property
+    def fifo_read_stats(self) -> dict:
+        """Bytes and USB round-trips used by the last read_spi_fifo() call"""
+
+        return self._fifo_read_stats
+
+    @property
+    def capture(self) -> CaptureWriter:
+        """Active raw capture, None if not capturing"""
+
+        return self._capture
+
+    def start_capture(self, filename: str) -> CaptureWriter:
+        """
+        Write every read_spi_fifo() result containing data to a raw capture file
+
+        Set the block context with capture.set_context(), e.g. scan pixel and step.
+
+        :param filename: Capture file
+
+        :returns: CaptureWriter
+        """
+        self.stop_capture()
+        self._capture = CaptureWriter(filename)
+
+        return self._capture
+
+    def stop_capture(self) -> None:
+        """Close raw capture"""
+
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+
+    def _capture_readout(self, read_stream: bytearray) -> None:
+        """Write FIFO read to the raw capture, reads with only idle bytes are skipped"""
+
+        if self._capture is not None and read_stream.translate(None, bytes(SPI_IDLE_BYTES)):
+            self._capture.write(read_stream)
+
     def write_spi_bytes(self, n_bytes: int) -> None:
         """
         Write to SPI for readout
@@ -269,7 +437,7 @@ class Spi:
             logger.warning("Cannot write more than 64000 Bytes")
 
         logger.info("SPI: Write %d Bytes", 8 * n_bytes + 4)
-        self.write_spi(bytearray([SPI_HEADER_EMPTY] * n_bytes * 8), False, 8191)
+        self.write_spi(bytearray([SPI_HEADER_EMPTY] * n_bytes * 8), False, SPI_WRITE_FIFO_SIZE)
 
     def send_routing_cmd(self) -> None:
         """
@@ -279,29 +447,32 @@ class Spi:
         logger.info("SPI: Send routing cmd")
         self.write_spi(bytearray([SPI_HEADER_EMPTY, 0, 0, 0, 0, 0, 0, 0]), False)
 
-    def write_spi(self, data: bytearray, MSBfirst: bool = True) -> None:
+    def write_spi(self, data: bytearray, MSBfirst: bool = True, buffersize: int = SPI_WRITE_FIFO_SIZE) -> None:
         """
         Write to Nexys SPI Write FIFO
 
+        Data is sent in chunks of buffersize bytes,
+        the FIFO state is only polled before each chunk until the FIFO is empty.
+
         :param data: Bytearray vector
         :param MSBfirst: SPI MSB first
-        :param buffersize: Buffersize
+        :param buffersize: Bytes per chunk, limited to the write FIFO size
         """
 
         if not MSBfirst:
-            for index in range(len(data)):
-                data[index] = int(format(data[index], '08b')[::-1], 2)
+            reverse_bits_inplace(data)
+
+        buffersize = min(max(buffersize, 1), SPI_WRITE_FIFO_SIZE)
 
-        logger.debug('SPIdata: %s', data)
+        view = memoryview(data)
+        polls = 0
 
-        i = 0
+        for i in range(0, len(view), buffersize):
+            # Wait until WrFIFO is Empty, previous chunk has been shifted out
+            polls += 1
+            while not self.get_spi_config() & SPI_WRITE_FIFO_EMPTY:
+                polls += 1
 
-        # Wait until WrFIFO is Empty
-        while not self.get_spi_config() & SPI_WRITE_FIFO_EMPTY:
-            continue
+            self.direct_write_spi(view[i:i + buffersize])
 
-        while i < len(data):
-            if not self.get_spi_config() & SPI_WRITE_FIFO_FULL:
-                self.direct_write_spi(bytes(bytearray(data[i:(i + 16)])))
-                logger.debug('Write SPI bytes %d:%d', i, i + 16)
-                i += 16
+        logger.debug('Write SPI %d bytes in chunks of %d, %d status polls', len(view), buffersize, polls)
@@ -5,10 +5,15 @@ Created on Fri Jun 25 16:28:27 2021
 
 @author: Nicolas Striebig
 """
+import numpy as np
 from bitstring import BitArray
 
 from modules.nexysio import Nexysio
 
+VB_ADRESS   = 12
+VB_CLKDIV   = 8
+VB_DACBITS  = 14
+
 
 class Voltageboard(Nexysio):
     """Configure GECCO Voltageboard"""
@@ -26,30 +31,43 @@ class Voltageboard(Nexysio):
         self.pos = pos
         self.dacvalues = dacvalues
 
-    def __vb_vector(self, pos: int, dacs: list[float]) -> BitArray:
-        """Generate VB bitvector from position and dacvalues
+    def __dac_codes(self, dacs: list[float]) -> tuple:
+        """Quantize DAC voltages to 14bit DAC codes, in the order they are shifted out
 
-        :param pos: Card slot
         :param dacs: List with DAC values
 
-        :returns: Voltageboard config vector
+        :returns: Tuple with DAC codes, last DAC first
         """
+        return tuple(int(vdac * 16383 / self.vsupply / self.vcal) for vdac in reversed(dacs))
+
+    @staticmethod
+    def __codes_vector(pos: int, codes: tuple) -> BitArray:
+        """Generate VB bitvector from position and DAC codes
 
-        vdacbits = BitArray()
+        :param pos: Card slot
+        :param codes: DAC codes, last DAC first
+
+        :returns: Voltageboard config vector
+        """
+        words = np.array(codes, dtype=np.int64)
 
-        # Reverse List of dacs in-place
-        dacs.reverse()
+        if np.any((words < 0) | (words >= 1 << VB_DACBITS)):
+            raise ValueError(f"DAC codes must be 0 - {(1 << VB_DACBITS) - 1}: {codes}")
 
-        for vdac in dacs:
+        # 14 bit DAC code and 2 zero bits per DAC, followed by the card select byte
+        data = (words << 2).astype('>u2').tobytes() + bytes([0b10000000 >> (pos - 1)])
 
-            dacvalue = int(vdac * 16383 / self.vsupply / self.vcal)
+        return BitArray(bytes=data)
 
-            vdacbits.append(BitArray(uint=dacvalue, length=14))
-            vdacbits.append(BitArray(uint=0, length=2))
+    def __vb_vector(self, pos: int, dacs: list[float]) -> BitArray:
+        """Generate VB bitvector from position and dacvalues
 
-        vdacbits.append(BitArray(uint=(0b10000000 >> (pos - 1)), length=8))
+        :param pos: Card slot
+        :param dacs: List with DAC values
 
-        return vdacbits
+        :returns: Voltageboard config vector
+        """
+        return self.__codes_vector(pos, self.__dac_codes(dacs))
 
     @property
     def vcal(self) -> float:
@@ -110,16 +128,25 @@ class Voltageboard(Nexysio):
         if 1 <= pos <= 8:
             self._pos = pos
 
+    def vb_pattern(self) -> bytes:
+        """Generate GECCO pattern for the current position and dacvalues
+
+        Patterns are cached by card position, DAC codes and clockdivider,
+        repeated settings are returned without regenerating the pattern.
+
+        :returns: Pattern with header
+        """
+
+        codes = self.__dac_codes(self.dacvalues)
+
+        return self.pattern_cache.get(
+            ('vb', self.pos, codes, VB_CLKDIV),
+            lambda: self.gen_gecco_pattern(VB_ADRESS, self.__codes_vector(self.pos, codes), VB_CLKDIV))
+
     def update_vb(self) -> None:
         """Update voltageboard"""
 
-        # Generate vector
-        vdacbits = self.__vb_vector(self.pos, self.dacvalues)
-
         # print(f'update_vb pos: {self.pos} value: {self.dacvalues}\n')
 
-        # Generate pattern
-        vbbits = self.gen_gecco_pattern(12, vdacbits, 8)
-
-        # Write to nexys
-        self.write(vbbits)
+        # Generate vector and pattern, write to nexys
+        self.write(self.vb_pattern())
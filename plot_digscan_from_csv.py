@@ -4,6 +4,7 @@ import pandas as pd
 import math
 
 from analysis.scurve_fit import Analysis
+from modules.hitstore import load_hits
 
 std_linewidth = 1
 
@@ -13,7 +14,8 @@ filename = "dig_inj_scan_20230912-124417"
 
 x_highres = np.arange(0, 1, 0.002)
 
-df = pd.read_csv('./log/' + filename + '.log', sep=',', skiprows=9)
+# .log for CSV scans, .parquet for Parquet scans
+df, metadata = load_hits('./log/' + filename + '.log', columns=['scan_col', 'scan_row', 'vinj'])
 
 
 n_plots = 35
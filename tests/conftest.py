@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Shared fixtures, tests run against the software emulated Nexys
+"""
+import os
+
+import pytest
+
+from modules.nexysio import Nexysio
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # Configs are loaded relative to the repository
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture
+def nexys():
+    nexys = Nexysio()
+    nexys.open_emulator()
+    return nexys
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Byte-by-byte reference implementations of the original decode, pattern
+and config vector generation, the optimized code has to match them exactly
+"""
+from bitstring import BitArray
+
+from modules.nexysio import WRITE_ADRESS, SR_ASIC_ADRESS, SIN_ASIC, LD_ASIC, LD_TDAC_ASIC, SIN_GECCO, LD_GECCO
+from modules.spi import SPI_SR_BROADCAST, SPI_SR_BIT0, SPI_SR_BIT1, SPI_SR_LOAD, SPI_EMPTY_BYTE, SPI_HEADER_SR
+
+
+def reverse_bitorder(data: bytes) -> bytearray:
+    return bytearray(int(bin(item)[2:].zfill(8)[::-1], 2) for item in data)
+
+
+def hits_from_readoutstream(readout: bytes, nchips: int = 1, bytesperhit: int = 5,
+                            reverse: bool = True) -> list:
+    header = set()
+
+    for i in range(nchips):
+        id = (i << 3) + bytesperhit - 1
+        header.add(int(f'{id:08b}'[::-1], 2) if reverse else id)
+
+    length = len(readout)
+    hitlist = []
+    i = 0
+
+    while i < length:
+        if readout[i] not in header:
+            i += 1
+        elif i + bytesperhit <= length:
+            hit = readout[i:i + bytesperhit]
+            hitlist.append(reverse_bitorder(hit) if reverse else bytearray(hit))
+            i += bytesperhit
+        else:
+            break
+
+    return hitlist
+
+
+def gray_to_dec(gray: int) -> int:
+    bits = gray >> 1
+    while bits:
+        gray ^= bits
+        bits >>= 1
+    return gray
+
+
+def decode_astropix2_hits(list_hits: list) -> list:
+    rows = []
+
+    for header, location, timestamp, tot_msb, tot_lsb in list_hits:
+        rows.append([header >> 3, header & 0b111, location & 0b111111, location >> 7 & 1, timestamp,
+                     ((tot_msb & 0b1111) << 8) + tot_lsb])
+
+    return rows
+
+
+def decode_astropix4_hits(list_hits: list) -> list:
+    rows = []
+
+    for header, byte1, byte2, byte3, byte4, byte5, byte6, byte7 in list_hits:
+        ts1 = ((byte2 & 0b11111) << 9) + (byte3 << 1) + (byte4 >> 7)
+        tsfine1 = (byte4 >> 4) & 0b111
+        ts2 = ((byte5 & 0b111111) << 8) + byte6
+        tsfine2 = (byte7 >> 5) & 0b111
+
+        rows.append([header >> 3, header & 0b111, byte1 >> 3, ((byte1 & 0b111) << 2) + (byte2 >> 6),
+                     ts1, tsfine1, ts2, tsfine2, (byte2 >> 5) & 0b1, (byte5 >> 6) & 0b1,
+                     ((byte4 & 0b1111) << 1) + (byte5 >> 7), byte7 & 0b11111,
+                     gray_to_dec((ts1 << 3) + tsfine1), gray_to_dec((ts2 << 3) + tsfine2)])
+
+    return rows
+
+
+def addbytes(value: bytearray, clkdiv: int) -> bytearray:
+    data = bytearray()
+
+    for byte in value:
+        data.extend([byte] * max(clkdiv, 1))
+
+    return data
+
+
+def gen_gecco_pattern(address: int, value, clkdiv: int = 16) -> bytes:
+    length = (len(value) * 3 + 20) * clkdiv
+
+    header = bytearray([WRITE_ADRESS, address, length >> 8, length % 256])
+
+    data = bytearray()
+    for bit in value:
+        pattern = SIN_GECCO if bit == 1 else 0
+        data.extend([pattern, pattern | 1, pattern])
+
+    data.extend([LD_GECCO, 0x00])
+    data.extend([0x01, 0x00] * 8)
+    data.extend([LD_GECCO, 0x00])
+
+    return bytes(header + addbytes(data, clkdiv))
+
+
+def gen_asic_pattern_part(value, wload: bool, clkdiv: int = 8, readback_mode: bool = False,
+                          load_signal: int = LD_ASIC) -> bytes:
+    if not readback_mode:
+        length = (len(value) * 5 + 30) * clkdiv
+    else:
+        length = ((len(value) + 1) * 5) * clkdiv
+
+    header = bytearray([WRITE_ADRESS, SR_ASIC_ADRESS, length >> 8, length % 256])
+
+    data, load = bytearray(), bytearray()
+
+    if not readback_mode:
+        for bit in value:
+            pattern = SIN_ASIC if bit == 1 else 0
+            data.extend([pattern, pattern | 1, pattern, pattern | 2, pattern])
+
+        if wload:
+            load.extend([0x00, load_signal, 0x00])
+
+        data = addbytes(data, clkdiv)
+        data.extend(addbytes(load, clkdiv * 10))
+    else:
+        data.extend([4 | 32, 4 | 33, 4 | 32, 4 | 34, 4 | 32])
+        for bit in value:
+            data.extend([4, 4 | 1, 4, 4 | 2, 4])
+        data = addbytes(data, clkdiv)
+
+    return bytes(header + data)
+
+
+def gen_tdac_pattern(value, wload: bool, clkdiv: int = 8) -> bytes:
+    return gen_asic_pattern_part(value, wload, clkdiv, load_signal=LD_TDAC_ASIC)
+
+
+def gen_asic_pattern(value, wload: bool, clkdiv: int = 8, readback_mode: bool = False) -> list:
+    data = []
+
+    if not readback_mode:
+        max_value = int((65534 / clkdiv - 30) / 5)
+    else:
+        max_value = int((65534 / clkdiv) / 5) - 1
+
+    length = len(value)
+
+    while length >= max_value:
+        data.append(gen_asic_pattern_part(value[:max_value], False, clkdiv, readback_mode))
+        value = value[max_value + 1:]
+        length -= max_value
+    else:
+        data.append(gen_asic_pattern_part(value, wload, clkdiv, readback_mode))
+
+    return data
+
+
+def asic_spi_vector(value, load: bool, n_load: int = 10, broadcast: bool = True, chipid: int = 0) -> bytearray:
+    data = bytearray([SPI_SR_BROADCAST if broadcast else SPI_HEADER_SR | chipid])
+
+    for bit in value:
+        data.append(SPI_SR_BIT1 if bit == 1 else SPI_SR_BIT0)
+
+    if load:
+        data.extend([SPI_SR_LOAD] * n_load)
+        data.extend([SPI_EMPTY_BYTE] * n_load)
+
+    return data
+
+
+def gen_asic_vector(asic_config: dict, msbfirst: bool = False) -> BitArray:
+    """Single chip vector, the original telescope chain reversed the accumulated vector per chip"""
+    bitvector = BitArray()
+
+    for key in asic_config:
+        for values in asic_config[key].values():
+            bits = BitArray(uint=values[1], length=values[0])
+            if key == 'vdac_block':
+                bits.reverse()
+            bitvector.append(bits)
+
+    if not msbfirst:
+        bitvector.reverse()
+
+    return bitvector
+
+
+def vb_vector(pos: int, dacs: list, vsupply: float, vcal: float) -> BitArray:
+    vdacbits = BitArray()
+
+    for vdac in reversed(dacs):
+        vdacbits.append(BitArray(uint=int(vdac * 16383 / vsupply / vcal), length=14))
+        vdacbits.append(BitArray(uint=0, length=2))
+
+    vdacbits.append(BitArray(uint=(0b10000000 >> (pos - 1)), length=8))
+
+    return vdacbits
+
+
+def patgen_program(period: int, cycle: int, clkdiv: int, delay: int, pulses: int, output: int) -> bytes:
+    """Injection pattern generator program as written by the original configureinjection"""
+    from modules.injectionboard import PG_WRITE, PG_OUTPUT, PG_ADDRESS, PG_DATA
+
+    def register(address: int, value: int) -> list:
+        return [WRITE_ADRESS, address, 0x00, 0x01, value]
+
+    def patgenwrite(address: int, value: int) -> list:
+        return register(PG_ADDRESS, address) + register(PG_DATA, value) + register(PG_WRITE, 1) + register(PG_WRITE, 0)
+
+    data = register(PG_OUTPUT, output)
+
+    for address, value in enumerate([1, 3, 0, 0, 0, 0, 0, 0, period, 0b010100, cycle >> 8, cycle % 256,
+                                     delay >> 8, delay % 256, clkdiv >> 8, clkdiv % 256]):
+        data += patgenwrite(address, value)
+
+    data += patgenwrite(7, pulses)
+
+    return bytes(data)
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Readout streams for decoder tests
+"""
+import numpy as np
+
+from modules.bitorder import BITREVERSE_LUT
+from modules.emulator import HitGenerator
+from modules.spi import SPI_IDLE_BYTES
+
+
+def random_stream(chipversion: int, nhits: int, seed: int = 1, nchips: int = 2) -> bytes:
+    """Frames separated by random idle padding and garbage bytes, incomplete hit at the end"""
+    rng = np.random.default_rng(seed)
+    hitgen = HitGenerator(chipversion=chipversion, nchips=nchips, seed=seed)
+
+    frames = np.frombuffer(hitgen.frames(nhits), dtype=np.uint8).reshape(-1, hitgen.bytesperhit)
+
+    stream = bytearray()
+    for frame in frames:
+        stream.extend(rng.choice(SPI_IDLE_BYTES, rng.integers(0, 4)).astype(np.uint8).tobytes())
+        stream.extend(rng.integers(0, 256, rng.integers(0, 3), dtype=np.uint8).tobytes())
+        stream.extend(frame.tobytes())
+
+    stream.extend(frames[0, :2].tobytes())
+
+    return bytes(stream)
+
+
+def header_dense_stream(nbytes: int, bytesperhit: int = 5, nchips: int = 2, seed: int = 1) -> bytes:
+    """Random bytes, about half of them bitreversed headers, so hit candidates overlap a lot"""
+    rng = np.random.default_rng(seed)
+
+    headers = BITREVERSE_LUT[(np.arange(nchips) << 3) + bytesperhit - 1]
+
+    stream = rng.integers(0, 256, nbytes, dtype=np.uint8)
+    dense = rng.random(nbytes) < 0.5
+    stream[dense] = rng.choice(headers, int(dense.sum()))
+
+    return stream.tobytes()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+ASIC config vectors and updates
+"""
+import copy
+import os
+import shutil
+
+import numpy as np
+import pytest
+import yaml
+
+from modules.asic import Asic, ConfigCache
+from modules.nexysio import DEMUX_ADRESS
+
+from tests import legacy
+
+
+def load_asic(nexys, chipversion: int, filename: str, **kwargs) -> Asic:
+    asic = Asic(nexys._handle)
+    asic.load_conf_from_yaml(chipversion, filename, cache=False, **kwargs)
+    return asic
+
+
+@pytest.mark.parametrize('chipversion, filename, chipname', [(1, 'testconfig_lf_tst', 'astropix_lf_test'),
+                                                             (2, 'testconfig', 'astropix'),
+                                                             (4, 'testconfig_v4', 'astropix')])
+def test_asic_vector_matches_legacy(nexys, chipversion, filename, chipname):
+    asic = load_asic(nexys, chipversion, filename, chipname=chipname)
+
+    assert asic.gen_asic_vector() == legacy.gen_asic_vector(asic.asic_config)
+
+    # Patched config vector follows dict and pixel changes
+    block = next(iter(asic.asic_config))
+    name, (nbits, value) = next(iter(asic.asic_config[block].items()))
+    asic.asic_config[block][name] = [nbits, (value + 1) % (1 << nbits)]
+
+    if 'recconfig' in asic.asic_config:
+        asic.enable_pixel(2, 3)
+        asic.enable_inj_col(2)
+
+    assert asic.gen_asic_vector() == legacy.gen_asic_vector(asic.asic_config)
+
+
+def test_update_asic_writes_both_demux_positions(nexys):
+    emulator = nexys._handle
+    asic = load_asic(nexys, 1, 'testconfig_lf_tst')
+
+    expected = np.fromiter(legacy.gen_asic_vector(asic.asic_config), dtype=np.uint8)
+
+    nexys.write_register(DEMUX_ADRESS, 0x00, True)
+    assert asic.update_asic()
+    assert not asic.update_asic()
+
+    nexys.write_register(DEMUX_ADRESS, 0x01, True)
+    assert asic.update_asic()
+
+    assert np.array_equal(emulator.asic_sr[0].vector, expected)
+    assert np.array_equal(emulator.asic_sr[1].vector, expected)
+
+    # Back to the first chip, config is still latched there
+    with nexys.transaction() as transaction:
+        transaction.write_register(DEMUX_ADRESS, 0x00)
+    assert not asic.update_asic()
+
+    # A reset through another Nexysio object forces the next write
+    loads = emulator.asic_sr[0].loads
+    nexys.chip_reset()
+    assert asic.update_asic()
+    assert emulator.asic_sr[0].loads == loads + 1
+
+
+@pytest.fixture
+def config_dir(tmp_path, monkeypatch):
+    """Copy of testconfig.yml in a temporary config folder"""
+    (tmp_path / 'config').mkdir()
+    shutil.copy('config/testconfig.yml', tmp_path / 'config' / 'testconfig.yml')
+    monkeypatch.chdir(tmp_path)
+
+    return tmp_path / 'config'
+
+
+def test_config_cache_sidecar_roundtrip(nexys, config_dir):
+    first = Asic(nexys._handle)
+    first.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+    assert sorted(os.listdir(config_dir)) == ['testconfig.yml', 'testconfig.yml.cache']
+
+    cache = ConfigCache(str(config_dir / 'testconfig.yml'))
+    assert cache.load() == yaml.safe_load((config_dir / 'testconfig.yml').read_text())
+    assert cache._read_cache() is not None
+
+    second = Asic(nexys._handle)
+    second.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+    assert second.asic_config == first.asic_config
+    assert second.gen_asic_vector() == legacy.gen_asic_vector(second.asic_config)
+
+
+def test_config_cache_follows_yaml_changes(nexys, config_dir):
+    yml = config_dir / 'testconfig.yml'
+
+    asic = Asic(nexys._handle)
+    asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+    config = yaml.safe_load(yml.read_text())
+    block = next(iter(config['astropix2']['config']))
+    name, (nbits, value) = next(iter(config['astropix2']['config'][block].items()))
+    config['astropix2']['config'][block][name] = [nbits, (value + 1) % (1 << nbits)]
+    yml.write_text(yaml.dump(config, sort_keys=False))
+
+    asic = Asic(nexys._handle)
+    asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+    assert asic.asic_config[block][name][1] == (value + 1) % (1 << nbits)
+    assert asic.gen_asic_vector() == legacy.gen_asic_vector(asic.asic_config)
+
+
+def test_config_cache_ignores_broken_sidecar(nexys, config_dir):
+    (config_dir / 'testconfig.yml.cache').write_bytes(b'not a pickle')
+
+    asic = Asic(nexys._handle)
+    asic.load_conf_from_yaml(2, 'testconfig', chipname='astropix')
+
+    assert asic.gen_asic_vector() == legacy.gen_asic_vector(asic.asic_config)
+    assert ConfigCache(str(config_dir / 'testconfig.yml')).load() is not None
+    assert sorted(os.listdir(config_dir)) == ['testconfig.yml', 'testconfig.yml.cache']
+
+
+def write_telescope_config(config_dir, nchips: int) -> None:
+    """Telescope config with nchips AstroPix2 chips, every chip with a different first field"""
+    chip = yaml.safe_load(open('config/testconfig.yml', encoding='utf-8'))['astropix2']
+
+    telescope = {'telescope': {'nchips': nchips}, 'geometry': chip['geometry']}
+
+    for number in range(nchips):
+        config = copy.deepcopy(chip['config'])
+        config['digitalconfig']['en_inj'] = [18, 0b101 << number]
+        config['biasconfig']['DisHiDR'] = [1, number % 2]
+        telescope[f'config_{number}'] = config
+
+    with open(config_dir / 'telescope.yml', 'w', encoding='utf-8') as stream:
+        yaml.dump({'astropix2': telescope}, stream, sort_keys=False)
+
+
+@pytest.mark.parametrize('nchips', [2, 3])
+def test_telescope_chain_segments_match_spi_vectors(nexys, config_dir, nchips):
+    write_telescope_config(config_dir, nchips)
+
+    asic = Asic(nexys._handle)
+    asic.load_conf_from_yaml(2, 'telescope', chipname='astropix')
+
+    vector = asic.gen_asic_vector()
+    msbfirst = asic.gen_asic_vector(msbfirst=True)
+
+    length = len(vector) // nchips
+    assert len(vector) == nchips * length
+
+    # LSB first is the whole chain reversed
+    msbfirst.reverse()
+    assert vector == msbfirst
+
+    for chip in range(nchips):
+        segment = vector[chip * length:(chip + 1) * length]
+        expected = legacy.gen_asic_vector(asic.asic_config[f'config_{chip}'])
+
+        assert asic.gen_asic_chip_vector(chip) == segment == expected
+        assert asic.asic_spi_vector(asic.gen_asic_chip_vector(chip), True, broadcast=False, chipid=chip) == \
+            legacy.asic_spi_vector(segment, True, broadcast=False, chipid=chip)
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Raw capture files, index rebuild and replay
+"""
+import os
+
+import numpy as np
+import pytest
+
+from modules.capture import CaptureReader, CaptureWriter, index_filename
+from modules.decode import Decode
+from modules.injectionboard import Injectionboard
+from modules.scan import Scan
+
+from tests import legacy
+from tests.streams import random_stream
+
+COLUMNS = ['id', 'payload', 'location', 'col', 'timestamp', 'tot_total']
+
+
+def write_capture(filename: str, steps: int = 3) -> list:
+    """Capture with one random stream per step, every stream split into blocks at random points"""
+    rng = np.random.default_rng(1)
+    streams = []
+
+    with CaptureWriter(filename) as capture:
+        capture.set_context(scan_col=1, scan_row=2, count=0)
+
+        for step in range(steps):
+            stream = random_stream(2, 30, seed=step + 1, nchips=2)
+            cuts = [0, *sorted(rng.integers(1, len(stream), 3)), len(stream)]
+
+            for begin, end in zip(cuts[:-1], cuts[1:]):
+                capture.write(stream[begin:end], step=step)
+
+            streams.append(stream)
+
+    return streams
+
+
+def legacy_replay(streams: list) -> list:
+    rows = []
+
+    for stream in streams:
+        rows.extend(legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(stream, nchips=2)))
+
+    return rows
+
+
+def test_replay_after_deleting_index_matches_legacy(tmp_path):
+    filename = str(tmp_path / 'run.raw')
+    streams = write_capture(filename)
+
+    with CaptureReader(filename) as reader:
+        index = reader.index.copy()
+        replayed = reader.replay(Decode(nchips=2))
+
+    assert replayed[COLUMNS].values.tolist() == legacy_replay(streams)
+
+    os.remove(index_filename(filename))
+
+    with CaptureReader(filename) as reader:
+        assert np.array_equal(reader.index, index)
+        assert reader.replay(Decode(nchips=2)).equals(replayed)
+
+        # Context selection replays only the blocks of one step
+        step = reader.replay(Decode(nchips=2), step=1)
+        assert step[COLUMNS].values.tolist() == legacy_replay(streams[1:2])
+
+    # Rebuilt index was written again
+    assert os.path.exists(index_filename(filename))
+
+
+def test_replay_with_truncated_last_block(tmp_path):
+    filename = str(tmp_path / 'run.raw')
+    streams = write_capture(filename)
+
+    # Crash while writing the last block
+    with open(filename, 'r+b') as file:
+        file.truncate(os.path.getsize(filename) - 3)
+    os.remove(index_filename(filename))
+
+    with CaptureReader(filename) as reader:
+        replayed = reader.replay(Decode(nchips=2), step=0)
+
+    assert replayed[COLUMNS].values.tolist() == legacy_replay(streams[:1])
+
+
+def test_scans_stop_capture_on_error(nexys, tmp_path):
+    filename = str(tmp_path / 'scan.raw')
+
+    # Fails inside the scan, after the capture was started
+    with pytest.raises(AttributeError):
+        Scan.inj_scan_old(None, None, None, nexys, None, capture=filename)
+    assert nexys.capture is None
+
+    inj = Injectionboard(nexys._handle, onchip=True)
+    with pytest.raises(AttributeError):
+        Scan.scan_binsearch(None, None, inj, nexys, None, capture=filename)
+    assert nexys.capture is None
+
+    with CaptureReader(filename) as reader:
+        assert len(reader) == 0
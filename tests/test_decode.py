@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Decode against the byte-by-byte reference in tests/legacy.py
+"""
+import numpy as np
+import pytest
+
+from modules.decode import Decode
+
+from tests import legacy
+from tests.streams import random_stream, header_dense_stream
+
+
+@pytest.mark.parametrize('chipversion', [2, 4])
+def test_hits_from_readoutstream_matches_legacy(chipversion):
+    bytesperhit = 8 if chipversion == 4 else 5
+    stream = random_stream(chipversion, 500)
+
+    hits = Decode(nchips=2, bytesperhit=bytesperhit).hits_from_readoutstream(stream)
+    expected = legacy.hits_from_readoutstream(stream, nchips=2, bytesperhit=bytesperhit)
+
+    assert hits.tolist() == [list(hit) for hit in expected]
+
+
+@pytest.mark.parametrize('bytesperhit', [5, 8])
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_hits_from_header_dense_stream_matches_legacy(bytesperhit, seed):
+    stream = header_dense_stream(20000, bytesperhit, seed=seed)
+
+    for reverse in (True, False):
+        hits = Decode(nchips=2, bytesperhit=bytesperhit).hits_from_readoutstream(stream, reverse)
+        expected = legacy.hits_from_readoutstream(stream, nchips=2, bytesperhit=bytesperhit, reverse=reverse)
+
+        assert hits.tolist() == [list(hit) for hit in expected]
+
+
+def test_decode_astropix2_matches_legacy():
+    stream = random_stream(2, 500)
+    decode = Decode(nchips=2)
+
+    decoded = decode.decode_astropix2_hits(decode.hits_from_readoutstream(stream))
+    expected = legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(stream, nchips=2))
+
+    assert list(decoded.columns) == ['id', 'payload', 'location', 'col', 'timestamp', 'tot_total']
+    assert decoded.values.tolist() == expected
+
+
+def test_decode_astropix4_matches_legacy():
+    stream = random_stream(4, 500)
+    decode = Decode(nchips=2, bytesperhit=8)
+
+    decoded = decode.decode_astropix4_hits(decode.hits_from_readoutstream(stream))
+    expected = legacy.decode_astropix4_hits(legacy.hits_from_readoutstream(stream, nchips=2, bytesperhit=8))
+
+    assert list(decoded.columns) == ['id', 'payload', 'row', 'col', 'ts1', 'tsfine1', 'ts2', 'tsfine2',
+                                     'tsneg1', 'tsneg2', 'tstdc1', 'tstdc2', 'ts_dec1', 'ts_dec2']
+    assert decoded.values.tolist() == expected
+
+
+def test_columns_match_dataframe():
+    stream = random_stream(4, 200)
+    decode = Decode(nchips=2, bytesperhit=8)
+    hits = decode.hits_from_readoutstream(stream)
+
+    columns = decode.decode_astropix4_columns(hits)
+    decoded = decode.decode_astropix4_hits(hits)
+
+    assert list(columns) == list(decoded.columns)
+    assert all(columns[name].tolist() == decoded[name].tolist() for name in columns)
+
+
+def test_gray_to_dec_array_matches_legacy():
+    gray = np.arange(1 << 17)
+
+    assert Decode.gray_to_dec_array(gray).tolist() == [legacy.gray_to_dec(value) for value in range(1 << 17)]
+
+
+@pytest.mark.parametrize('bytesperhit', [5, 8])
+@pytest.mark.parametrize('window_size', [8, 13, 256, 4096])
+def test_windowed_hits_from_header_dense_stream_match_legacy(bytesperhit, window_size):
+    stream = header_dense_stream(20000, bytesperhit, seed=window_size)
+    decode = Decode(nchips=2, bytesperhit=bytesperhit)
+
+    for reverse in (True, False):
+        hits = np.concatenate(list(decode.iter_hits_windowed(stream, window_size, reverse)))
+        expected = legacy.hits_from_readoutstream(stream, nchips=2, bytesperhit=bytesperhit, reverse=reverse)
+
+        assert hits.tolist() == [list(hit) for hit in expected]
+
+
+def test_decode_windowed_file_matches_legacy(tmp_path):
+    stream = header_dense_stream(50000, seed=4) + random_stream(2, 200)
+    filename = tmp_path / 'readout.raw'
+    filename.write_bytes(stream)
+
+    decode = Decode(nchips=2)
+    decoded = decode.decode_windowed(str(filename), window_size=1000)
+    expected = legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(stream, nchips=2))
+
+    assert decoded.values.tolist() == expected
+
+    with pytest.raises(ValueError):
+        next(decode.iter_hits_windowed(stream, 4))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Software Nexys emulator end to end
+"""
+import time
+
+from modules.decode import Decode
+from modules.emulator import HitGenerator
+from modules.nexysio import Nexysio
+
+from tests import legacy
+
+
+def test_decode_emulator_readout():
+    nexys = Nexysio()
+    nexys.open_emulator(hitgen=HitGenerator(seed=1))
+    nexys.spi_enable()
+    nexys.spi_reset_fpga_readout()
+
+    nexys._handle.inject(50, pixel=(3, 7))
+    # Let the FIFO fill, frames are not split by idle padding
+    time.sleep(0.05)
+    readout = nexys.read_spi_fifo(0, adaptive=True)
+
+    decode = Decode()
+    decoded = decode.decode_astropix2_hits(decode.hits_from_readoutstream(readout))
+
+    assert decoded.values.tolist() == legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(readout))
+    # One row and one column frame per hit
+    assert len(decoded) == 100
+    assert sorted(set(decoded.location.tolist())) == [3, 7]
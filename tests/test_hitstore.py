@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Hit store files written and loaded back
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.hitstore import HitStore, ParquetHitStore, PARQUET_AVAILABLE, load_hits
+
+COLUMNS = ['scan_col', 'run', 'vinj', 'location', 'tot_total']
+
+
+def scan_chunks(seed: int = 1) -> list:
+    """Decoded hit chunks with their scan constants, integer vinj steps in between"""
+    rng = np.random.default_rng(seed)
+
+    chunks = []
+    for step in range(6):
+        num = int(rng.integers(0, 5))
+        hits = pd.DataFrame({'location': rng.integers(0, 35, num), 'tot_total': rng.random(num) * 100,
+                             'col': rng.integers(0, 2, num)})
+        chunks.append((hits, {'scan_col': step % 3, 'run': step, 'vinj': step if step % 2 else step * 0.1}))
+
+    return chunks
+
+
+def concat_reference(chunks: list) -> pd.DataFrame:
+    """Hits as the scans built them before the store, with pd.concat per chunk"""
+    frame = pd.DataFrame(columns=COLUMNS)
+
+    for hits, constants in chunks:
+        hits = hits.assign(**constants)[COLUMNS]
+        frame = pd.concat([frame, hits], ignore_index=True) if len(frame) else hits.reset_index(drop=True)
+
+    frame.index.name = 'index'
+
+    return frame.astype({'scan_col': np.int64, 'run': np.int64, 'vinj': np.float64,
+                         'location': np.int64, 'tot_total': np.float64})
+
+
+def fill_store(store: HitStore, chunks: list) -> None:
+    for hits, constants in chunks:
+        store.append(hits, **constants)
+
+
+def test_csv_roundtrip_with_dtypes_and_metadata(tmp_path):
+    chunks = scan_chunks()
+    filename = str(tmp_path / 'scan.log')
+
+    with open(filename, 'w', encoding='utf-8', newline='') as file:
+        file.write('chip: astropix2\nvth: 1.2\n')
+
+        with HitStore(COLUMNS, file, flush_rows=3, keep=True, dtypes={'vinj': np.float64}) as store:
+            fill_store(store, chunks)
+            # Kept in memory, the store can not read back a file it did not open
+            assert len(store.to_dataframe()) == len(store)
+
+    frame, metadata = load_hits(filename)
+
+    assert metadata == {'chip': 'astropix2', 'vth': '1.2'}
+    pd.testing.assert_frame_equal(frame, concat_reference(chunks))
+
+    frame, _ = load_hits(filename, columns=['vinj'])
+    assert list(frame.columns) == ['vinj']
+    assert frame.vinj.dtype == np.float64
+
+
+def test_csv_store_reads_back_flushed_rows(tmp_path):
+    chunks = scan_chunks(seed=2)
+    filename = str(tmp_path / 'scan.csv')
+
+    store = HitStore.create(COLUMNS, filename, flush_rows=2, dtypes={'vinj': np.float64})
+    fill_store(store, chunks)
+
+    pd.testing.assert_frame_equal(store.to_dataframe(), concat_reference(chunks))
+    store.close()
+
+    pd.testing.assert_frame_equal(load_hits(filename)[0], concat_reference(chunks))
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='pyarrow not installed')
+def test_parquet_roundtrip_with_dtypes_and_metadata(tmp_path):
+    chunks = scan_chunks(seed=3)
+    filename = str(tmp_path / 'scan.parquet')
+    metadata = {'chip': 'astropix2', 'vboard': {'vth': 1.2, 'dacs': [0, 1.1]}, 'scan': {'method': 'inj_scan_old'}}
+
+    with HitStore.create(COLUMNS, filename, metadata=metadata, flush_rows=2,
+                         dtypes={'vinj': np.float64}) as store:
+        assert isinstance(store, ParquetHitStore)
+        fill_store(store, chunks)
+
+    frame, loaded = load_hits(filename)
+
+    assert loaded == metadata
+    pd.testing.assert_frame_equal(frame, concat_reference(chunks))
+
+    frame, _ = load_hits(filename, columns=['vinj', 'location'])
+    pd.testing.assert_frame_equal(frame, concat_reference(chunks)[['vinj', 'location']])
+
+
+@pytest.mark.skipif(not PARQUET_AVAILABLE, reason='pyarrow not installed')
+def test_empty_parquet_store_has_all_columns(tmp_path):
+    filename = str(tmp_path / 'empty.parquet')
+
+    with HitStore.create(COLUMNS, filename, metadata={'run': 1}, dtypes={'run': np.int64}):
+        pass
+
+    frame, metadata = load_hits(filename)
+
+    assert metadata == {'run': 1}
+    assert list(frame.columns) == COLUMNS and len(frame) == 0
+    assert frame.run.dtype == np.int64
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Injectionboard pattern generator programs on the emulator
+"""
+from modules.injectionboard import Injectionboard
+
+from tests import legacy
+
+
+def injectionboard(nexys, **settings) -> Injectionboard:
+    inj = Injectionboard(nexys._handle, pos=3)
+
+    inj.period = settings.get('period', 10)
+    inj.cycle = settings.get('cycle', 1)
+    inj.clkdiv = settings.get('clkdiv', 300)
+    inj.initdelay = settings.get('initdelay', 100)
+    inj.pulsesperset = settings.get('pulsesperset', 5)
+    inj.amplitude = settings.get('amplitude', 0.3)
+
+    return inj
+
+
+def recorded_writes(nexys) -> list:
+    """Record every FTDI write of the emulator"""
+    emulator = nexys._handle
+    writes = []
+    write = emulator.write
+
+    def recording_write(data):
+        writes.append(bytes(data))
+        return write(data)
+
+    emulator.write = recording_write
+
+    return writes
+
+
+def test_start_is_one_write_with_the_original_program(nexys):
+    inj = injectionboard(nexys)
+    writes = recorded_writes(nexys)
+
+    inj.start()
+
+    assert len(writes) == 1
+    assert legacy.patgen_program(10, 1, 300, 100, 5, 1) in writes[0]
+
+    # Programmed registers: timestamps, period, flags, runlength, delay, clkdiv and pulses at address 7
+    assert list(nexys._handle.patgen) == [1, 3, 0, 0, 0, 0, 0, 5, 10, 0b010100, 0, 1, 0, 100, 300 >> 8, 300 % 256]
+
+
+def test_patgen_programs_are_cached(nexys):
+    inj = injectionboard(nexys)
+
+    inj.start()
+    misses = inj.pattern_cache.misses
+
+    inj.pulsesperset = 7
+    inj.start()
+    assert inj.pattern_cache.misses == misses + 1
+
+    inj.pulsesperset = 5
+    hits = inj.pattern_cache.hits
+    writes = recorded_writes(nexys)
+    inj.start()
+
+    assert inj.pattern_cache.hits == hits + 1
+    assert legacy.patgen_program(10, 1, 300, 100, 5, 1) in writes[0]
+
+
+def test_unchanged_amplitude_is_not_rewritten(nexys):
+    inj = injectionboard(nexys)
+    inj.start()
+
+    writes = recorded_writes(nexys)
+    inj.update_inj_amplitude()
+    assert writes == []
+
+    inj.amplitude = 0.4
+    inj.update_inj_amplitude()
+    assert len(writes) == 1
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Shift register patterns against the byte-by-byte reference in tests/legacy.py
+"""
+import numpy as np
+import pytest
+from bitstring import BitArray
+
+from tests import legacy
+
+
+@pytest.mark.parametrize('nbits', [1, 150, 1608, 3000])
+@pytest.mark.parametrize('clkdiv', [1, 8, 16])
+def test_asic_patterns_match_legacy(nexys, nbits, clkdiv):
+    value = BitArray(np.random.default_rng(nbits).integers(0, 2, nbits).astype(bool).tolist())
+
+    assert [bytes(part) for part in nexys.gen_asic_pattern(value, True, clkdiv)] == \
+        legacy.gen_asic_pattern(value, True, clkdiv)
+    assert [bytes(part) for part in nexys.gen_asic_pattern(value, False, clkdiv, readback_mode=True)] == \
+        legacy.gen_asic_pattern(value, False, clkdiv, readback_mode=True)
+
+
+@pytest.mark.parametrize('nbits', [1, 35, 136])
+@pytest.mark.parametrize('clkdiv', [1, 8, 16])
+def test_tdac_gecco_patterns_match_legacy(nexys, nbits, clkdiv):
+    value = BitArray(np.random.default_rng(nbits).integers(0, 2, nbits).astype(bool).tolist())
+
+    assert bytes(nexys.gen_tdac_pattern(value, True, clkdiv)) == legacy.gen_tdac_pattern(value, True, clkdiv)
+    assert bytes(nexys.gen_gecco_pattern(12, value, clkdiv)) == legacy.gen_gecco_pattern(12, value, clkdiv)
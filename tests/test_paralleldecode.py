@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Parallel decode against the byte-by-byte reference
+"""
+import multiprocessing
+
+import pytest
+
+from modules.decode import Decode
+from modules.paralleldecode import ParallelDecode
+
+from tests import legacy
+from tests.streams import header_dense_stream
+
+
+class WorkerFailingDecode(Decode):
+    """Hit search fails in the worker processes"""
+
+    def _find_hit_offsets(self, stream, reverse_bitorder):
+        if multiprocessing.parent_process() is not None:
+            raise RuntimeError("hit search failed")
+
+        return super()._find_hit_offsets(stream, reverse_bitorder)
+
+
+@pytest.mark.parametrize('decoder, bytesperhit', [('astropix2', 5), ('astropix4', 8)])
+@pytest.mark.parametrize('seed', [1, 2])
+def test_parallel_decode_of_header_dense_stream_matches_legacy(decoder, bytesperhit, seed):
+    stream = header_dense_stream(60000, bytesperhit, seed=seed)
+    decode = Decode(nchips=2, bytesperhit=bytesperhit)
+    legacy_decode = legacy.decode_astropix4_hits if decoder == 'astropix4' else legacy.decode_astropix2_hits
+
+    for reverse in (True, False):
+        with ParallelDecode(decode, decoder, workers=2, chunk_size=4096, reverse_bitorder=reverse) as parallel:
+            decoded = parallel.decode(stream)
+
+        expected = legacy.hits_from_readoutstream(stream, nchips=2, bytesperhit=bytesperhit, reverse=reverse)
+
+        assert decoded.values.tolist() == legacy_decode(expected)
+
+
+def test_parallel_decode_of_file_matches_legacy(tmp_path):
+    stream = header_dense_stream(60000, seed=3)
+    filename = tmp_path / 'readout.raw'
+    filename.write_bytes(stream)
+
+    with ParallelDecode(Decode(nchips=2), workers=2, chunk_size=4096) as parallel:
+        decoded = parallel.decode(str(filename))
+
+    assert decoded.values.tolist() == legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(stream, nchips=2))
+
+
+@pytest.mark.parametrize('source', ['bytes', 'file'])
+def test_worker_error_is_raised(tmp_path, source):
+    stream = header_dense_stream(60000, seed=4)
+
+    if source == 'file':
+        filename = tmp_path / 'readout.raw'
+        filename.write_bytes(stream)
+        stream = str(filename)
+
+    with ParallelDecode(WorkerFailingDecode(nchips=2), workers=2, chunk_size=4096) as parallel:
+        with pytest.raises(RuntimeError, match="hit search failed"):
+            parallel.decode(stream)
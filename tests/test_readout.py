@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+ReadoutStream on the emulator
+"""
+import time
+
+import pytest
+
+from modules.decode import Decode
+from modules.readout import ReadoutStream, DecodeSink
+
+from tests import legacy
+
+
+def test_stream_decodes_injected_hits(nexys):
+    nexys.spi_enable()
+    nexys.spi_reset_fpga_readout()
+
+    raw = bytearray()
+    hits = DecodeSink()
+
+    with ReadoutStream(nexys, Decode()) as stream:
+        stream.add_sink(raw.extend)
+        stream.add_sink(hits, decoded=True)
+
+        with stream.paused():
+            nexys._handle.inject(200, pixel=(5, 9))
+
+        for _ in stream.batches(timeout=0.05, duration=0.3):
+            pass
+
+    decoded = hits.to_dataframe()
+
+    # One row and one column frame per hit
+    assert len(decoded) == 400
+    assert decoded.values.tolist() == legacy.decode_astropix2_hits(legacy.hits_from_readoutstream(bytes(raw)))
+
+
+def test_idle_reads_are_throttled(nexys):
+    nexys.spi_enable()
+
+    stream = ReadoutStream(nexys, poll_interval=0.005)
+    stream.start()
+    time.sleep(0.2)
+    stream.stop()
+
+    assert 0 < stream.bytes_read // 4096 < 100
+
+
+def test_reader_error_is_raised_in_consumer(nexys):
+    reads = []
+    read_spi = nexys.read_spi
+
+    def failing_read_spi(num):
+        reads.append(num)
+        if len(reads) > 5:
+            raise OSError("USB device gone")
+        return read_spi(num)
+
+    nexys.read_spi = failing_read_spi
+
+    stream = ReadoutStream(nexys)
+    stream.start()
+
+    with pytest.raises(OSError, match="USB device gone"):
+        for _ in stream.batches(timeout=0.05, duration=5):
+            pass
+
+    assert not stream.running
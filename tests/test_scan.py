@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Scan acquisition on the emulator
+"""
+import time
+
+import pytest
+
+from modules.decode import Decode
+from modules.emulator import HitGenerator
+from modules.injectionboard import Injectionboard, PATGEN_CLOCK_HZ
+from modules.nexysio import Nexysio
+from modules.scan import Scan
+from modules.spi import SPI_IDLE_BYTES
+
+
+@pytest.mark.parametrize('rate', [2e3, 2e4])
+def test_fifo_drain_and_acquire_end_under_steady_noise(rate):
+    nexys = Nexysio()
+    nexys.open_emulator(hitgen=HitGenerator(rate=rate, seed=1))
+    nexys.spi_enable()
+
+    start = time.monotonic()
+    nexys.read_spi_fifo(0, adaptive=True, timeout=0.2)
+    assert time.monotonic() - start < 1.0
+
+    start = time.monotonic()
+    readout = Scan.acquire(nexys, None, timeout=0.3)
+    assert time.monotonic() - start < 1.5
+    assert readout.translate(None, bytes(SPI_IDLE_BYTES))
+
+
+def acquire_burst(patgen_clock_hz: float, **kwargs) -> int:
+    """Acquire a burst of 5 pulses about 50 ms apart, number of decoded hits"""
+    nexys = Nexysio()
+    nexys.open_emulator(hitgen=HitGenerator(seed=1, pixel=(3, 7)), patgen_clock_hz=patgen_clock_hz)
+    nexys.spi_enable()
+    nexys.spi_reset_fpga_readout()
+
+    inj = Injectionboard(nexys._handle, pos=3, clock_hz=kwargs.pop('clock_hz', PATGEN_CLOCK_HZ))
+    inj.period = 255
+    inj.clkdiv = 65535
+    inj.cycle = 1
+    inj.pulsesperset = 5
+    inj.amplitude = 0.3
+
+    inj.start()
+    readout = Scan.acquire(nexys, inj, timeout=1.0, **kwargs)
+
+    return len(Decode().hits_from_readoutstream(readout))
+
+
+def test_burst_duration_follows_clock_hz(nexys):
+    inj = Injectionboard(nexys._handle, pos=3)
+    inj.period = 255
+    inj.clkdiv = 65535
+    inj.cycle = 1
+    inj.pulsesperset = 5
+
+    duration = inj.burst_duration
+    inj.clock_hz = PATGEN_CLOCK_HZ / 2
+
+    assert inj.burst_duration == pytest.approx(2 * duration)
+
+
+def test_acquire_keeps_last_hits_with_slow_patgen_clock():
+    # Patgen runs 40 % slower than assumed, the last pulse comes after burst_duration + 50 ms
+    assert acquire_burst(0.6 * PATGEN_CLOCK_HZ) == 10
+
+    # Fixed margin stops before the last pulse
+    assert acquire_burst(0.6 * PATGEN_CLOCK_HZ, margin_fraction=0) < 10
+
+    # Matching clock_hz needs no extra margin
+    assert acquire_burst(0.6 * PATGEN_CLOCK_HZ, clock_hz=0.6 * PATGEN_CLOCK_HZ, margin_fraction=0) == 10
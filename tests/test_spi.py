@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+SPI FIFO draining and config vectors
+"""
+import time
+
+import numpy as np
+import pytest
+from bitstring import BitArray
+
+from modules.emulator import HitGenerator
+from modules.nexysio import Nexysio
+from modules.spi import SPI_IDLE_BYTES
+
+from tests import legacy
+
+
+@pytest.mark.parametrize('rate', [2e3, 2e4])
+def test_adaptive_drain_ends_under_steady_noise(rate):
+    nexys = Nexysio()
+    nexys.open_emulator(hitgen=HitGenerator(rate=rate, seed=1))
+    nexys.spi_enable()
+
+    start = time.monotonic()
+    readout = nexys.read_spi_fifo(0, adaptive=True, timeout=0.2)
+
+    assert time.monotonic() - start < 1.0
+    assert readout.translate(None, bytes(SPI_IDLE_BYTES))
+
+
+def test_adaptive_drain_stops_at_max_bytes():
+    nexys = Nexysio()
+    nexys.open_emulator(hitgen=HitGenerator(rate=2e4, seed=1))
+    nexys.spi_enable()
+    time.sleep(0.05)
+
+    readout = nexys.read_spi_fifo(0, adaptive=True, max_bytes=4096, timeout=None)
+
+    assert 4096 <= len(readout) < 4096 + 65536
+
+
+@pytest.mark.parametrize('broadcast, chipid', [(True, 0), (False, 3)])
+def test_asic_spi_vector_matches_legacy(nexys, broadcast, chipid):
+    value = BitArray(np.random.default_rng(chipid).integers(0, 2, 1608).astype(bool).tolist())
+
+    for load in (True, False):
+        assert bytes(nexys.asic_spi_vector(value, load, broadcast=broadcast, chipid=chipid)) == \
+            bytes(legacy.asic_spi_vector(value, load, broadcast=broadcast, chipid=chipid))
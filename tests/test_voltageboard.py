@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Voltageboard patterns against the reference in tests/legacy.py
+"""
+import numpy as np
+
+from modules.voltageboard import Voltageboard
+
+from tests import legacy
+
+
+def test_voltageboard_pattern_matches_legacy(nexys):
+    dacs = [0, 0, 1.1, 1, 0, 0, 0.8, 1.2]
+    vboard = Voltageboard(nexys._handle, 4, (8, list(dacs)))
+
+    for vth in (1.2, 1.25, 1.2):
+        vboard.dacvalues = (8, dacs[:7] + [vth])
+        vboard.update_vb()
+
+        vector = legacy.vb_vector(4, vboard.dacvalues, vboard.vsupply, vboard.vcal)
+
+        assert vboard.dacvalues == dacs[:7] + [vth]
+        assert bytes(vboard.vb_pattern()) == legacy.gen_gecco_pattern(12, vector, 8)
+        assert np.array_equal(nexys._handle.gecco_vector, np.fromiter(vector, dtype=np.uint8))
+
+
+def test_voltageboard_pattern_cache_is_bounded(nexys):
+    vboard = Voltageboard(nexys._handle, 4, (8, [0, 0, 1.1, 1, 0, 0, 0.8, 1.2]))
+
+    for step in range(100):
+        vboard.dacvalues = (8, [0, 0, 1.1, 1, 0, 0, 0.8, 1.0 + step * 0.005])
+        vector = legacy.vb_vector(4, vboard.dacvalues, vboard.vsupply, vboard.vcal)
+
+        assert bytes(vboard.vb_pattern()) == legacy.gen_gecco_pattern(12, vector, 8)
+
+    assert len(vboard.pattern_cache) <= 64